@@ -1,22 +1,42 @@
 #!/usr/bin/env python3
+import asyncio
+import base64
+import hashlib
+import hmac
+import contextvars
+import difflib
 import json
 import os
+import random
+import secrets
 import re
+import socket
 import sqlite3
+import ssl
 import subprocess
+import sys
 import threading
 import time
+import shlex
 import shutil
 import signal
+import stat
 import urllib.error
+import urllib.parse
 import urllib.request
-from contextlib import contextmanager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta
-from functools import wraps
+from email.utils import parsedate_to_datetime
+from functools import lru_cache, wraps
 
 from flask import Flask, abort, flash, g, jsonify, redirect, render_template, request, send_from_directory, session, url_for
 from werkzeug.utils import secure_filename
 
+import proc_limits
+import warm_runner
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.getenv("ATC_DB_PATH", os.path.join(BASE_DIR, "data", "tasks.db"))
 ADMIN_USERNAME = os.getenv("ATC_ADMIN_USERNAME", "root")
@@ -24,6 +44,8 @@ ADMIN_PASSWORD = os.getenv("ATC_ADMIN_PASSWORD", "k5348988")
 APP_SECRET = os.getenv("ATC_APP_SECRET", "change-me-now")
 WORKDIR = os.getenv("ATC_WORKDIR", BASE_DIR)
 DEFAULT_MAX_CONCURRENT = int(os.getenv("ATC_MAX_CONCURRENT", "4"))
+WORKFLOW_ENGINE = "asyncio" if (os.getenv("ATC_WORKFLOW_ENGINE", "thread") or "").strip().lower() == "asyncio" else "thread"
+MAX_CONCURRENT_CAP = 512 if WORKFLOW_ENGINE == "asyncio" else 16
 ARTIFACT_ROOT = os.getenv("ATC_ARTIFACT_ROOT", os.path.join(BASE_DIR, "artifacts"))
 ROLE_DEFAULT_API_BASE = os.getenv("ATC_ROLE_DEFAULT_API_BASE", "").strip()
 ROLE_DEFAULT_API_KEY = os.getenv("ATC_ROLE_DEFAULT_API_KEY", "").strip()
@@ -33,7 +55,79 @@ ROLE_STAGE_REVIEW_MAX_RETRIES = max(0, min(5, int(os.getenv("ATC_STAGE_REVIEW_MA
 ROLE_MAX_TOOL_ROUNDS = max(1, min(10, int(os.getenv("ATC_ROLE_MAX_TOOL_ROUNDS", "5"))))
 ROLE_REASONING_EFFORT = (os.getenv("ATC_ROLE_REASONING_EFFORT", "high") or "high").strip()
 ROLE_CROSS_REVIEW_ROUNDS = max(0, min(6, int(os.getenv("ATC_ROLE_CROSS_REVIEW_ROUNDS", "3"))))
+ADAPTIVE_REVIEW = os.getenv("ATC_ADAPTIVE_REVIEW", "1").strip().lower() in ("1", "true", "yes", "on")
+ADAPTIVE_REVIEW_MIN_SAMPLES = max(3, int(os.getenv("ATC_ADAPTIVE_REVIEW_MIN_SAMPLES", "8")))
+ADAPTIVE_REVIEW_WINDOW = 50
+ADAPTIVE_REVIEW_SPOT_CHECK = 4
+# 独立质控样本（非沿用对抗评审结论的质控调用）少于此数时，不按质控通过率调整策略
+ADAPTIVE_REVIEW_QC_MIN_SAMPLES = max(3, ADAPTIVE_REVIEW_MIN_SAMPLES // 2)
+SPECULATIVE_STAGES = os.getenv("ATC_SPECULATIVE_STAGES", "0").strip().lower() in ("1", "true", "yes", "on")
+DELTA_REVIEW = os.getenv("ATC_DELTA_REVIEW", "1").strip().lower() in ("1", "true", "yes", "on")
+FUSED_REVIEW = os.getenv("ATC_FUSED_REVIEW", "1").strip().lower() in ("1", "true", "yes", "on")
+PARALLEL_STAGES = os.getenv("ATC_PARALLEL_STAGES", "1").strip().lower() in ("1", "true", "yes", "on")
+WARM_RUNNER = os.getenv("ATC_WARM_RUNNER", "0").strip().lower() in ("1", "true", "yes", "on")
+WARM_RUNNER_SOCKET = os.getenv("ATC_WARM_RUNNER_SOCKET", os.path.join(BASE_DIR, "data", "warm_runner.sock"))
 ROLE_HISTORY_LIMIT = max(8, min(50, int(os.getenv("ATC_ROLE_HISTORY_LIMIT", "20"))))
+ROLE_HISTORY_VERBATIM = max(2, min(ROLE_HISTORY_LIMIT, int(os.getenv("ATC_ROLE_HISTORY_VERBATIM", "6"))))
+ROLE_PROMPT_TOKEN_BUDGET = max(2000, int(os.getenv("ATC_ROLE_PROMPT_TOKEN_BUDGET", "24000")))
+ROLE_RETRY_MAX = max(0, min(8, int(os.getenv("ATC_ROLE_RETRY_MAX", "3"))))
+ROLE_RETRY_BASE_DELAY = max(0.1, float(os.getenv("ATC_ROLE_RETRY_BASE_SECONDS", "1")))
+ROLE_RETRY_MAX_DELAY = max(1.0, float(os.getenv("ATC_ROLE_RETRY_MAX_SECONDS", "30")))
+ROLE_HEDGE_ENABLED = os.getenv("ATC_ROLE_HEDGE", "0").strip().lower() in ("1", "true", "yes", "on")
+ROLE_HEDGE_MIN_SAMPLES = max(5, int(os.getenv("ATC_ROLE_HEDGE_MIN_SAMPLES", "20")))
+TASK_TOKEN_BUDGET = max(0, int(os.getenv("ATC_TASK_TOKEN_BUDGET", "0")))
+TOKEN_BUDGET_DEGRADE_RATIO = max(0.1, min(1.0, float(os.getenv("ATC_TOKEN_BUDGET_DEGRADE_RATIO", "0.8"))))
+TASK_DEADLINE_SEC = max(0, int(os.getenv("ATC_TASK_DEADLINE_SEC", "0")))
+DEADLINE_DEGRADE_RATIO = max(0.1, min(1.0, float(os.getenv("ATC_DEADLINE_DEGRADE_RATIO", "0.8"))))
+WEBHOOK_SECRET = os.getenv("ATC_WEBHOOK_SECRET", "").strip()
+WEBHOOK_MAX_ATTEMPTS = max(1, int(os.getenv("ATC_WEBHOOK_MAX_ATTEMPTS", "8")))
+WEBHOOK_RETRY_BASE_SEC = max(0.1, float(os.getenv("ATC_WEBHOOK_RETRY_BASE_SEC", "2")))
+WEBHOOK_RETRY_MAX_SEC = max(1.0, float(os.getenv("ATC_WEBHOOK_RETRY_MAX_SEC", "600")))
+WEBHOOK_TIMEOUT_SEC = max(1.0, float(os.getenv("ATC_WEBHOOK_TIMEOUT_SEC", "10")))
+WEBHOOK_LEASE_SEC = max(60.0, WEBHOOK_TIMEOUT_SEC * 3)
+WEBHOOK_CONCURRENCY = 4
+TASK_WAIT_MAX_SEC = max(1, int(os.getenv("ATC_TASK_WAIT_MAX_SEC", "60")))
+# 同时挂起的长轮询数上限，应小于 Web 服务的请求线程数（deploy 中 gthread --threads 8），给普通请求留出线程
+TASK_WAIT_MAX_WAITERS = max(1, int(os.getenv("ATC_TASK_WAIT_MAX_WAITERS", "4")))
+TASK_TERMINAL_STATUSES = ("done", "failed")
+TASK_REUSE = (os.getenv("ATC_TASK_REUSE", "offer") or "offer").strip().lower()
+TASK_REUSE_TTL_SEC = max(0, int(os.getenv("ATC_TASK_REUSE_TTL_SEC", "86400")))
+TOOL_DIGEST_HEAD_LINES = max(5, int(os.getenv("ATC_TOOL_DIGEST_HEAD_LINES", "15")))
+TOOL_DIGEST_TAIL_LINES = max(5, int(os.getenv("ATC_TOOL_DIGEST_TAIL_LINES", "30")))
+TOOL_DIGEST_ERROR_LINES = 12
+TOOL_STREAM_LOG_SEC = max(0.2, float(os.getenv("ATC_TOOL_STREAM_LOG_SEC", "1")))
+TOOL_STREAM_LOG_MAX_LINES = max(0, int(os.getenv("ATC_TOOL_STREAM_LOG_MAX_LINES", "500")))
+TOOL_LINE_MAX_CHARS = 2000
+TOOL_DRAIN_GRACE_SEC = 2
+TOOL_ERROR_KEYWORDS = ("error", "exception", "traceback", "failed", "denied", "not found", "refused", "timeout", "失败", "异常", "错误", "拒绝")
+TOOL_ERROR_LINE_RE = re.compile(r"^.*(?:" + "|".join(map(re.escape, TOOL_ERROR_KEYWORDS)) + r").*$", re.I | re.M)
+TOOL_READ_MAX_CHARS = 6000
+TOOL_BATCH_MAX = max(1, int(os.getenv("ATC_TOOL_BATCH_MAX", "8")))
+TOOL_BATCH_CONCURRENCY = max(1, int(os.getenv("ATC_TOOL_BATCH_CONCURRENCY", "4")))
+LLM_CACHE_MODE = (os.getenv("ATC_LLM_CACHE_MODE", "off") or "off").strip().lower()
+LLM_CACHE_PATH = os.getenv("ATC_LLM_CACHE_PATH", os.path.join(os.path.dirname(DB_PATH), "llm_cache.db"))
+LLM_CACHE_MAX_MB = max(1, int(os.getenv("ATC_LLM_CACHE_MAX_MB", "256")))
+TOOL_CACHE = os.getenv("ATC_TOOL_CACHE", "0").strip().lower() in ("1", "true", "yes", "on")
+BLOB_DIR = os.getenv("ATC_BLOB_DIR", os.path.join(os.path.dirname(DB_PATH), "blobs"))
+BULK_TASK_MAX = max(1, int(os.getenv("ATC_BULK_TASK_MAX", "500")))
+TOOL_CACHE_DIR = os.getenv("ATC_TOOL_CACHE_DIR", os.path.join(os.path.dirname(DB_PATH), "tool_cache"))
+TOOL_CACHE_TTL_SEC = max(0, int(os.getenv("ATC_TOOL_CACHE_TTL_SEC", "3600")))
+TOOL_CACHE_MAX_MB = max(1, int(os.getenv("ATC_TOOL_CACHE_MAX_MB", "1024")))
+TOOL_LIMITS = proc_limits.parse_limits(
+    {
+        "cpu_sec": os.getenv("ATC_TOOL_CPU_SEC", "0"),
+        "mem_mb": os.getenv("ATC_TOOL_MEM_MB", "0"),
+        "pids": os.getenv("ATC_TOOL_PIDS", "0"),
+        "wall_sec": os.getenv("ATC_TOOL_WALL_SEC", "0"),
+    }
+)
+TOOL_CGROUP_ROOT = os.getenv("ATC_TOOL_CGROUP_ROOT", "").strip()
+TOOL_ADMISSION = os.getenv("ATC_TOOL_ADMISSION", "1").strip().lower() in ("1", "true", "yes", "on")
+TOOL_ADMIT_RESERVE_MB = max(0, int(os.getenv("ATC_TOOL_ADMIT_RESERVE_MB", "512")))
+TOOL_ADMIT_MAX_LOAD = max(0.0, float(os.getenv("ATC_TOOL_ADMIT_MAX_LOAD", "1.5")))
+TOOL_ADMIT_MAX_WAIT_SEC = max(0, int(os.getenv("ATC_TOOL_ADMIT_MAX_WAIT_SEC", "300")))
+TOOL_ADMIT_POLL_SEC = 0.5
+TOOL_ADMIT_RAMP_SEC = 10
 
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 os.makedirs(ARTIFACT_ROOT, exist_ok=True)
@@ -44,6 +138,32 @@ app.config["MAX_CONTENT_LENGTH"] = 200 * 1024 * 1024  # 200MB
 
 running_processes = {}
 task_run_context = {}
+task_llm_calls = {}
+task_token_carry = {}
+llm_round_ctx = contextvars.ContextVar("llm_round", default=0)
+task_verdict_cache = {}
+task_file_manifests = {}
+task_cancel_tokens = {}
+task_deadlines = {}
+task_tool_limits = {}
+tool_inflight = {}
+tool_admission_lock = threading.Lock()
+llm_latency_samples = {}
+llm_latency_lock = threading.Lock()
+db_local = threading.local()
+db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="atc-db-writer")
+workflow_loop = None
+workflow_loop_lock = threading.Lock()
+warm_runner_state = {"proc": None, "failedAt": 0.0}
+warm_runner_lock = threading.Lock()
+task_status_cond = threading.Condition()
+task_status_state = {"seq": 0}
+task_waiters = threading.BoundedSemaphore(TASK_WAIT_MAX_WAITERS)
+webhook_wakeup = threading.Event()
+webhook_worker_state = {"thread": None}
+webhook_worker_lock = threading.Lock()
+_llm_ssl_context = None
+_llm_proxies = None
 
 
 class ConcurrencyLimiter:
@@ -52,6 +172,23 @@ class ConcurrencyLimiter:
         self._running = 0
         self._lock = threading.Lock()
         self._cond = threading.Condition(self._lock)
+        # asyncio 引擎下排队的协程：(事件循环, asyncio.Event)，名额释放或上限调整时跨线程唤醒
+        self._async_waiters = []
+
+    def _wake_async(self):
+        # 调用方持有 _lock
+        for loop, event in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:
+                # 事件循环已关闭：等待方已不存在
+                pass
+
+    def _release(self):
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+            self._wake_async()
 
     @contextmanager
     def acquire(self):
@@ -62,14 +199,34 @@ class ConcurrencyLimiter:
         try:
             yield
         finally:
+            self._release()
+
+    @asynccontextmanager
+    async def acquire_async(self):
+        # asyncio 引擎下排队不占线程：在 asyncio.Event 上等待，名额释放时由 _release/set_limit 唤醒，语义与 acquire 一致
+        loop = asyncio.get_running_loop()
+        while True:
             with self._cond:
-                self._running -= 1
-                self._cond.notify_all()
+                if self._running < self._limit:
+                    self._running += 1
+                    break
+                waiter = (loop, asyncio.Event())
+                self._async_waiters.append(waiter)
+            try:
+                await waiter[1].wait()
+            finally:
+                with self._cond:
+                    self._async_waiters.remove(waiter)
+        try:
+            yield
+        finally:
+            self._release()
 
     def set_limit(self, limit: int):
         with self._cond:
             self._limit = max(1, int(limit))
             self._cond.notify_all()
+            self._wake_async()
 
     def get_limit(self) -> int:
         with self._lock:
@@ -83,6 +240,29 @@ class ConcurrencyLimiter:
 limiter = ConcurrencyLimiter(DEFAULT_MAX_CONCURRENT)
 
 
+class CancelToken:
+    """单次运行的取消令牌：取消该运行的顶层协程，在途的模型请求（关闭连接）与工具命令（杀进程组）随之中止。
+    thread / asyncio 引擎下都在运行所在的事件循环里生效，可从任意线程调用 cancel。"""
+
+    def __init__(self, loop, task):
+        self._loop = loop
+        self._task = task
+        self.reason = ""
+        self.cancelled_at = None
+
+    def cancel(self, reason: str) -> bool:
+        if self.cancelled_at is not None:
+            return False
+        self.reason = reason
+        self.cancelled_at = time.perf_counter()
+        try:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        except RuntimeError:
+            # 事件循环已结束：运行已收尾，无需再取消
+            return False
+        return True
+
+
 def now_str():
     return datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
 
@@ -178,6 +358,7 @@ def clear_dir_contents(path: str) -> int:
 def clear_role_session_messages(task_id: int) -> int:
     with db_conn() as conn:
         cur = conn.execute("DELETE FROM role_session_messages WHERE task_id=?", (task_id,))
+        conn.execute("DELETE FROM role_session_summaries WHERE task_id=?", (task_id,))
         return int(cur.rowcount or 0)
 
 
@@ -335,6 +516,8 @@ def extract_failure_diagnosis(logs):
         friendly_reason = f"复核/返工达到上限（{m_rework.group(1)} 轮），任务终止。"
     elif "未配置 api_base" in reason_plain or "未配置 api_key" in reason_plain:
         friendly_reason = "角色配置不完整（缺少 API Base 或 API Key），任务无法继续。"
+    elif "token 预算已耗尽" in reason_plain:
+        friendly_reason = "任务 token 用量超出预算，流程已按预算终止。"
     elif m_http and "模型请求失败" in reason_plain:
         friendly_reason = f"模型调用失败（HTTP {m_http.group(1)}），流程中断。"
     elif "质控未通过" in reason_plain:
@@ -350,8 +533,10 @@ def extract_failure_diagnosis(logs):
         suggestion = "当前阶段产出不满足验收标准。请按质控原因补齐“可验收结果”（例如实际数据/文件/结论），再重置任务。"
     elif "最大重试" in combo or "最大返工轮次" in combo:
         suggestion = "已触发重试上限。建议先优化当前阶段提示词或放宽验收条件，再重置任务；必要时提高重试上限。"
+    elif "token 预算已耗尽" in combo:
+        suggestion = "可在“用量统计”页查看各阶段 token 消耗，调高任务 token 预算或精简任务描述/附件后重置任务。"
     elif "HTTP" in combo or "模型请求失败" in combo:
-        suggestion = "模型/API调用失败。请检查角色 API 可用性、密钥有效性、模型名是否正确；网络波动时可直接重试。"
+        suggestion = "模型/API调用失败（已按角色重试策略自动退避重试并尝试回退模型）。请检查角色 API 可用性、密钥有效性、模型名是否正确，必要时在角色中心补充回退模型。"
 
     return {
         "run_id": latest_run_id,
@@ -368,6 +553,10 @@ def build_delivery_overview(task, output_files, logs):
         headline = "✅ 任务已完成，可直接查看并下载交付物"
         next_action = "优先下载“交付压缩包”，确认结果后可归档任务。"
         progress = 100
+    elif status == "done" and rc in (124, "124"):
+        headline = "⏰ 已到截止时间，已按已完成内容尽力交付"
+        next_action = "交付未经完整复核/验收，请先核对；需要补齐时可从断点恢复继续。"
+        progress = 90
     elif status == "running":
         headline = "⏳ 任务执行中，正在持续产出"
         next_action = "可先查看实时日志，等待进入“待你确认”。"
@@ -473,6 +662,7 @@ def load_multiagent_summary(output_dir: str):
                 "model": model_name,
                 "reworkRound": s.get("reworkRound") or 0,
                 "duration_sec": s.get("durationSec"),
+                "tokens": (s.get("usage") or {}).get("totalTokens"),
                 "status": track_status,
                 "reason": (reason or "")[:180],
             }
@@ -498,6 +688,70 @@ def load_multiagent_summary(output_dir: str):
     }
 
 
+def load_task_usage(task_id: int, budget: int = 0):
+    with db_conn() as conn:
+        row = conn.execute("SELECT run_id FROM llm_usage WHERE task_id=? ORDER BY id DESC LIMIT 1", (task_id,)).fetchone()
+        if not row:
+            return None
+        run_id = row["run_id"] or ""
+        rows = conn.execute(
+            """
+            SELECT stage, role_code, COUNT(*) calls,
+                   SUM(CASE WHEN cached=0 THEN prompt_tokens ELSE 0 END) prompt_tokens,
+                   SUM(CASE WHEN cached=0 THEN completion_tokens ELSE 0 END) completion_tokens,
+                   SUM(CASE WHEN cached=0 THEN reasoning_tokens ELSE 0 END) reasoning_tokens,
+                   SUM(latency_ms) latency_ms, AVG(ttfb_ms) avg_ttfb_ms,
+                   SUM(request_bytes + response_bytes) payload_bytes, SUM(cached) cached_calls
+            FROM llm_usage WHERE task_id=? AND run_id=?
+            GROUP BY stage, role_code
+            ORDER BY MIN(id) ASC
+            """,
+            (task_id, run_id),
+        ).fetchall()
+
+    items = [dict(r) for r in rows]
+    total_tokens = sum(int(r["prompt_tokens"] or 0) + int(r["completion_tokens"] or 0) for r in items)
+    return {
+        "run_id": run_id,
+        "rows": items,
+        "calls": sum(int(r["calls"] or 0) for r in items),
+        "total_tokens": total_tokens,
+        "latency_sec": round(sum(int(r["latency_ms"] or 0) for r in items) / 1000, 1),
+        "budget": budget,
+        "budget_pct": round(total_tokens * 100 / budget, 1) if budget else None,
+    }
+
+
+def load_usage_overview(days: int = 7):
+    since = (datetime.utcnow() - timedelta(days=max(1, days))).strftime("%Y-%m-%d %H:%M:%S UTC")
+    agg = """
+        COUNT(*) calls,
+        SUM(CASE WHEN cached=0 THEN prompt_tokens + completion_tokens ELSE 0 END) total_tokens,
+        SUM(CASE WHEN cached=0 THEN reasoning_tokens ELSE 0 END) reasoning_tokens,
+        SUM(latency_ms) latency_ms, AVG(latency_ms) avg_latency_ms, AVG(ttfb_ms) avg_ttfb_ms,
+        SUM(cached) cached_calls, SUM(failed) failed_calls
+    """
+    out = {"days": days}
+    with db_conn() as conn:
+        out["totals"] = dict(conn.execute(f"SELECT {agg} FROM llm_usage WHERE created_at>=?", (since,)).fetchone())
+        for key, group in [("by_stage", "stage"), ("by_role", "role_code"), ("by_model", "model")]:
+            rows = conn.execute(
+                f"SELECT {group} name, {agg} FROM llm_usage WHERE created_at>=? GROUP BY {group} ORDER BY total_tokens DESC LIMIT 30",
+                (since,),
+            ).fetchall()
+            out[key] = [dict(r) for r in rows]
+        rows = conn.execute(
+            f"""
+            SELECT u.task_id, t.title, t.workflow_code, {agg}
+            FROM llm_usage u LEFT JOIN tasks t ON t.id=u.task_id
+            WHERE u.created_at>=? GROUP BY u.task_id ORDER BY total_tokens DESC LIMIT 30
+            """,
+            (since,),
+        ).fetchall()
+        out["by_task"] = [dict(r) for r in rows]
+    return out
+
+
 def safe_join_under(root: str, rel_path: str):
     safe_full = os.path.realpath(os.path.join(root, rel_path))
     root_real = os.path.realpath(root)
@@ -506,15 +760,50 @@ def safe_join_under(root: str, rel_path: str):
     return safe_full
 
 
-@contextmanager
-def db_conn():
+def _open_db():
     conn = sqlite3.connect(DB_PATH, timeout=30)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+@contextmanager
+def db_conn():
+    # 每个线程复用一个连接（嵌套时另开临时连接）：高并发工作流下省去反复建连/关闭触发的 WAL checkpoint。
+    # 连接随线程常驻：每个 Web 请求线程（gthread --threads）、任务线程与 db_writer 线程各持有一个，线程退出时随 threading.local 回收；
+    # 事务在 with 结束时提交，空闲连接不持有读快照，不会阻止 WAL checkpoint
+    conn = getattr(db_local, "conn", None)
+    if conn is None or getattr(db_local, "busy", False):
+        temp = conn is not None
+        conn = _open_db()
+        if not temp:
+            db_local.conn = conn
+    else:
+        temp = False
+    if temp:
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+        return
+
+    db_local.busy = True
     try:
         yield conn
         conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
     finally:
-        conn.close()
+        db_local.busy = False
+
+
+async def db_write(fn, *args, **kwargs):
+    """事件循环上的 sqlite 写入交给单线程写入器执行：不阻塞事件循环，各协程的写入按提交顺序落库，
+    且所有协程共用写入器线程上的一个连接。等待写入完成后返回，之后的读取能看到这次写入。"""
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(db_writer, lambda: ctx.run(fn, *args, **kwargs))
 
 
 def ensure_column(conn, table: str, column: str, decl: str):
@@ -525,6 +814,8 @@ def ensure_column(conn, table: str, column: str, decl: str):
 
 def init_db():
     with db_conn() as conn:
+        # WAL：大量并发工作流写日志/会话时读写互不阻塞，提交不必每次 fsync
+        conn.execute("PRAGMA journal_mode=WAL")
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS tasks (
@@ -609,6 +900,124 @@ def init_db():
             """
         )
 
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS role_session_summaries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id INTEGER NOT NULL,
+                role_code TEXT NOT NULL,
+                from_id INTEGER,
+                to_id INTEGER,
+                summary TEXT,
+                source_chars INTEGER,
+                created_at TEXT
+            )
+            """
+        )
+
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS stage_review_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id INTEGER,
+                run_id TEXT,
+                workflow TEXT,
+                stage TEXT,
+                role_code TEXT,
+                model TEXT,
+                rounds_budget INTEGER,
+                rounds_used INTEGER,
+                first_pass INTEGER,
+                rounds_to_pass INTEGER,
+                qc_decision TEXT,
+                policy TEXT,
+                created_at TEXT
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS task_checkpoints (
+                task_id INTEGER PRIMARY KEY,
+                run_id TEXT,
+                stage_idx INTEGER,
+                stage TEXT,
+                stages_json TEXT,
+                state_json TEXT,
+                manifest_json TEXT,
+                message_mark INTEGER,
+                created_at TEXT
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tool_result_cache (
+                cache_key TEXT PRIMARY KEY,
+                command TEXT,
+                deps_json TEXT,
+                rc INTEGER,
+                summary_json TEXT,
+                log_blob TEXT,
+                files_json TEXT,
+                size_bytes INTEGER,
+                duration_sec REAL,
+                hit_count INTEGER DEFAULT 0,
+                created_at REAL,
+                last_used_at REAL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_stage_review_history_key ON stage_review_history(workflow, stage, role_code, model, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tool_result_cache_lru ON tool_result_cache(last_used_at)")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tool_footprints (
+                signature TEXT PRIMARY KEY,
+                runs INTEGER,
+                cpu_sec REAL,
+                max_rss_mb REAL,
+                io_bytes REAL,
+                wall_sec REAL,
+                updated_at TEXT
+            )
+            """
+        )
+
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS webhooks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL,
+                secret TEXT,
+                task_id INTEGER,
+                events TEXT,
+                enabled INTEGER DEFAULT 1,
+                created_at TEXT
+            )
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS webhook_deliveries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                webhook_id INTEGER NOT NULL,
+                task_id INTEGER,
+                event TEXT,
+                payload_json TEXT,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL,
+                last_status INTEGER,
+                last_error TEXT,
+                created_at TEXT,
+                delivered_at TEXT
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_webhooks_task ON webhooks(task_id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_webhook_deliveries_due ON webhook_deliveries(status, next_attempt_at)")
+
         # 历史库兼容：按需补字段
         ensure_column(conn, "tasks", "workflow_code", "TEXT")
         ensure_column(conn, "roles", "api_base", "TEXT")
@@ -617,6 +1026,48 @@ def init_db():
         ensure_column(conn, "roles", "temperature", "REAL DEFAULT 0.3")
         ensure_column(conn, "roles", "max_tokens", "INTEGER DEFAULT 1200")
         ensure_column(conn, "workflows", "stage_roles_json", "TEXT")
+        ensure_column(conn, "roles", "retry_max", "INTEGER")
+        ensure_column(conn, "roles", "fallback_models", "TEXT")
+        ensure_column(conn, "roles", "hedge_enabled", "INTEGER")
+        ensure_column(conn, "roles", "prompt_token_budget", "INTEGER")
+        ensure_column(conn, "tasks", "token_budget", "INTEGER")
+        ensure_column(conn, "task_checkpoints", "tokens_carried", "INTEGER DEFAULT 0")
+        ensure_column(conn, "stage_review_history", "qc_pass", "INTEGER")
+        ensure_column(conn, "workflows", "token_budget", "INTEGER")
+        ensure_column(conn, "tasks", "deadline_sec", "INTEGER")
+        ensure_column(conn, "workflows", "deadline_sec", "INTEGER")
+        ensure_column(conn, "workflows", "tool_limits", "TEXT")
+        ensure_column(conn, "tasks", "resource_json", "TEXT")
+        ensure_column(conn, "tasks", "fingerprint", "TEXT")
+        ensure_column(conn, "tasks", "reused_from", "INTEGER")
+        ensure_column(conn, "tasks", "reuse_disabled", "INTEGER")
+        ensure_column(conn, "workflows", "reuse_ttl_sec", "INTEGER")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_fingerprint ON tasks(fingerprint, id)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_tasks_updated ON tasks(updated_at, id)")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS llm_usage (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                task_id INTEGER NOT NULL,
+                run_id TEXT,
+                stage TEXT,
+                role_code TEXT,
+                round INTEGER,
+                model TEXT,
+                prompt_tokens INTEGER DEFAULT 0,
+                completion_tokens INTEGER DEFAULT 0,
+                reasoning_tokens INTEGER DEFAULT 0,
+                latency_ms INTEGER DEFAULT 0,
+                ttfb_ms INTEGER DEFAULT 0,
+                request_bytes INTEGER DEFAULT 0,
+                response_bytes INTEGER DEFAULT 0,
+                cached INTEGER DEFAULT 0,
+                failed INTEGER DEFAULT 0,
+                created_at TEXT
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_usage_task ON llm_usage(task_id, run_id)")
 
         # 默认全局角色（创建一次，后续可在页面维护）
         default_roles = [
@@ -710,13 +1161,20 @@ def init_db():
                 (ROLE_DEFAULT_API_KEY, now_str()),
             )
 
-        # 默认工作流（当前仅保留智能双角色）
+        # 默认工作流（当前仅保留智能双角色）；前端/后端实现互不依赖，可并行
+        intelligent_dual_stages = [
+            "需求评估与分配",
+            {"name": "前端实现", "after": ["需求评估与分配"]},
+            {"name": "后端实现", "after": ["需求评估与分配"]},
+            {"name": "复核", "after": ["前端实现", "后端实现"]},
+            "联合交付",
+        ]
         default_workflows = [
             (
                 "intelligent_dual",
                 "智能三角色（Lead+前端+后端+复核）",
                 "Lead先评估并分配，前后端执行，复核失败会给意见并打回",
-                json.dumps(["需求评估与分配", "前端实现", "后端实现", "复核", "联合交付"], ensure_ascii=False),
+                json.dumps(intelligent_dual_stages, ensure_ascii=False),
                 "general",
                 "Lead Agent",
                 "",
@@ -747,7 +1205,7 @@ def init_db():
             )
 
         workflow_stage_defaults = {
-            "intelligent_dual": ["需求评估与分配", "前端实现", "后端实现", "复核", "联合交付"],
+            "intelligent_dual": intelligent_dual_stages,
         }
         workflow_assignee_defaults = {
             "intelligent_dual": "Lead Agent",
@@ -793,7 +1251,7 @@ def set_setting(key: str, value: str):
 def sync_runtime_settings():
     raw = get_setting("max_concurrent", str(DEFAULT_MAX_CONCURRENT))
     try:
-        val = max(1, min(16, int(raw)))
+        val = max(1, min(MAX_CONCURRENT_CAP, int(raw)))
     except Exception:
         val = DEFAULT_MAX_CONCURRENT
     set_setting("max_concurrent", str(val))
@@ -858,12 +1316,28 @@ def parse_stages(stages_json: str):
     try:
         data = json.loads(raw)
         if isinstance(data, list):
-            return [str(x) for x in data]
+            return [str(x.get("name") or x.get("stage") or "") if isinstance(x, dict) else str(x) for x in data]
     except Exception:
         pass
     return [x.strip() for x in re.split(r"[,，\n]+", raw) if x.strip()]
 
 
+def parse_stage_deps(stages_json: str) -> dict:
+    """stages_json 中以 {"name": 阶段, "after": [依赖阶段]} 声明的依赖；未声明的阶段默认依赖前一阶段。"""
+    try:
+        data = json.loads((stages_json or "").strip() or "[]")
+    except Exception:
+        return {}
+    out = {}
+    for item in data if isinstance(data, list) else []:
+        if isinstance(item, dict):
+            name = str(item.get("name") or item.get("stage") or "").strip()
+            deps = item.get("after", item.get("depends_on"))
+            if name and isinstance(deps, list):
+                out[name] = [str(x).strip() for x in deps if str(x).strip()]
+    return out
+
+
 def parse_stage_roles(stage_roles_json: str):
     raw = (stage_roles_json or "").strip()
     if not raw:
@@ -922,6 +1396,17 @@ def append_log(task_id: int, line: str):
         )
 
 
+def append_logs(task_id: int, lines: list):
+    """批量写入多行日志（单个事务），用于工具输出等高频日志。"""
+    rid = task_run_context.get(task_id)
+    ts = now_str()
+    rows = [(task_id, ts, (f"[run:{rid}] {ln}" if rid and not ln.startswith("[run:") else ln)[:4000]) for ln in lines]
+    if not rows:
+        return
+    with db_conn() as conn:
+        conn.executemany("INSERT INTO task_logs(task_id, ts, line) VALUES(?,?,?)", rows)
+
+
 def update_task(task_id: int, **fields):
     if not fields:
         return
@@ -929,8 +1414,22 @@ def update_task(task_id: int, **fields):
     keys = list(fields.keys())
     vals = [fields[k] for k in keys]
     clause = ", ".join([f"{k}=?" for k in keys])
+    prev, queued = None, 0
     with db_conn() as conn:
+        if "status" in fields:
+            prev = conn.execute("SELECT status FROM tasks WHERE id=?", (task_id,)).fetchone()
         conn.execute(f"UPDATE tasks SET {clause} WHERE id=?", vals + [task_id])
+        changed = prev is not None and prev["status"] != fields["status"]
+        if changed:
+            # 与状态变更同一事务写入投递队列，进程中途退出也不会漏发
+            queued = enqueue_task_webhooks(conn, task_id, prev["status"])
+    if changed:
+        with task_status_cond:
+            task_status_state["seq"] += 1
+            task_status_cond.notify_all()
+    if queued:
+        ensure_webhook_worker()
+        webhook_wakeup.set()
 
 
 def get_task(task_id: int):
@@ -938,6 +1437,146 @@ def get_task(task_id: int):
         return conn.execute("SELECT * FROM tasks WHERE id=?", (task_id,)).fetchone()
 
 
+def task_status_payload(row, prev_status: str = "") -> dict:
+    return {
+        "event": "task.status",
+        "taskId": row["id"],
+        "title": row["title"],
+        "status": row["status"],
+        "previousStatus": prev_status,
+        "terminal": row["status"] in TASK_TERMINAL_STATUSES,
+        "returnCode": row["return_code"],
+        "workflow": row["workflow_code"],
+        "reusedFrom": row["reused_from"],
+        "startedAt": row["started_at"],
+        "finishedAt": row["finished_at"],
+        "updatedAt": row["updated_at"],
+    }
+
+
+def enqueue_task_webhooks(conn, task_id: int, prev_status: str) -> int:
+    """为订阅了该任务（或全局订阅）且关注该状态的 webhook 写入待投递记录，返回条数。"""
+    hooks = conn.execute("SELECT id, events FROM webhooks WHERE enabled=1 AND (task_id IS NULL OR task_id=?)", (task_id,)).fetchall()
+    if not hooks:
+        return 0
+    row = conn.execute("SELECT * FROM tasks WHERE id=?", (task_id,)).fetchone()
+    body = json.dumps(task_status_payload(row, prev_status), ensure_ascii=False)
+    targets = [h["id"] for h in hooks if not h["events"] or row["status"] in h["events"].split(",")]
+    now = time.time()
+    conn.executemany(
+        "INSERT INTO webhook_deliveries(webhook_id, task_id, event, payload_json, status, next_attempt_at, created_at) VALUES(?,?,?,?,?,?,?)",
+        [(hid, task_id, "task.status", body, "pending", now, now_str()) for hid in targets],
+    )
+    return len(targets)
+
+
+def webhook_signature(secret: str, timestamp: str, body: bytes) -> str:
+    """签名 = HMAC-SHA256(secret, "<时间戳>.<请求体>")，接收方用同一密钥重算并比较，时间戳用于拒绝重放。"""
+    return "sha256=" + hmac.new(secret.encode("utf-8"), timestamp.encode("ascii") + b"." + body, hashlib.sha256).hexdigest()
+
+
+def claim_webhook_deliveries(limit: int) -> list:
+    """取出到期的投递并加租约（多进程部署时同一条只会被一个进程取走；租约过期视为投递进程已退出，重新投递）。"""
+    now = time.time()
+    with db_conn() as conn:
+        rows = conn.execute(
+            """
+            SELECT d.*, w.url, w.secret FROM webhook_deliveries d JOIN webhooks w ON w.id=d.webhook_id
+            WHERE d.status IN ('pending', 'sending') AND d.next_attempt_at<=?
+            ORDER BY d.next_attempt_at LIMIT ?
+            """,
+            (now, limit),
+        ).fetchall()
+        claimed = []
+        for r in rows:
+            cur = conn.execute(
+                "UPDATE webhook_deliveries SET status='sending', next_attempt_at=? WHERE id=? AND next_attempt_at=?",
+                (now + WEBHOOK_LEASE_SEC, r["id"], r["next_attempt_at"]),
+            )
+            if cur.rowcount:
+                claimed.append(r)
+    return claimed
+
+
+def deliver_webhook(row):
+    body = (row["payload_json"] or "{}").encode("utf-8")
+    ts = str(int(time.time()))
+    headers = {
+        "Content-Type": "application/json",
+        "User-Agent": "agent-team-console-webhook",
+        "X-ATC-Event": row["event"],
+        "X-ATC-Delivery": str(row["id"]),
+        "X-ATC-Timestamp": ts,
+    }
+    secret = row["secret"] or WEBHOOK_SECRET
+    if secret:
+        headers["X-ATC-Signature"] = webhook_signature(secret, ts, body)
+    try:
+        status, _, data, _ = http_post_blocking(row["url"], headers, body, WEBHOOK_TIMEOUT_SEC)
+        error = "" if 200 <= status < 300 else f"HTTP {status}: {data[:200].decode('utf-8', 'replace')}"
+    except Exception as e:
+        status, error = 0, str(e)[:300]
+    attempts = int(row["attempts"] or 0) + 1
+    with db_conn() as conn:
+        if not error:
+            conn.execute(
+                "UPDATE webhook_deliveries SET status='ok', attempts=?, last_status=?, last_error=NULL, delivered_at=? WHERE id=?",
+                (attempts, status, now_str(), row["id"]),
+            )
+        elif attempts >= WEBHOOK_MAX_ATTEMPTS:
+            conn.execute(
+                "UPDATE webhook_deliveries SET status='failed', attempts=?, last_status=?, last_error=? WHERE id=?",
+                (attempts, status, error, row["id"]),
+            )
+        else:
+            # full jitter 指数退避，与模型请求重试一致
+            delay = random.uniform(0, min(WEBHOOK_RETRY_MAX_SEC, WEBHOOK_RETRY_BASE_SEC * (2 ** (attempts - 1))))
+            conn.execute(
+                "UPDATE webhook_deliveries SET status='pending', attempts=?, last_status=?, last_error=?, next_attempt_at=? WHERE id=?",
+                (attempts, status, error, time.time() + delay, row["id"]),
+            )
+    if error:
+        msg = f"[webhook] 投递 #{row['id']} 失败（第 {attempts} 次）：{error}"
+        if row["task_id"]:
+            append_log(row["task_id"], msg)
+        else:
+            app.logger.warning(msg)
+
+
+def webhook_worker():
+    with ThreadPoolExecutor(max_workers=WEBHOOK_CONCURRENCY, thread_name_prefix="webhook") as pool:
+        while True:
+            webhook_wakeup.clear()
+            try:
+                rows = claim_webhook_deliveries(WEBHOOK_CONCURRENCY)
+                if rows:
+                    list(pool.map(deliver_webhook, rows))
+                    continue
+                with db_conn() as conn:
+                    nxt = conn.execute("SELECT MIN(next_attempt_at) t FROM webhook_deliveries WHERE status IN ('pending', 'sending')").fetchone()["t"]
+            except Exception as e:
+                app.logger.warning("[webhook] 投递循环异常：%s", e)
+                nxt = None
+            webhook_wakeup.wait(5.0 if nxt is None else min(5.0, max(0.05, nxt - time.time())))
+
+
+def ensure_webhook_worker():
+    with webhook_worker_lock:
+        t = webhook_worker_state["thread"]
+        if t is None or not t.is_alive():
+            t = threading.Thread(target=webhook_worker, name="webhook-worker", daemon=True)
+            t.start()
+            webhook_worker_state["thread"] = t
+
+
+def resume_webhook_deliveries():
+    """启动时若队列中还有未完成的投递（上次退出前未发出或等待重试），拉起投递线程。"""
+    with db_conn() as conn:
+        pending = conn.execute("SELECT 1 FROM webhook_deliveries WHERE status IN ('pending', 'sending') LIMIT 1").fetchone()
+    if pending:
+        ensure_webhook_worker()
+
+
 def save_role_message(task_id: int, role_code: str, stage: str, turn: str, content: str):
     with db_conn() as conn:
         conn.execute(
@@ -949,12 +1588,136 @@ def save_role_message(task_id: int, role_code: str, stage: str, turn: str, conte
 def load_role_messages(task_id: int, role_code: str, limit: int = 8):
     with db_conn() as conn:
         rows = conn.execute(
-            "SELECT turn, content FROM role_session_messages WHERE task_id=? AND role_code=? ORDER BY id DESC LIMIT ?",
+            "SELECT id, stage, turn, content FROM role_session_messages WHERE task_id=? AND role_code=? ORDER BY id DESC LIMIT ?",
             (task_id, role_code, max(1, int(limit))),
         ).fetchall()
     return list(reversed(rows))
 
 
+def estimate_tokens(text: str) -> int:
+    s = text or ""
+    cjk = len(re.findall(r"[\u3000-\u9fff\uff00-\uffef]", s))
+    return cjk + (len(s) - cjk) // 4 + 1
+
+
+def role_prompt_token_budget(role) -> int:
+    raw = role["prompt_token_budget"] if "prompt_token_budget" in role.keys() else None
+    try:
+        return max(2000, int(raw)) if raw else ROLE_PROMPT_TOKEN_BUDGET
+    except Exception:
+        return ROLE_PROMPT_TOKEN_BUDGET
+
+
+def summarize_turn_extractive(stage: str, turn: str, content: str, seen: set, max_chars: int = 360) -> str:
+    # 抽取式摘要：首行 + 含结论/决策/产物/返回码的关键行（同一摘要块内去重），不额外调用模型
+    lines = [ln.strip() for ln in (content or "").splitlines() if ln.strip()]
+    if not lines:
+        return ""
+    keys = ["结论", "decision", "PASS", "FAIL", "原因", "返回码", "rc=", "文件", "产出", "交付", "问题", "修改要求", "命令", "action", ".json", ".md", ".csv", ".zip"]
+    picked = []
+    for i, ln in enumerate(lines):
+        if (i == 0 or any(k in ln for k in keys)) and ln not in seen:
+            seen.add(ln)
+            picked.append(ln)
+    if not picked:
+        return ""
+    text = " / ".join(picked)
+    if len(text) > max_chars:
+        text = text[: max_chars - 1] + "…"
+    return f"[{stage or '-'}|{turn}] {text}"
+
+
+def load_role_summaries(task_id: int, role_code: str, before_id: int) -> list:
+    """older turns（id < before_id）按块生成摘要并落库，已摘要的块直接复用。"""
+    with db_conn() as conn:
+        rows = conn.execute(
+            "SELECT to_id, summary FROM role_session_summaries WHERE task_id=? AND role_code=? ORDER BY to_id ASC",
+            (task_id, role_code),
+        ).fetchall()
+        covered_to = int(rows[-1]["to_id"]) if rows else 0
+        summaries = [r["summary"] for r in rows if int(r["to_id"]) < before_id]
+        pending = conn.execute(
+            "SELECT id, stage, turn, content FROM role_session_messages WHERE task_id=? AND role_code=? AND id>? AND id<? ORDER BY id ASC",
+            (task_id, role_code, covered_to, before_id),
+        ).fetchall()
+        if pending:
+            seen = set()
+            parts = [summarize_turn_extractive(r["stage"], r["turn"], r["content"], seen) for r in pending]
+            summary = "\n".join(p for p in parts if p)
+            conn.execute(
+                """
+                INSERT INTO role_session_summaries(task_id, role_code, from_id, to_id, summary, source_chars, created_at)
+                VALUES(?,?,?,?,?,?,?)
+                """,
+                (task_id, role_code, pending[0]["id"], pending[-1]["id"], summary, sum(len(r["content"] or "") for r in pending), now_str()),
+            )
+            summaries.append(summary)
+    return summaries
+
+
+def truncate_middle(text: str, max_tokens: int) -> str:
+    s = text or ""
+    if estimate_tokens(s) <= max_tokens:
+        return s
+    ratio = max_tokens / max(1, estimate_tokens(s))
+    keep = max(200, int(len(s) * ratio) - 40)
+    head = keep * 2 // 3
+    return s[:head] + f"\n\n…（中间 {len(s) - keep} 字符已按 token 预算省略）…\n\n" + s[-(keep - head):]
+
+
+def build_role_messages(task_id: int, role, sys_prompt: str, user_prompt: str):
+    """最近若干轮原样保留，更早的轮次替换为缓存摘要，整体受角色 token 预算约束。"""
+    history = load_role_messages(task_id, role["code"], limit=ROLE_HISTORY_LIMIT)
+    history = [h for h in history if (h["turn"] or "").strip().lower() in ("user", "assistant", "system")]
+    budget = role_prompt_token_budget(role)
+
+    # legacy：旧逻辑下会原样发送的历史窗口 + 本轮提示词，用于统计节省量
+    legacy_tokens = estimate_tokens(sys_prompt) + estimate_tokens(user_prompt) + sum(estimate_tokens(h["content"]) for h in history)
+
+    recent = list(history[-ROLE_HISTORY_VERBATIM:])
+    summaries = load_role_summaries(task_id, role["code"], recent[0]["id"]) if recent else []
+    summary_budget = budget // 4
+    summary_lines = []
+    used = 0
+    for block in reversed(summaries):
+        t = estimate_tokens(block)
+        if used + t > summary_budget:
+            break
+        summary_lines.insert(0, block)
+        used += t
+
+    system_content = sys_prompt
+    if summary_lines:
+        system_content += "\n\n【早期会话摘要（自动压缩）】\n" + "\n".join(summary_lines)
+
+    dropped = 0
+    fixed = estimate_tokens(system_content) + estimate_tokens(user_prompt)
+    while recent and fixed + sum(estimate_tokens(h["content"]) for h in recent) > budget:
+        recent.pop(0)
+        dropped += 1
+    user_content = user_prompt
+    if fixed > budget:
+        user_content = truncate_middle(user_prompt, max(500, budget - estimate_tokens(system_content)))
+
+    messages = [{"role": "system", "content": system_content}]
+    for h in recent:
+        messages.append({"role": (h["turn"] or "").strip().lower(), "content": h["content"] or ""})
+    messages.append({"role": "user", "content": user_content})
+
+    sent_tokens = sum(estimate_tokens(m["content"]) for m in messages)
+    metrics = {
+        "budgetTokens": budget,
+        "legacyTokens": legacy_tokens,
+        "sentTokens": sent_tokens,
+        "savedTokens": max(0, legacy_tokens - sent_tokens),
+        "verbatimTurns": len(recent),
+        "summaryBlocks": len(summary_lines),
+        "droppedTurns": dropped,
+        "promptTruncated": user_content is not user_prompt,
+    }
+    return messages, metrics
+
+
 def parse_task_sections(description: str):
     text = (description or "").strip()
     out = {"task": "", "delivery": "", "extra": text}
@@ -1063,87 +1826,848 @@ def _extract_content_from_chat_response(data: dict) -> str:
     return (content or "").strip()
 
 
-def call_role_llm(role, messages):
-    api_base = (role["api_base"] or ROLE_DEFAULT_API_BASE or "").strip()
-    api_key = (role["api_key"] or ROLE_DEFAULT_API_KEY or "").strip()
-    model = (role["default_model"] or "").strip()
+def llm_cache_mode() -> str:
+    mode = LLM_CACHE_MODE.replace("_", "-")
+    if mode in ("rw", "read-write", "on"):
+        return "rw"
+    if mode in ("replay", "replay-only"):
+        return "replay"
+    return "off"
 
-    if not api_base:
-        raise RuntimeError(f"角色 {role['code']} 未配置 api_base")
-    if not api_key:
-        raise RuntimeError(f"角色 {role['code']} 未配置 api_key")
-    if not model:
-        raise RuntimeError(f"角色 {role['code']} 未配置模型")
 
-    base = api_base.rstrip("/")
-    url = (base + "/chat/completions") if base.endswith("/v1") else (base + "/v1/chat/completions")
-    payload = {
-        "model": model,
-        "messages": messages,
-        "temperature": float(role["temperature"] if role["temperature"] is not None else 0.3),
-        "max_tokens": int(role["max_tokens"] if role["max_tokens"] is not None else 1200),
-    }
+@contextmanager
+def llm_cache_conn():
+    conn = sqlite3.connect(LLM_CACHE_PATH, timeout=30)
+    conn.row_factory = sqlite3.Row
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
 
-    # GPT/Codex 角色默认开启深度思考参数（MiniMax等模型不注入）
-    ml = model.lower()
-    if ml.startswith("gpt-") or ("codex" in ml):
-        effort = ROLE_REASONING_EFFORT if ROLE_REASONING_EFFORT in ("low", "medium", "high") else "high"
-        payload["reasoning"] = {"effort": effort}
-        payload["thinking"] = effort
-    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
 
-    req = urllib.request.Request(
-        url,
-        data=body,
-        method="POST",
-        headers={
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        },
-    )
+def init_llm_cache():
+    if llm_cache_mode() == "off":
+        return
+    os.makedirs(os.path.dirname(LLM_CACHE_PATH) or ".", exist_ok=True)
+    with llm_cache_conn() as conn:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS llm_response_cache (
+                cache_key TEXT PRIMARY KEY,
+                api_base TEXT,
+                model TEXT,
+                response TEXT,
+                size_bytes INTEGER,
+                latency_ms INTEGER,
+                hit_count INTEGER DEFAULT 0,
+                created_at TEXT,
+                last_used_at REAL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_lru ON llm_response_cache(last_used_at)")
 
-    timeout = max(30, ROLE_DEFAULT_TIMEOUT)
-    try:
-        with urllib.request.urlopen(req, timeout=timeout) as resp:
-            raw = resp.read().decode("utf-8", errors="ignore")
-    except urllib.error.HTTPError as e:
-        detail = e.read().decode("utf-8", errors="ignore") if hasattr(e, "read") else str(e)
-        raise RuntimeError(f"角色 {role['code']} 模型请求失败: HTTP {getattr(e, 'code', '?')} {detail[:200]}")
-    except Exception as e:
-        raise RuntimeError(f"角色 {role['code']} 模型请求异常: {e}")
 
-    try:
-        data = json.loads(raw)
-    except Exception:
-        raise RuntimeError(f"角色 {role['code']} 返回非JSON: {raw[:200]}")
+def _normalize_cache_messages(messages) -> list:
+    out = []
+    for m in messages or []:
+        content = str((m or {}).get("content") or "").replace("\r\n", "\n")
+        content = "\n".join(ln.rstrip() for ln in content.strip().split("\n"))
+        out.append([str((m or {}).get("role") or "").strip().lower(), content])
+    return out
 
-    text = _extract_content_from_chat_response(data)
-    if not text:
-        raise RuntimeError(f"角色 {role['code']} 返回空内容")
-    return text
 
+def build_llm_cache_key(api_base: str, payload: dict) -> str:
+    messages_hash = hashlib.sha256(
+        json.dumps(_normalize_cache_messages(payload.get("messages")), ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+    key_src = {
+        "api_base": (api_base or "").rstrip("/"),
+        "model": payload.get("model"),
+        "temperature": payload.get("temperature"),
+        "max_tokens": payload.get("max_tokens"),
+        "reasoning": payload.get("thinking"),
+        "messages": messages_hash,
+    }
+    return hashlib.sha256(json.dumps(key_src, sort_keys=True).encode("utf-8")).hexdigest()
 
-def is_verifier_stage(stage: str, role_code: str) -> bool:
-    s = (stage or "")
-    r = (role_code or "")
-    return r in ("reviewer", "@verifier") or any(k in s for k in ["验证", "复核", "验收", "review"])
 
+def llm_cache_get(cache_key: str):
+    with llm_cache_conn() as conn:
+        row = conn.execute(
+            "SELECT response, latency_ms FROM llm_response_cache WHERE cache_key=?", (cache_key,)
+        ).fetchone()
+        if row:
+            conn.execute(
+                "UPDATE llm_response_cache SET hit_count=hit_count+1, last_used_at=? WHERE cache_key=?",
+                (time.time(), cache_key),
+            )
+    return row
 
-def parse_verifier_feedback(text: str) -> dict:
-    raw = (text or "").strip()
-    out = {
-        "decision": "UNKNOWN",
-        "reason": "",
-        "issues": [],
-        "send_back_role": "",
-        "rework_instructions": "",
-    }
-    if not raw:
-        return out
 
-    # 优先解析 JSON
-    m = re.search(r"\{[\s\S]*\}", raw)
-    if m:
+def llm_cache_put(cache_key: str, api_base: str, model: str, response: str, latency_ms: int):
+    size = len(response.encode("utf-8"))
+    max_bytes = LLM_CACHE_MAX_MB * 1024 * 1024
+    with llm_cache_conn() as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO llm_response_cache(cache_key, api_base, model, response, size_bytes, latency_ms, hit_count, created_at, last_used_at)
+            VALUES(?,?,?,?,?,?,0,?,?)
+            """,
+            (cache_key, api_base, model, response, size, int(latency_ms), now_str(), time.time()),
+        )
+        total = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) s FROM llm_response_cache").fetchone()["s"]
+        if total <= max_bytes:
+            return
+        # LRU 淘汰：按最近使用时间从旧到新删除，直到回落到上限的 90%
+        target = int(max_bytes * 0.9)
+        for row in conn.execute("SELECT cache_key, size_bytes FROM llm_response_cache ORDER BY last_used_at ASC").fetchall():
+            if total <= target:
+                break
+            conn.execute("DELETE FROM llm_response_cache WHERE cache_key=?", (row["cache_key"],))
+            total -= int(row["size_bytes"] or 0)
+
+
+def record_llm_call(task_id: int, record: dict):
+    if not task_id:
+        return
+    record.setdefault("round", llm_round_ctx.get())
+    task_llm_calls.setdefault(task_id, []).append(record)
+    try:
+        with db_conn() as conn:
+            conn.execute(
+                """
+                INSERT INTO llm_usage(
+                    task_id, run_id, stage, role_code, round, model, prompt_tokens, completion_tokens, reasoning_tokens,
+                    latency_ms, ttfb_ms, request_bytes, response_bytes, cached, failed, created_at
+                ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                """,
+                (
+                    task_id,
+                    task_run_context.get(task_id) or "",
+                    record.get("stage") or "",
+                    record.get("role") or "",
+                    int(record.get("round") or 0),
+                    record.get("model") or "",
+                    int(record.get("promptTokens") or 0),
+                    int(record.get("completionTokens") or 0),
+                    int(record.get("reasoningTokens") or 0),
+                    int(record.get("latencyMs") or 0),
+                    int(record.get("ttfbMs") or 0),
+                    int(record.get("requestBytes") or 0),
+                    int(record.get("responseBytes") or 0),
+                    1 if record.get("cache") == "hit" else 0,
+                    1 if record.get("failed") else 0,
+                    now_str(),
+                ),
+            )
+    except Exception:
+        pass
+
+
+def summarize_llm_usage(records) -> dict:
+    billed = [r for r in records or [] if r.get("cache") != "hit"]
+    prompt = sum(int(r.get("promptTokens") or 0) for r in billed)
+    completion = sum(int(r.get("completionTokens") or 0) for r in billed)
+    return {
+        "calls": len(records or []),
+        "promptTokens": prompt,
+        "completionTokens": completion,
+        "reasoningTokens": sum(int(r.get("reasoningTokens") or 0) for r in billed),
+        "totalTokens": prompt + completion,
+        "latencyMs": sum(int(r.get("latencyMs") or 0) for r in records or []),
+        "requestBytes": sum(int(r.get("requestBytes") or 0) for r in billed),
+        "responseBytes": sum(int(r.get("responseBytes") or 0) for r in billed),
+    }
+
+
+def task_token_budget(task, wf=None) -> int:
+    raw = task["token_budget"] if "token_budget" in task.keys() else None
+    if not raw and wf is not None and "token_budget" in wf.keys():
+        raw = wf["token_budget"]
+    try:
+        return max(0, int(raw or TASK_TOKEN_BUDGET))
+    except Exception:
+        return TASK_TOKEN_BUDGET
+
+
+def check_token_budget(task_id: int, budget: int) -> tuple[str, int]:
+    """返回 (ok|degrade|exceeded, 已用token)。达到 ATC_TOKEN_BUDGET_DEGRADE_RATIO 时降级，超过预算时终止。
+    断点恢复的运行计入此前各次运行已用的 token（task_token_carry）。"""
+    used = task_token_carry.get(task_id, 0) + summarize_llm_usage(task_llm_calls.get(task_id))["totalTokens"]
+    if budget <= 0:
+        return "ok", used
+    if used >= budget:
+        return "exceeded", used
+    if used >= budget * TOKEN_BUDGET_DEGRADE_RATIO:
+        return "degrade", used
+    return "ok", used
+
+
+def discard_llm_calls(task_id: int, round_no: int) -> dict:
+    """撤销某一执行轮次（被回滚的推测阶段）的模型调用记录：从内存列表与 llm_usage 中删除，
+    其计费 token 计入 task_token_carry，预算仍按实际花费计算。"""
+    calls = task_llm_calls.get(task_id) or []
+    dropped = [r for r in calls if r.get("round") == round_no]
+    calls[:] = [r for r in calls if r.get("round") != round_no]
+    tokens = summarize_llm_usage(dropped)["totalTokens"]
+    task_token_carry[task_id] = task_token_carry.get(task_id, 0) + tokens
+    with db_conn() as conn:
+        conn.execute(
+            "DELETE FROM llm_usage WHERE task_id=? AND run_id=? AND round=?",
+            (task_id, task_run_context.get(task_id) or "", round_no),
+        )
+    return {"calls": len(dropped), "tokens": tokens}
+
+
+class DeadlineExceeded(RuntimeError):
+    pass
+
+
+def workflow_tool_limits(wf) -> dict:
+    """工作流 tool_limits（如 `cpu=120,mem=2048,pids=256,wall=600`），覆盖 ATC_TOOL_* 默认限制。"""
+    if wf is None or "tool_limits" not in wf.keys():
+        return {}
+    return proc_limits.parse_limits(wf["tool_limits"])
+
+
+def load_task_resources(task_id: int) -> dict:
+    with db_conn() as conn:
+        row = conn.execute("SELECT resource_json FROM tasks WHERE id=?", (task_id,)).fetchone()
+    return json.loads(row["resource_json"] or "{}") if row else {}
+
+
+def task_deadline_sec(task, wf=None) -> int:
+    raw = task["deadline_sec"] if "deadline_sec" in task.keys() else None
+    if not raw and wf is not None and "deadline_sec" in wf.keys():
+        raw = wf["deadline_sec"]
+    try:
+        return max(0, int(raw or TASK_DEADLINE_SEC))
+    except Exception:
+        return TASK_DEADLINE_SEC
+
+
+def load_fingerprint_roles() -> list:
+    with db_conn() as conn:
+        rows = conn.execute(
+            "SELECT code, enabled, default_model, fallback_models, system_prompt, temperature, max_tokens FROM roles ORDER BY code"
+        ).fetchall()
+    return [list(r) for r in rows]
+
+
+def compute_task_fingerprint(workflow_code: str, command: str, description: str, wf, roles: list, attachments: list) -> str:
+    """attachments 为 [[文件名, sha256], ...]，与 blob 哈希同为内容 sha256。"""
+    raw = json.dumps(
+        {
+            "workflow": (workflow_code or "").strip(),
+            "stages": wf["stages_json"] if wf else "",
+            "stageRoles": wf["stage_roles_json"] if wf else "",
+            "roles": roles,
+            "command": re.sub(r"\s+", " ", command or "").strip(),
+            "description": re.sub(r"\s+", " ", description or "").strip(),
+            "attachments": sorted(attachments),
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def task_fingerprint(task) -> str:
+    """任务指纹：工作流阶段与角色分配、各角色模型配置、命令、规整后的任务描述、附件内容哈希。"""
+    _, input_dir, _ = task_artifact_dirs(task["id"])
+    attachments = []
+    for name in sorted(os.listdir(input_dir)):
+        full = os.path.join(input_dir, name)
+        if os.path.isfile(full):
+            st = os.stat(full)
+            attachments.append([name, _file_digest(full, st.st_size, st.st_mtime_ns)])
+    wf = get_workflow_by_code((task["workflow_code"] or "").strip())
+    return compute_task_fingerprint(task["workflow_code"], task["command"], task["description"], wf, load_fingerprint_roles(), attachments)
+
+
+def refresh_task_fingerprint(task_id: int) -> str:
+    task = get_task(task_id)
+    fp = task_fingerprint(task) if task else ""
+    if fp:
+        update_task(task_id, fingerprint=fp)
+    return fp
+
+
+def task_reuse_ttl(task) -> int:
+    """工作流 reuse_ttl_sec 覆盖 ATC_TASK_REUSE_TTL_SEC；0 表示该工作流不复用。"""
+    wf = get_workflow_by_code((task["workflow_code"] or "").strip())
+    raw = wf["reuse_ttl_sec"] if wf is not None and "reuse_ttl_sec" in wf.keys() else None
+    try:
+        return max(0, int(TASK_REUSE_TTL_SEC if raw is None else raw))
+    except Exception:
+        return TASK_REUSE_TTL_SEC
+
+
+def find_reusable_task(task):
+    """同指纹、时效内成功完成且产物仍在的最近一次原始运行（本身复用来的任务不作为来源）。"""
+    fp = task["fingerprint"] if "fingerprint" in task.keys() else ""
+    ttl = task_reuse_ttl(task)
+    if TASK_REUSE == "off" or not fp or not ttl:
+        return None
+    with db_conn() as conn:
+        rows = conn.execute(
+            """
+            SELECT id, title, finished_at FROM tasks
+            WHERE fingerprint=? AND id<>? AND status='done' AND return_code=0 AND reused_from IS NULL
+            ORDER BY id DESC LIMIT 10
+            """,
+            (fp, task["id"]),
+        ).fetchall()
+    for r in rows:
+        try:
+            age = (datetime.utcnow() - datetime.strptime(r["finished_at"], "%Y-%m-%d %H:%M:%S UTC")).total_seconds()
+        except Exception:
+            continue
+        out_dir = os.path.join(ARTIFACT_ROOT, f"task_{r['id']}", "output")
+        if age <= ttl and os.path.isdir(out_dir) and os.listdir(out_dir):
+            return {"id": r["id"], "title": r["title"], "finishedAt": r["finished_at"], "ageSec": int(age), "ttlSec": ttl}
+    return None
+
+
+def link_tree(src: str, dst: str) -> int:
+    """把 src 下的文件硬链接到 dst（跨文件系统时复制）；两边文件各自删除/重写互不影响。"""
+    n = 0
+    for base, _, names in os.walk(src):
+        target = os.path.normpath(os.path.join(dst, os.path.relpath(base, src)))
+        os.makedirs(target, exist_ok=True)
+        for name in names:
+            try:
+                os.link(os.path.join(base, name), os.path.join(target, name))
+            except OSError:
+                shutil.copy2(os.path.join(base, name), os.path.join(target, name))
+            n += 1
+    return n
+
+
+def apply_task_reuse(task_id: int, source: dict) -> int:
+    """把来源任务的产物链接到本任务输出目录并直接标记完成，不调用模型。"""
+    base_dir, _, output_dir = task_artifact_dirs(task_id)
+    clear_dir_contents(output_dir)
+    clear_dir_contents(os.path.join(base_dir, "tool_runs"))
+    clear_checkpoint(task_id)
+    clear_role_session_messages(task_id)
+    files = link_tree(os.path.join(ARTIFACT_ROOT, f"task_{source['id']}", "output"), output_dir)
+    now = now_str()
+    update_task(task_id, status="done", started_at=now, finished_at=now, return_code=0, reused_from=source["id"], resource_json=None)
+    append_log(
+        task_id,
+        f"[SYSTEM] 复用任务 #{source['id']} 的结果（指纹相同，{source['ageSec']}s 前完成，时效 {source['ttlSec']}s）："
+        f"已链接 {files} 个产物文件，未调用模型",
+    )
+    return files
+
+
+def try_auto_reuse(task_id: int, task) -> bool:
+    """ATC_TASK_REUSE=auto 时在排队前检查；启动时重算指纹，创建后角色模型或附件变化都会使复用失效。"""
+    if TASK_REUSE != "auto" or ("reuse_disabled" in task.keys() and task["reuse_disabled"]):
+        return False
+    refresh_task_fingerprint(task_id)
+    source = find_reusable_task(get_task(task_id))
+    if not source:
+        return False
+    apply_task_reuse(task_id, source)
+    return True
+
+
+def deadline_remaining(task_id: int):
+    """本次运行距截止时间的剩余秒数；未设置截止时间时返回 None。"""
+    entry = task_deadlines.get(task_id)
+    if not entry:
+        return None
+    started, limit = entry
+    return limit - (time.perf_counter() - started)
+
+
+def clamp_to_deadline(task_id: int, timeout: float) -> float:
+    """单次模型/工具调用的超时取 min(默认值, 剩余时间)；已过截止时间时抛出 DeadlineExceeded。"""
+    remaining = deadline_remaining(task_id)
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceeded(f"任务已到截止时间（{task_deadlines[task_id][1]}s）")
+    return min(timeout, remaining)
+
+
+def check_deadline(task_id: int) -> tuple[str, float]:
+    """返回 (ok|degrade|exceeded, 已用秒数)。达到 ATC_DEADLINE_DEGRADE_RATIO 时降级，超过截止时间时收尾。"""
+    entry = task_deadlines.get(task_id)
+    if not entry:
+        return "ok", 0.0
+    started, limit = entry
+    elapsed = time.perf_counter() - started
+    if elapsed >= limit:
+        return "exceeded", elapsed
+    if elapsed >= limit * DEADLINE_DEGRADE_RATIO:
+        return "degrade", elapsed
+    return "ok", elapsed
+
+
+def summarize_llm_cache(records) -> dict:
+    calls = [r for r in records or [] if r.get("cache") in ("hit", "miss")]
+    hits = [r for r in calls if r.get("cache") == "hit"]
+    return {
+        "mode": llm_cache_mode(),
+        "calls": len(calls),
+        "hits": len(hits),
+        "hitRate": round(len(hits) / len(calls), 3) if calls else 0.0,
+        "savedLatencyMs": sum(int(r.get("savedMs") or 0) for r in hits),
+    }
+
+
+class LLMRequestError(RuntimeError):
+    def __init__(self, message: str, status: int = 0, retryable: bool = False, retry_after=None, kind: str = "error"):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.kind = kind
+
+
+def parse_retry_after(value):
+    raw = (value or "").strip()
+    if not raw:
+        return None
+    try:
+        return max(0.0, float(raw))
+    except Exception:
+        pass
+    try:
+        dt = parsedate_to_datetime(raw)
+        return max(0.0, dt.timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def parse_fallback_endpoints(raw: str) -> list:
+    text = (raw or "").strip()
+    if not text:
+        return []
+    try:
+        data = json.loads(text)
+    except Exception:
+        data = [x.strip() for x in re.split(r"[,，\n]+", text) if x.strip()]
+    out = []
+    for item in data if isinstance(data, list) else []:
+        if isinstance(item, dict):
+            model = str(item.get("model") or "").strip()
+            if model:
+                out.append({"model": model, "api_base": str(item.get("api_base") or "").strip(), "api_key": str(item.get("api_key") or "").strip()})
+        elif str(item).strip():
+            # 简写：model 或 model@api_base
+            model, _, base = str(item).strip().partition("@")
+            out.append({"model": model.strip(), "api_base": base.strip(), "api_key": ""})
+    return out
+
+
+def resolve_role_endpoints(role) -> list:
+    keys = role.keys()
+    api_base = (role["api_base"] or ROLE_DEFAULT_API_BASE or "").strip()
+    api_key = (role["api_key"] or ROLE_DEFAULT_API_KEY or "").strip()
+    endpoints = [{"model": (role["default_model"] or "").strip(), "api_base": api_base, "api_key": api_key}]
+    raw = role["fallback_models"] if "fallback_models" in keys else ""
+    for fb in parse_fallback_endpoints(raw):
+        ep = {
+            "model": fb["model"],
+            "api_base": fb["api_base"] or api_base,
+            "api_key": fb["api_key"] or api_key,
+        }
+        if ep not in endpoints:
+            endpoints.append(ep)
+    return endpoints
+
+
+def role_retry_max(role) -> int:
+    raw = role["retry_max"] if "retry_max" in role.keys() else None
+    try:
+        return max(0, min(8, int(raw))) if raw is not None else ROLE_RETRY_MAX
+    except Exception:
+        return ROLE_RETRY_MAX
+
+
+def build_chat_payload(role, model: str, messages) -> dict:
+    payload = {
+        "model": model,
+        "messages": messages,
+        "temperature": float(role["temperature"] if role["temperature"] is not None else 0.3),
+        "max_tokens": int(role["max_tokens"] if role["max_tokens"] is not None else 1200),
+    }
+
+    # GPT/Codex 角色默认开启深度思考参数（MiniMax等模型不注入）
+    ml = model.lower()
+    if ml.startswith("gpt-") or ("codex" in ml):
+        effort = ROLE_REASONING_EFFORT if ROLE_REASONING_EFFORT in ("low", "medium", "high") else "high"
+        payload["reasoning"] = {"effort": effort}
+        payload["thinking"] = effort
+    return payload
+
+
+def chat_completions_url(api_base: str) -> str:
+    base = api_base.rstrip("/")
+    return (base + "/chat/completions") if base.endswith("/v1") else (base + "/v1/chat/completions")
+
+
+def llm_ssl_context():
+    global _llm_ssl_context
+    if _llm_ssl_context is None:
+        _llm_ssl_context = ssl.create_default_context()
+    return _llm_ssl_context
+
+
+def llm_uses_proxy(url: str) -> bool:
+    global _llm_proxies
+    if _llm_proxies is None:
+        _llm_proxies = urllib.request.getproxies()
+    parts = urllib.parse.urlsplit(url)
+    proxies = _llm_proxies
+    return bool(proxies.get(parts.scheme)) and not urllib.request.proxy_bypass(parts.hostname or "")
+
+
+async def http_post_async(url: str, headers: dict, body: bytes, timeout: float):
+    """最小 HTTP/1.1 POST 客户端（asyncio 原生，不占线程），返回 (status, headers, body, ttfb_ms)。"""
+    parts = urllib.parse.urlsplit(url)
+    https = parts.scheme == "https"
+    path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+    t0 = time.perf_counter()
+
+    async def _do():
+        reader, writer = await asyncio.open_connection(
+            parts.hostname,
+            parts.port or (443 if https else 80),
+            ssl=llm_ssl_context() if https else None,
+            limit=1 << 20,
+        )
+        try:
+            head = [f"POST {path} HTTP/1.1", f"Host: {parts.netloc}", "Connection: close", "Accept-Encoding: identity", f"Content-Length: {len(body)}"]
+            head.extend(f"{k}: {v}" for k, v in headers.items())
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("utf-8") + body)
+            await writer.drain()
+
+            status_line = await reader.readline()
+            ttfb_ms = int((time.perf_counter() - t0) * 1000)
+            try:
+                status = int(status_line.split()[1])
+            except Exception:
+                raise ConnectionError(f"无效的 HTTP 响应行: {status_line[:80]!r}")
+            resp_headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                k, _, v = line.decode("latin-1").partition(":")
+                resp_headers[k.strip().lower()] = v.strip()
+
+            if "chunked" in resp_headers.get("transfer-encoding", "").lower():
+                chunks = []
+                while True:
+                    size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+                    if size == 0:
+                        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                            pass
+                        break
+                    chunks.append(await reader.readexactly(size))
+                    await reader.readline()
+                data = b"".join(chunks)
+            elif "content-length" in resp_headers:
+                data = await reader.readexactly(int(resp_headers["content-length"]))
+            else:
+                data = await reader.read()
+            return status, resp_headers, data, ttfb_ms
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    return await asyncio.wait_for(_do(), timeout=timeout)
+
+
+def http_post_blocking(url: str, headers: dict, body: bytes, timeout: float):
+    """走 urllib（支持系统代理），返回值同 http_post_async。"""
+    req = urllib.request.Request(url, data=body, method="POST", headers=headers)
+    t0 = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            ttfb_ms = int((time.perf_counter() - t0) * 1000)
+            return resp.status, {k.lower(): v for k, v in resp.headers.items()}, resp.read(), ttfb_ms
+    except urllib.error.HTTPError as e:
+        data = e.read() if hasattr(e, "read") else str(e).encode("utf-8")
+        hdrs = {k.lower(): v for k, v in e.headers.items()} if e.headers else {}
+        return int(getattr(e, "code", 0) or 0), hdrs, data, int((time.perf_counter() - t0) * 1000)
+
+
+async def post_chat_completion(role_code: str, endpoint: dict, payload: dict, timeout: float) -> dict:
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    url = chat_completions_url(endpoint["api_base"])
+    headers = {
+        "Authorization": f"Bearer {endpoint['api_key']}",
+        "Content-Type": "application/json",
+    }
+    try:
+        if llm_uses_proxy(url):
+            status, resp_headers, raw_bytes, ttfb_ms = await asyncio.to_thread(http_post_blocking, url, headers, body, timeout)
+        else:
+            status, resp_headers, raw_bytes, ttfb_ms = await http_post_async(url, headers, body, timeout)
+    except (asyncio.TimeoutError, socket.timeout, TimeoutError) as e:
+        raise LLMRequestError(f"角色 {role_code} 模型请求异常: 超时 {e}", retryable=True, kind="timeout")
+    except urllib.error.URLError as e:
+        kind = "timeout" if isinstance(e.reason, (socket.timeout, TimeoutError)) else "network"
+        raise LLMRequestError(f"角色 {role_code} 模型请求异常: {e}", retryable=True, kind=kind)
+    except Exception as e:
+        raise LLMRequestError(f"角色 {role_code} 模型请求异常: {e}", retryable=True, kind="network")
+
+    raw = raw_bytes.decode("utf-8", errors="ignore")
+    if status >= 400:
+        raise LLMRequestError(
+            f"角色 {role_code} 模型请求失败: HTTP {status or '?'} {raw[:200]}",
+            status=status,
+            retryable=(status == 429 or status >= 500),
+            retry_after=parse_retry_after(resp_headers.get("retry-after")),
+            kind=f"http_{status}",
+        )
+
+    try:
+        data = json.loads(raw)
+    except Exception:
+        raise LLMRequestError(f"角色 {role_code} 返回非JSON: {raw[:200]}", retryable=True, kind="bad_json")
+    if not _extract_content_from_chat_response(data):
+        raise LLMRequestError(f"角色 {role_code} 返回空内容", retryable=True, kind="empty")
+    return {
+        "raw": raw,
+        "usage": extract_llm_usage(data),
+        "ttfbMs": ttfb_ms,
+        "requestBytes": len(body),
+        "responseBytes": len(raw_bytes),
+    }
+
+
+def extract_llm_usage(data: dict) -> dict:
+    u = (data or {}).get("usage") or {}
+    details = u.get("completion_tokens_details") or u.get("output_tokens_details") or {}
+    try:
+        return {
+            "promptTokens": int(u.get("prompt_tokens") or u.get("input_tokens") or 0),
+            "completionTokens": int(u.get("completion_tokens") or u.get("output_tokens") or 0),
+            "reasoningTokens": int(details.get("reasoning_tokens") or u.get("reasoning_tokens") or 0),
+        }
+    except Exception:
+        return {"promptTokens": 0, "completionTokens": 0, "reasoningTokens": 0}
+
+
+def llm_backoff_delay(attempt: int, retry_after=None) -> float:
+    # full jitter 指数退避；服务端给了 Retry-After 时以其为下限
+    cap = min(ROLE_RETRY_MAX_DELAY, ROLE_RETRY_BASE_DELAY * (2 ** max(0, attempt - 1)))
+    delay = random.uniform(0, cap)
+    if retry_after is not None:
+        delay = max(delay, min(float(retry_after), ROLE_RETRY_MAX_DELAY))
+    return delay
+
+
+def _endpoint_label(endpoint: dict) -> str:
+    host = urllib.parse.urlsplit(endpoint.get("api_base") or "").netloc or endpoint.get("api_base") or "-"
+    return f"{endpoint.get('model')}@{host}"
+
+
+def record_llm_latency(endpoint: dict, latency_ms: int):
+    key = (endpoint.get("api_base") or "", endpoint.get("model") or "")
+    with llm_latency_lock:
+        llm_latency_samples.setdefault(key, deque(maxlen=200)).append(latency_ms)
+
+
+def llm_hedge_threshold_sec(endpoint: dict):
+    key = (endpoint.get("api_base") or "", endpoint.get("model") or "")
+    with llm_latency_lock:
+        samples = sorted(llm_latency_samples.get(key) or [])
+    if len(samples) < ROLE_HEDGE_MIN_SAMPLES:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * 0.95))] / 1000.0
+
+
+def role_hedge_enabled(role) -> bool:
+    raw = role["hedge_enabled"] if "hedge_enabled" in role.keys() else None
+    if raw is None:
+        return ROLE_HEDGE_ENABLED
+    return int(raw or 0) == 1
+
+
+async def _timed_post(role_code: str, endpoint: dict, payload: dict, timeout: float):
+    t0 = time.perf_counter()
+    resp = await post_chat_completion(role_code, endpoint, payload, timeout)
+    return endpoint, resp, int((time.perf_counter() - t0) * 1000)
+
+
+async def _post_with_hedge(role, endpoint: dict, hedge_endpoint: dict, messages, timeout: float, attempts: list):
+    """主请求超过该端点 p95 延迟仍未返回时，补发一个对冲请求，取先成功者。"""
+    payload = build_chat_payload(role, endpoint["model"], messages)
+    threshold = llm_hedge_threshold_sec(endpoint) if role_hedge_enabled(role) else None
+    if threshold is None:
+        return await _timed_post(role["code"], endpoint, payload, timeout)
+
+    primary = asyncio.ensure_future(_timed_post(role["code"], endpoint, payload, timeout))
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=threshold)
+    except BaseException:
+        primary.cancel()
+        raise
+    if done:
+        return primary.result()
+
+    hedge_payload = build_chat_payload(role, hedge_endpoint["model"], messages)
+    hedge = asyncio.ensure_future(_timed_post(role["code"], hedge_endpoint, hedge_payload, timeout))
+    attempts.append({"endpoint": _endpoint_label(hedge_endpoint), "status": "hedge_started", "afterMs": int(threshold * 1000)})
+    pending = {primary, hedge}
+    last_err = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                try:
+                    result = fut.result()
+                except LLMRequestError as e:
+                    last_err = e
+                    continue
+                if fut is hedge:
+                    attempts.append({"endpoint": _endpoint_label(hedge_endpoint), "status": "hedge_won"})
+                return result
+    finally:
+        for fut in pending:
+            fut.cancel()
+    raise last_err
+
+
+def attach_stage_llm_audit(stage_audit: dict, task_id: int, mark: int):
+    # 并行分支的调用会交错写入，按执行序号（round）筛出本阶段的调用
+    round_no = stage_audit.get("executionNo")
+    records = [r for r in (task_llm_calls.get(task_id) or [])[mark:] if not round_no or r.get("round") == round_no]
+    stage_audit["llmCalls"] = records
+    stage_audit["usage"] = summarize_llm_usage(records)
+    if llm_cache_mode() != "off":
+        stage_audit["llmCache"] = summarize_llm_cache(records)
+
+
+async def call_role_llm(role, messages, task_id: int = 0, stage: str = ""):
+    endpoints = resolve_role_endpoints(role)
+    primary = endpoints[0]
+
+    if not primary["api_base"]:
+        raise RuntimeError(f"角色 {role['code']} 未配置 api_base")
+    if not primary["api_key"]:
+        raise RuntimeError(f"角色 {role['code']} 未配置 api_key")
+    if not primary["model"]:
+        raise RuntimeError(f"角色 {role['code']} 未配置模型")
+
+    primary_payload = build_chat_payload(role, primary["model"], messages)
+    record = {"stage": stage, "role": role["code"], "model": primary["model"], "cache": "off", "attempts": []}
+
+    cache_mode = llm_cache_mode()
+    cache_key = ""
+    if cache_mode != "off":
+        cache_key = build_llm_cache_key(primary["api_base"].rstrip("/"), primary_payload)
+        lookup_t0 = time.perf_counter()
+        cached = llm_cache_get(cache_key)
+        if cached:
+            lookup_ms = int((time.perf_counter() - lookup_t0) * 1000)
+            try:
+                cached_data = json.loads(cached["response"])
+                text = _extract_content_from_chat_response(cached_data)
+            except Exception:
+                cached_data, text = {}, ""
+            if text:
+                record.update(extract_llm_usage(cached_data))
+                record.update({"cache": "hit", "latencyMs": lookup_ms, "savedMs": max(0, int(cached["latency_ms"] or 0) - lookup_ms)})
+                await db_write(record_llm_call, task_id, record)
+                return text
+        if cache_mode == "replay":
+            raise RuntimeError(f"角色 {role['code']} 回放模式缓存未命中（key={cache_key[:12]}）")
+        record["cache"] = "miss"
+
+    base_timeout = max(30, ROLE_DEFAULT_TIMEOUT)
+    retry_max = role_retry_max(role)
+    last_err = None
+    call_t0 = time.perf_counter()
+    for ep_idx, endpoint in enumerate(endpoints):
+        if not (endpoint["api_base"] and endpoint["api_key"] and endpoint["model"]):
+            continue
+        hedge_endpoint = endpoints[ep_idx + 1] if ep_idx + 1 < len(endpoints) else endpoint
+        for attempt in range(1, retry_max + 2):
+            if task_id:
+                ensure_not_stopped(task_id)
+            att = {"endpoint": _endpoint_label(endpoint), "attempt": attempt}
+            timeout = clamp_to_deadline(task_id, base_timeout)
+            if timeout < base_timeout:
+                att["timeoutSec"] = round(timeout, 1)
+            att_t0 = time.perf_counter()
+            try:
+                used_endpoint, resp, latency_ms = await _post_with_hedge(role, endpoint, hedge_endpoint, messages, timeout, record["attempts"])
+            except LLMRequestError as e:
+                last_err = e
+                att.update({"status": e.kind, "latencyMs": int((time.perf_counter() - att_t0) * 1000)})
+                if e.retryable and attempt <= retry_max:
+                    delay = llm_backoff_delay(attempt, e.retry_after)
+                    att["backoffMs"] = int(delay * 1000)
+                    record["attempts"].append(att)
+                    await asyncio.sleep(clamp_to_deadline(task_id, delay))
+                    continue
+                record["attempts"].append(att)
+                break
+
+            att.update({"endpoint": _endpoint_label(used_endpoint), "status": "ok", "latencyMs": latency_ms})
+            record["attempts"].append(att)
+            record_llm_latency(used_endpoint, latency_ms)
+            record["model"] = used_endpoint["model"]
+            record["latencyMs"] = int((time.perf_counter() - call_t0) * 1000)
+            record.update(resp["usage"])
+            record.update({"ttfbMs": resp["ttfbMs"], "requestBytes": resp["requestBytes"], "responseBytes": resp["responseBytes"]})
+            if used_endpoint is not primary:
+                record["fallbackUsed"] = _endpoint_label(used_endpoint)
+            await db_write(record_llm_call, task_id, record)
+            if cache_mode == "rw":
+                try:
+                    llm_cache_put(cache_key, primary["api_base"].rstrip("/"), primary["model"], resp["raw"], latency_ms)
+                except Exception:
+                    pass
+            return _extract_content_from_chat_response(json.loads(resp["raw"]))
+
+        if task_id and len(endpoints) > ep_idx + 1:
+            await db_write(append_log, task_id, f"[{role['code']}] 模型端点 {_endpoint_label(endpoint)} 不可用，切换回退端点：{_endpoint_label(endpoints[ep_idx + 1])}")
+
+    record["failed"] = True
+    record["latencyMs"] = int((time.perf_counter() - call_t0) * 1000)
+    await db_write(record_llm_call, task_id, record)
+    # 超时被截止时间收紧后失败：按截止处理，由工作流尽力交付而不是判为模型故障
+    clamp_to_deadline(task_id, base_timeout)
+    tries = len([a for a in record["attempts"] if a.get("attempt")])
+    raise RuntimeError(f"{last_err or '角色 ' + role['code'] + ' 模型请求失败'}（已尝试{tries}次，端点{len(endpoints)}个）")
+
+
+def is_verifier_stage(stage: str, role_code: str) -> bool:
+    s = (stage or "")
+    r = (role_code or "")
+    return r in ("reviewer", "@verifier") or any(k in s for k in ["验证", "复核", "验收", "review"])
+
+
+def parse_verifier_feedback(text: str) -> dict:
+    raw = (text or "").strip()
+    out = {
+        "decision": "UNKNOWN",
+        "reason": "",
+        "issues": [],
+        "send_back_role": "",
+        "rework_instructions": "",
+    }
+    if not raw:
+        return out
+
+    # 优先解析 JSON
+    m = re.search(r"\{[\s\S]*\}", raw)
+    if m:
         try:
             data = json.loads(m.group(0))
             dec = str(data.get("decision", "")).strip().upper()
@@ -1192,108 +2716,1076 @@ def parse_role_action(text: str) -> dict:
     except Exception:
         return out
 
-    action = str(data.get("action") or "").strip().lower()
-    if action == "run_command":
-        out["action"] = "run_command"
-        out["command"] = str(data.get("command") or data.get("cmd") or "").strip()
-        out["reason"] = str(data.get("reason") or "").strip()
-        return out
+    action = str(data.get("action") or "").strip().lower()
+    if action == "run_command":
+        out["action"] = "run_command"
+        out["command"] = str(data.get("command") or data.get("cmd") or "").strip()
+        out["reason"] = str(data.get("reason") or "").strip()
+        out["refresh"] = str(data.get("refresh") or "").strip().lower() in ("1", "true", "yes", "on")
+        try:
+            out["ttl"] = max(0, int(data["ttl"])) if data.get("ttl") is not None else None
+        except Exception:
+            out["ttl"] = None
+        return out
+
+    if action == "run_commands":
+        out["action"] = "run_commands"
+        out["reason"] = str(data.get("reason") or "").strip()
+        out["commands"] = parse_batch_commands(data.get("commands") or [])
+        return out
+
+    if action == "read_tool_output":
+        out["action"] = "read_tool_output"
+        out["handle"] = str(data.get("handle") or "").strip()
+        out["pattern"] = str(data.get("pattern") or data.get("grep") or "").strip()
+        try:
+            out["offset"] = max(0, int(data.get("offset") or 0))
+            out["limit"] = max(200, min(TOOL_READ_MAX_CHARS, int(data.get("limit") or TOOL_READ_MAX_CHARS)))
+        except Exception:
+            out["offset"], out["limit"] = 0, TOOL_READ_MAX_CHARS
+        return out
+
+    if action == "final":
+        out["action"] = "final"
+        out["content"] = str(data.get("content") or raw).strip()
+        return out
+
+    return out
+
+
+def batch_command_id(raw, default: str) -> str:
+    return re.sub(r"[^\w-]+", "_", str(raw or default))[:24] or default
+
+
+def parse_batch_commands(raw) -> list:
+    """run_commands 的命令列表：元素可为字符串或 {"id","command","after","refresh","ttl"}；
+    依赖只能指向列表中更早的命令（保证无环），依赖 id 与命令 id 按同一规则规范化；
+    指向不存在或更靠后命令的依赖记入 badAfter，该命令不执行。超过 ATC_TOOL_BATCH_MAX 的部分丢弃。"""
+    items, seen = [], set()
+    for i, entry in enumerate((raw if isinstance(raw, list) else [])[:TOOL_BATCH_MAX]):
+        if not isinstance(entry, dict):
+            entry = {"command": entry}
+        cid = batch_command_id(entry.get("id"), f"c{i + 1}")
+        if cid in seen:
+            cid = f"{cid}_{i + 1}"
+        after = entry.get("after") or entry.get("depends_on") or []
+        after = [after] if isinstance(after, (str, int)) else after if isinstance(after, list) else []
+        after = [batch_command_id(d, "") for d in after]
+        try:
+            ttl = max(0, int(entry["ttl"])) if entry.get("ttl") is not None else None
+        except Exception:
+            ttl = None
+        items.append(
+            {
+                "id": cid,
+                "command": str(entry.get("command") or entry.get("cmd") or "").strip(),
+                "after": [d for d in after if d in seen],
+                "badAfter": [d for d in after if d not in seen],
+                "refresh": str(entry.get("refresh") or "").strip().lower() in ("1", "true", "yes", "on"),
+                "ttl": ttl,
+            }
+        )
+        seen.add(cid)
+    return items
+
+
+class FileManifest:
+    """输出目录的增量文件清单：name -> [size, mtime_ns, sha256]，sha256 按需计算。
+    目录自身 mtime 未变（且上次扫描晚于该 mtime）时不再 listdir，只 stat 已知文件；未变化的条目沿用已算出的哈希。
+    上次快照在 invalidate 之前原样复用（上一轮的 after 即下一轮的 before），运行中的任务由 touch_task_files 失效。"""
+
+    MTIME_SLACK_NS = 10_000_000
+
+    def __init__(self, root: str):
+        self.root = root
+        self.entries = {}
+        self.dir_mtime_ns = None
+        self.scanned_ns = 0
+        self.snapshot = None
+        self.stat_calls = 0
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        with self.lock:
+            self.snapshot = None
+
+    def _names(self):
+        try:
+            dir_mtime = os.stat(self.root).st_mtime_ns
+        except FileNotFoundError:
+            self.dir_mtime_ns = None
+            return None
+        if dir_mtime == self.dir_mtime_ns and self.scanned_ns > dir_mtime + self.MTIME_SLACK_NS:
+            return list(self.entries)
+        self.scanned_ns = time.time_ns()
+        self.dir_mtime_ns = dir_mtime
+        with os.scandir(self.root) as it:
+            return [e.name for e in it]
+
+    def refresh(self) -> dict:
+        """返回快照 {name: (size, mtime_ns, sha256 或 None)}；同尺寸仅 mtime 变化且旧哈希已知时补算新哈希，以区分“只是被重写”。"""
+        with self.lock:
+            if self.snapshot is not None:
+                return dict(self.snapshot)
+            names = self._names()
+            entries = {}
+            self.stat_calls += len(names or [])
+            for name in names or []:
+                full = os.path.join(self.root, name)
+                try:
+                    st = os.stat(full)
+                except FileNotFoundError:
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    continue
+                old = self.entries.get(name)
+                sha = None
+                if old and old[0] == st.st_size:
+                    if old[1] == st.st_mtime_ns:
+                        sha = old[2]
+                    elif old[2]:
+                        sha = _file_digest(full, st.st_size, st.st_mtime_ns)
+                entries[name] = [st.st_size, st.st_mtime_ns, sha]
+            self.entries = entries
+            self.snapshot = {k: tuple(v) for k, v in entries.items()}
+            return dict(self.snapshot)
+
+    def digest(self, name: str) -> str:
+        with self.lock:
+            entry = self.entries.get(name)
+            if not entry:
+                return ""
+            if not entry[2]:
+                entry[2] = _file_digest(os.path.join(self.root, name), entry[0], entry[1])
+                if self.snapshot is not None and name in self.snapshot:
+                    self.snapshot[name] = tuple(entry)
+            return entry[2]
+
+
+def task_file_manifest(task_id: int, output_dir: str) -> FileManifest:
+    """本次运行内按目录复用的清单；不在运行中的任务（如脚本直接调用）返回一次性清单。"""
+    manifests = task_file_manifests.get(task_id)
+    if manifests is None:
+        return FileManifest(output_dir)
+    if output_dir not in manifests:
+        manifests[output_dir] = FileManifest(output_dir)
+    return manifests[output_dir]
+
+
+def touch_task_files(task_id: int):
+    """任务的目录可能被改写后调用（工具命令执行完、写阶段文件、合并分支/推测产物），下次快照重新扫描。"""
+    for manifest in list((task_file_manifests.get(task_id) or {}).values()):
+        manifest.invalidate()
+
+
+def manifest_snapshot(task_id: int, dirs) -> dict:
+    """多个目录合并后的快照，同名文件以靠前目录为准。"""
+    out = {}
+    for d in reversed(list(dict.fromkeys(dirs))):
+        out.update(task_file_manifest(task_id, d).refresh())
+    return out
+
+
+def diff_file_manifests(before: dict, after: dict) -> dict:
+    """按 stat 比较两次快照；尺寸相同、仅 mtime 变化且两侧哈希都已知并相同的文件不算修改。"""
+    created, modified = [], []
+    for name, (size, mtime_ns, sha) in after.items():
+        old = before.get(name)
+        if old is None:
+            created.append(name)
+        elif old[0] != size or (old[1] != mtime_ns and not (old[2] and old[2] == sha)):
+            modified.append(name)
+    deleted = [name for name in before if name not in after]
+    return {"created": sorted(created), "modified": sorted(modified), "deleted": sorted(deleted)}
+
+
+def changed_files(changes: dict) -> list:
+    return sorted(changes["created"] + changes["modified"])
+
+
+def is_system_generated_output(name: str) -> bool:
+    n = (name or "").strip()
+    return n.startswith("步骤") or n in ("多Agent_最终交付.md", "多Agent_会话审计.json")
+
+
+def task_requires_real_artifacts(task_text: str) -> bool:
+    t = (task_text or "")
+    keys = ["爬取", "采集", "关键词", "文包", "报告", "导出", "csv", "json", "zip", "附件"]
+    return any(k in t for k in keys)
+
+
+def is_safe_role_command(command: str) -> tuple[bool, str]:
+    cmd = (command or "").strip()
+    if not cmd:
+        return False, "命令为空"
+    if len(cmd) > 800:
+        return False, "命令过长（>800）"
+    if "\n" in cmd or "\r" in cmd:
+        return False, "命令不能包含换行"
+
+    blocked = [
+        "rm -rf /",
+        "shutdown",
+        "reboot",
+        "mkfs",
+        "fdisk",
+        "poweroff",
+        ":(){",
+        "halt",
+        "systemctl stop",
+        "systemctl disable",
+    ]
+    lower = cmd.lower()
+    for b in blocked:
+        if b in lower:
+            return False, f"命中高危命令片段: {b}"
+    return True, "ok"
+
+
+def kill_process_group(proc):
+    # 工具命令在独立会话中运行，连同其派生的子进程一起结束
+    if proc.returncode is not None:
+        return
+    try:
+        os.killpg(os.getpgid(proc.pid), signal.SIGKILL)
+    except Exception:
+        proc.kill()
+
+
+def ensure_warm_runner() -> bool:
+    """按需拉起预热执行器；拉起失败后 60 秒内不再重试，期间工具命令走 bash。"""
+    with warm_runner_lock:
+        try:
+            warm_runner.connect(WARM_RUNNER_SOCKET, timeout=0.5).close()
+            return True
+        except OSError:
+            pass
+        if time.time() - warm_runner_state["failedAt"] < 60:
+            return False
+        proc = warm_runner_state["proc"]
+        if proc is None or proc.poll() is not None:
+            run_dir = os.path.dirname(os.path.abspath(WARM_RUNNER_SOCKET))
+            os.makedirs(run_dir, exist_ok=True)
+            with open(os.path.join(run_dir, "warm_runner.log"), "ab") as log_file:
+                warm_runner_state["proc"] = subprocess.Popen(
+                    [sys.executable, os.path.join(BASE_DIR, "warm_runner.py"), "--socket", WARM_RUNNER_SOCKET],
+                    cwd=WORKDIR,
+                    stdin=subprocess.DEVNULL,
+                    stdout=log_file,
+                    stderr=subprocess.STDOUT,
+                    start_new_session=True,
+                )
+        if warm_runner.wait_ready(WARM_RUNNER_SOCKET, 15):
+            return True
+        warm_runner_state["failedAt"] = time.time()
+        return False
+
+
+class ToolProcess:
+    """工具子进程句柄，提供与 asyncio.subprocess.Process 相同的 pid/stdout/wait/kill/terminate，
+    另在 wait() 返回后通过 usage 给出 wait4 取得的 CPU 秒、峰值 RSS 与块 I/O。"""
+
+    def __init__(self, pid: int, stdout, stdout_transport=None):
+        self.pid = pid
+        self.stdout = stdout
+        self.returncode = None
+        self.usage = {}
+        self._stdout_transport = stdout_transport
+
+    def send_signal(self, sig):
+        try:
+            os.kill(self.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def release(self):
+        """调用方不再等待退出码时调用（如取消后）。关闭 stdout 读端：脱离进程组的后代仍持有写端时不再挂在事件循环上。"""
+        if self._stdout_transport is not None:
+            self._stdout_transport.close()
+            self._stdout_transport = None
+
+
+class WarmProcess(ToolProcess):
+    """预热执行器 fork 出的子进程，由执行器回收并回传退出码与用量。"""
+
+    def __init__(self, pid: int, stdout, stdout_transport, control, writer):
+        super().__init__(pid, stdout, stdout_transport)
+        self._control = control
+        self._writer = writer
+
+    async def wait(self) -> int:
+        if self.returncode is None:
+            try:
+                msg = json.loads(await self._control.readline() or b"{}")
+                self.usage = msg.get("usage") or {}
+                self.returncode = int(msg.get("rc", 1))
+            finally:
+                self._writer.close()
+        return self.returncode
+
+
+class BashProcess(ToolProcess):
+    """bash 子进程，由本进程以 wait4 回收（不经 asyncio 子进程监视器，以便拿到 rusage）。"""
+
+    def __init__(self, popen: subprocess.Popen, stdout, stdout_transport):
+        super().__init__(popen.pid, stdout, stdout_transport)
+        self._popen = popen
+
+    async def wait(self) -> int:
+        if self.returncode is None:
+            rc, self.usage = await proc_limits.wait_pid(self.pid)
+            self.returncode = self._popen.returncode = rc
+        return self.returncode
+
+    def release(self):
+        super().release()
+        # 取消时 wait() 可能从未开始，进程组被杀后仍需回收，避免留下僵尸进程
+        if self.returncode is None:
+            self.returncode = self._popen.returncode = -1
+            proc_limits.reap_in_background(self.pid)
+
+
+async def attach_stdout_reader(pipe, limit: int):
+    """返回 (StreamReader, 读端 transport)。"""
+    loop = asyncio.get_running_loop()
+    stdout = asyncio.StreamReader(limit=limit, loop=loop)
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stdout, loop=loop), pipe)
+    return stdout, transport
+
+
+async def spawn_bash_process(command: str, cwd: str, env: dict, limit: int, limits: dict = None, cgroup: str = "") -> BashProcess:
+    # 服务进程是多线程的，fork 后的子进程里不能跑 Python（preexec_fn）；限制由 shell 前缀设置，再 exec 出执行命令的 bash
+    prefix = proc_limits.shell_prefix(limits or {}, cgroup)
+    argv = ["/bin/bash", "-c", command] if not prefix else ["/bin/bash", "-c", prefix + 'exec /bin/bash -c "$1"', "bash", command]
+    popen = subprocess.Popen(
+        argv,
+        cwd=cwd,
+        env=env,
+        start_new_session=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    try:
+        return BashProcess(popen, *await attach_stdout_reader(popen.stdout, limit))
+    except BaseException:
+        kill_process_group(popen)
+        raise
+
+
+async def spawn_warm_process(argv: list, cwd: str, env: dict, limit: int, limits: dict = None, cgroup: str = "") -> WarmProcess:
+    conn = warm_runner.connect(WARM_RUNNER_SOCKET)
+    out_r, out_w = os.pipe()
+    try:
+        warm_runner.send_request(conn, argv, cwd, env, out_w, limits=limits, cgroup=cgroup)
+        conn.setblocking(False)
+        control, writer = await asyncio.open_unix_connection(sock=conn)
+        msg = json.loads(await control.readline() or b"{}")
+        if "pid" not in msg:
+            writer.close()
+            raise OSError(msg.get("error") or "预热执行器未返回子进程 pid")
+    except BaseException:
+        conn.close()
+        os.close(out_r)
+        raise
+    finally:
+        os.close(out_w)
+    return WarmProcess(msg["pid"], *await attach_stdout_reader(os.fdopen(out_r, "rb", 0), limit), control, writer)
+
+
+async def spawn_tool_process(command: str, cwd: str, env: dict, limit: int = 1 << 16, limits: dict = None, cgroup: str = ""):
+    """`[cd DIR &&] python3 scripts/*.py` 形式的命令交给预热执行器 fork 执行，其余命令或执行器不可用时走 bash。
+    返回 (进程句柄, 启动方式 warm|bash)，两种句柄的 stdout/wait/usage/进程组语义一致；limits/cgroup 见 proc_limits。"""
+    plan = warm_runner.plan_launch(command, cwd, env) if WARM_RUNNER else None
+    if plan:
+        for attempt in range(2):
+            try:
+                return await spawn_warm_process(plan[0], plan[1], env, limit, limits, cgroup), "warm"
+            except OSError:
+                if attempt or not await asyncio.to_thread(ensure_warm_runner):
+                    break
+    return await spawn_bash_process(command, cwd, env, limit, limits, cgroup), "bash"
+
+
+def tool_command_signature(command: str) -> str:
+    """同类命令的资源画像键：解释器 + 脚本（python3 scripts/x.py），其他命令取可执行文件名。"""
+    try:
+        tokens = shlex.split(command)
+    except ValueError:
+        tokens = command.split()
+    while len(tokens) >= 3 and tokens[0] == "cd" and tokens[2] == "&&":
+        tokens = tokens[3:]
+    if not tokens:
+        return ""
+    head = os.path.basename(tokens[0])
+    if re.match(r"^(python\d*(\.\d+)?|node|bash|sh)$", head) and len(tokens) > 1 and not tokens[1].startswith("-"):
+        return f"{head} {tokens[1]}"
+    return head
+
+
+def task_limits(task_id: int) -> dict:
+    return proc_limits.merge_limits(TOOL_LIMITS, task_tool_limits.get(task_id))
+
+
+def tool_footprint(signature: str) -> dict:
+    with db_conn() as conn:
+        row = conn.execute("SELECT * FROM tool_footprints WHERE signature=?", (signature,)).fetchone()
+    return dict(row) if row else {}
+
+
+def record_tool_footprint(signature: str, usage: dict, wall_sec: float):
+    """按命令画像记录用量：CPU/I/O/耗时取指数滑动平均，峰值内存取缓慢衰减的最大值，准入时偏保守。"""
+    if not signature:
+        return
+    cpu = float(usage.get("cpuSec") or 0)
+    rss = float(usage.get("maxRssMb") or 0)
+    io = float((usage.get("ioReadBytes") or 0) + (usage.get("ioWriteBytes") or 0))
+    with db_conn() as conn:
+        row = conn.execute("SELECT * FROM tool_footprints WHERE signature=?", (signature,)).fetchone()
+        if row:
+            cpu = row["cpu_sec"] * 0.7 + cpu * 0.3
+            io = row["io_bytes"] * 0.7 + io * 0.3
+            wall_sec = row["wall_sec"] * 0.7 + wall_sec * 0.3
+            rss = max(row["max_rss_mb"] * 0.9, rss)
+        conn.execute(
+            "INSERT OR REPLACE INTO tool_footprints(signature, runs, cpu_sec, max_rss_mb, io_bytes, wall_sec, updated_at) VALUES(?,?,?,?,?,?,?)",
+            (signature, (row["runs"] if row else 0) + 1, cpu, rss, io, wall_sec, now_str()),
+        )
+
+
+def tool_saturation(need_mb: float) -> str:
+    """机器是否已饱和：可用内存（扣除预留与刚启动、尚未到峰值的命令）不足以容纳预计峰值，或每核负载过高。返回原因，空串表示可准入。"""
+    now = time.perf_counter()
+    ramping = sum(mb for started, mb in tool_inflight.values() if now - started < TOOL_ADMIT_RAMP_SEC)
+    avail = proc_limits.mem_available_mb() - TOOL_ADMIT_RESERVE_MB - ramping
+    if need_mb > avail:
+        return f"可用内存 {max(0, avail):.0f}MB < 预计峰值 {need_mb:.0f}MB"
+    load = proc_limits.load_per_cpu()
+    if TOOL_ADMIT_MAX_LOAD and load > TOOL_ADMIT_MAX_LOAD:
+        return f"每核负载 {load:.2f} > {TOOL_ADMIT_MAX_LOAD}"
+    return ""
+
+
+@asynccontextmanager
+async def tool_admission(task_id: int, signature: str, log_prefix: str = ""):
+    """按历史资源画像做准入：机器饱和时排队等待；本进程没有在途命令或等待超过 ATC_TOOL_ADMIT_MAX_WAIT_SEC 时直接放行，避免饿死。
+    产出 {"waitSec", "expectedRssMb"}。"""
+    need = float(tool_footprint(signature).get("max_rss_mb") or 0) if TOOL_ADMISSION else 0.0
+    slot, t0, logged = object(), time.perf_counter(), False
+    while True:
+        waited = time.perf_counter() - t0
+        with tool_admission_lock:
+            reason = tool_saturation(need) if TOOL_ADMISSION and tool_inflight else ""
+            if not reason or waited >= TOOL_ADMIT_MAX_WAIT_SEC:
+                tool_inflight[slot] = (time.perf_counter(), need)
+                break
+        if not logged:
+            await db_write(append_log, task_id, f"{log_prefix}机器资源紧张（{reason}），工具命令排队等待准入")
+            logged = True
+        ensure_not_stopped(task_id)
+        clamp_to_deadline(task_id, TOOL_ADMIT_POLL_SEC)
+        await asyncio.sleep(TOOL_ADMIT_POLL_SEC)
+    if logged:
+        await db_write(append_log, task_id, f"{log_prefix}已准入，等待 {waited:.1f}s")
+    try:
+        yield {"waitSec": round(waited, 2), "expectedRssMb": round(need, 1)}
+    finally:
+        with tool_admission_lock:
+            tool_inflight.pop(slot, None)
+
+
+def record_task_resources(task_id: int, event: dict):
+    """把单条命令的用量累加到任务元数据 tasks.resource_json。"""
+    with db_conn() as conn:
+        row = conn.execute("SELECT resource_json FROM tasks WHERE id=?", (task_id,)).fetchone()
+        if not row:
+            return
+        total = json.loads(row["resource_json"] or "{}")
+        total["commands"] = total.get("commands", 0) + 1
+        for key in ("cpuSec", "wallSec", "ioReadBytes", "ioWriteBytes"):
+            total[key] = round(total.get(key, 0) + (event.get(key) or 0), 3)
+        total["maxRssMb"] = max(total.get("maxRssMb", 0), event.get("maxRssMb") or 0)
+        reason = event.get("exitReason") or ""
+        if reason not in ("ok", "error", ""):
+            total.setdefault("exitReasons", {})[reason] = total.get("exitReasons", {}).get(reason, 0) + 1
+        conn.execute("UPDATE tasks SET resource_json=? WHERE id=?", (json.dumps(total, ensure_ascii=False), task_id))
+
+
+@asynccontextmanager
+async def limited_tool_process(task_id: int, command: str, cwd: str, env: dict, limit: int = 1 << 16, log_prefix: str = ""):
+    """准入 → 建 cgroup（已配置时）→ 按任务限制启动工具进程。产出 run（proc/launcher/limits/admitWaitSec），
+    退出时把 wait4/cgroup 用量汇总到 run["usage"]、更新命令资源画像并删除 cgroup。"""
+    limits = task_limits(task_id)
+    signature = tool_command_signature(command)
+    async with tool_admission(task_id, signature, log_prefix) as admitted:
+        cgroup = ""
+        if TOOL_CGROUP_ROOT:
+            cgroup = await asyncio.to_thread(proc_limits.create_cgroup, TOOL_CGROUP_ROOT, f"atc-task{task_id}-{time.time_ns()}", limits)
+        run = {"limits": limits, "cgroup": bool(cgroup), "admitWaitSec": admitted["waitSec"], "usage": {}}
+        t0 = time.perf_counter()
+        try:
+            run["proc"], run["launcher"] = await spawn_tool_process(command, cwd, env, limit, limits, cgroup)
+            yield run
+        finally:
+            proc = run.get("proc")
+            if proc is not None:
+                proc.release()
+            usage = dict(proc.usage) if proc is not None else {}
+            if cgroup:
+                usage.update(await asyncio.to_thread(proc_limits.cgroup_usage, cgroup))
+                await asyncio.to_thread(proc_limits.remove_cgroup, cgroup)
+            run["usage"] = usage
+            if usage:
+                await asyncio.to_thread(record_tool_footprint, signature, usage, time.perf_counter() - t0)
+
+
+class ToolOutputRing:
+    """工具输出的有界汇总：开头若干行 + 结尾环形缓冲 + 错误行，内存占用与输出长度无关。"""
+
+    def __init__(self):
+        self.head = []
+        self.tail = deque(maxlen=TOOL_DIGEST_TAIL_LINES)
+        self.errors = deque(maxlen=TOOL_DIGEST_ERROR_LINES)
+        self.lines = 0
+        self.bytes = 0
+
+    def feed(self, text: str):
+        """text 为若干完整行（不含末尾换行），按块处理，避免大输出逐行处理的开销。"""
+        self.lines += text.count("\n") + 1
+        lowered = text.lower()
+        if any(k in lowered for k in TOOL_ERROR_KEYWORDS):
+            for ln in TOOL_ERROR_LINE_RE.findall(text)[-TOOL_DIGEST_ERROR_LINES:]:
+                self.errors.append(ln.strip()[:240])
+        if len(self.head) < TOOL_DIGEST_HEAD_LINES:
+            need = TOOL_DIGEST_HEAD_LINES - len(self.head)
+            parts = text.split("\n", need)
+            self.head.extend(ln[:TOOL_LINE_MAX_CHARS] for ln in parts[:need])
+            if len(parts) <= need:
+                return
+            text = parts[need]
+        self.tail.extend(ln[:TOOL_LINE_MAX_CHARS] for ln in text.rsplit("\n", TOOL_DIGEST_TAIL_LINES)[-TOOL_DIGEST_TAIL_LINES:])
+
+    def summary(self) -> dict:
+        return {"lines": self.lines, "bytes": self.bytes, "head": self.head, "tail": list(self.tail), "errorLines": list(self.errors)}
+
+
+async def execute_role_command(
+    command: str,
+    task_id: int,
+    base_dir: str,
+    input_dir: str,
+    output_dir: str,
+    timeout_sec: int = 240,
+    spill_path: str = "",
+    log_prefix: str = "",
+    refresh: bool = False,
+    cache_ttl: int = None,
+    cache_store=None,
+) -> dict:
+    """流式执行工具命令：输出逐行写入完整输出文件、按批写入任务日志，只在内存中保留有界摘要。
+    开启 TOOL_CACHE 时先按 (命令, 引用的环境变量, 输入文件哈希) 查缓存，命中则还原产物并回放输出，不再执行。
+    cache_store 为可调用对象时，执行结束后其返回 False 则不写缓存（如批量中与其他命令并发、产物无法归属）。"""
+    env = os.environ.copy()
+    env.update(
+        {
+            "TASK_ID": str(task_id),
+            "TASK_ARTIFACT_DIR": base_dir,
+            "TASK_INPUT_DIR": input_dir,
+            "TASK_OUTPUT_DIR": output_dir,
+        }
+    )
+
+    ttl = TOOL_CACHE_TTL_SEC if cache_ttl is None else cache_ttl
+    cache_key, files_before = "", None
+    if TOOL_CACHE and ttl > 0:
+        cache_key = await asyncio.to_thread(tool_cache_key, command, env, base_dir, input_dir, output_dir)
+        if not refresh:
+            hit = await asyncio.to_thread(tool_cache_restore, cache_key, ttl, output_dir, spill_path)
+            if hit:
+                await db_write(
+                    append_log,
+                    task_id,
+                    f"{log_prefix}命中工具缓存（{hit['cache']['ageSec']}s 前执行，原耗时 {hit['cache']['savedSec']}s），"
+                    f"已还原 {len(hit['cache']['files'])} 个产物",
+                )
+                return hit
+        files_before = await asyncio.to_thread(output_manifest, output_dir)
+
+    timeout = clamp_to_deadline(task_id, task_limits(task_id).get("wall_sec") or max(30, int(timeout_sec)))
+    async with limited_tool_process(task_id, command, WORKDIR, env, log_prefix=log_prefix) as run:
+        timeout = max(1.0, timeout - run["admitWaitSec"])
+        t0 = time.perf_counter()
+        proc, launcher = run["proc"], run["launcher"]
+        ring = ToolOutputRing()
+        spill = open(spill_path, "w", encoding="utf-8") if spill_path else None
+        if spill:
+            spill.write(f"$ {command}\n\n")
+        pending = []
+        logged = 0
+        partial = b""
+
+        def flush_log():
+            # 交给写入器线程，不等待：日志行按提交顺序落库，事件循环不被 sqlite 写入阻塞
+            if pending:
+                db_writer.submit(append_logs, task_id, [f"{log_prefix}{ln}" for ln in pending])
+                pending.clear()
+
+        def emit(raw: bytes):
+            # raw 为若干完整行（不含末尾换行）
+            nonlocal logged
+            text = raw.decode("utf-8", errors="replace").replace("\r\n", "\n")
+            ring.feed(text)
+            if spill:
+                spill.write(text + "\n")
+            if logged < TOOL_STREAM_LOG_MAX_LINES:
+                room = TOOL_STREAM_LOG_MAX_LINES - logged
+                lines = text.split("\n", room)[:room]
+                logged += len(lines)
+                pending.extend(ln[:TOOL_LINE_MAX_CHARS] for ln in lines)
+                if logged == TOOL_STREAM_LOG_MAX_LINES:
+                    pending.append(f"…（已写入 {logged} 行，后续输出不再写入任务日志，见完整输出文件）")
+
+        async def pump():
+            nonlocal partial
+            while True:
+                chunk = await proc.stdout.read(65536)
+                if not chunk:
+                    break
+                ring.bytes += len(chunk)
+                partial += chunk
+                cut = partial.rfind(b"\n")
+                if cut >= 0:
+                    emit(partial[:cut])
+                    partial = partial[cut + 1 :]
+                elif len(partial) > 65536:
+                    emit(partial)
+                    partial = b""
+            if partial:
+                emit(partial)
+                partial = b""
+            return await proc.wait()
+
+        async def flusher():
+            while True:
+                await asyncio.sleep(TOOL_STREAM_LOG_SEC)
+                flush_log()
+
+        flush_job = asyncio.ensure_future(flusher())
+        try:
+            try:
+                rc = await asyncio.wait_for(pump(), timeout=timeout)
+                timed_out = False
+            except asyncio.TimeoutError:
+                kill_process_group(proc)
+                try:
+                    # 脱离进程组的后代可能仍持有 stdout，排空只等一小段时间
+                    await asyncio.wait_for(pump(), timeout=TOOL_DRAIN_GRACE_SEC)
+                except asyncio.TimeoutError:
+                    if partial:
+                        emit(partial)
+                        partial = b""
+                    pending.append("…（命令已超时终止，但仍有后代进程占用输出管道，不再等待其输出）")
+                rc = 124
+                timed_out = True
+            except asyncio.CancelledError:
+                kill_process_group(proc)
+                raise
+        finally:
+            flush_job.cancel()
+            flush_log()
+            duration = round(time.perf_counter() - t0, 2)
+            if spill:
+                spill.write(f"\n# rc={proc.returncode} durationSec={duration} lines={ring.lines} bytes={ring.bytes}\n")
+                spill.close()
+
+    usage = run["usage"]
+    exit_reason = proc_limits.exit_reason(rc, timed_out, usage, run["limits"], "\n".join(ring.errors))
+    await asyncio.to_thread(record_task_resources, task_id, {**usage, "wallSec": duration, "exitReason": exit_reason})
+
+    result = {
+        "rc": rc,
+        "timedOut": timed_out,
+        "timeoutSec": round(timeout, 1),
+        "durationSec": duration,
+        "launcher": launcher,
+        "usage": usage,
+        "exitReason": exit_reason,
+        "limits": run["limits"],
+        "admitWaitSec": run["admitWaitSec"],
+        **ring.summary(),
+    }
+    if cache_key:
+        result["cache"] = {"hit": False, "refresh": bool(refresh), "stored": False}
+        if rc == 0 and not timed_out:
+            if cache_store is None or cache_store():
+                result["cache"]["stored"] = await asyncio.to_thread(tool_cache_put, task_id, cache_key, command, result, output_dir, files_before, spill_path)
+            else:
+                await db_write(append_log, task_id, f"{log_prefix}与同批其他命令并发执行，输出目录变化无法归属到本命令，不写入工具缓存")
+    return result
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def tool_cache_key(command: str, env: dict, base_dir: str, input_dir: str, output_dir: str) -> str:
+    """工具缓存键：规整后的命令 + 命令引用的环境变量值 + 输入目录全部文件与命令参数中已存在文件（含脚本本身）的内容哈希。
+    任务目录替换为占位符，不同任务的相同命令与输入可复用同一条缓存。"""
+    placeholders = [(output_dir, "$TASK_OUTPUT_DIR"), (input_dir, "$TASK_INPUT_DIR"), (base_dir, "$TASK_ARTIFACT_DIR")]
+    task_vars = {"TASK_ID", "TASK_ARTIFACT_DIR", "TASK_INPUT_DIR", "TASK_OUTPUT_DIR"}
+
+    def portable(path: str) -> str:
+        for root, name in placeholders:
+            if path == root or path.startswith(root + os.sep):
+                return name + path[len(root) :]
+        return path
+
+    refs = sorted({a or b for a, b in warm_runner.ENV_REF_RE.findall(command)})
+    deps = {
+        "command": " ".join(command.split()),
+        "env": {k: "" if k in task_vars else env.get(k, "") for k in refs},
+        "files": {},
+    }
+    for root, _, files in os.walk(input_dir):
+        for name in files:
+            full = os.path.join(root, name)
+            deps["files"][portable(full)] = file_sha256(full)
+
+    expanded = warm_runner.ENV_REF_RE.sub(lambda m: env.get(m.group(1) or m.group(2), ""), command)
+    try:
+        tokens = shlex.split(expanded)
+    except ValueError:
+        tokens = expanded.split()
+    cwd = WORKDIR
+    for i, tok in enumerate(tokens):
+        if i and tokens[i - 1] == "cd":
+            cwd = os.path.normpath(os.path.join(cwd, tok))
+            continue
+        for cand in {tok, tok.split("=", 1)[-1]}:
+            full = os.path.normpath(os.path.join(cwd, cand))
+            if os.path.isfile(full):
+                deps["files"].setdefault(portable(full), file_sha256(full))
+    return hashlib.sha256(json.dumps(deps, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def tool_cache_blob_path(sha: str) -> str:
+    return os.path.join(TOOL_CACHE_DIR, "blobs", sha[:2], sha)
+
+
+def tool_cache_store_blob(path: str) -> str:
+    """按内容哈希存入缓存目录，相同内容只存一份。"""
+    sha = file_sha256(path)
+    dst = tool_cache_blob_path(sha)
+    if not os.path.exists(dst):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(path, tmp)
+        os.replace(tmp, dst)
+    return sha
+
+
+def tool_cache_put(task_id: int, cache_key: str, command: str, result: dict, output_dir: str, files_before: dict, spill_path: str) -> bool:
+    try:
+        files, size = [], 0
+        for rel, meta in sorted(output_manifest(output_dir).items()):
+            if files_before.get(rel) != meta:
+                files.append([rel, tool_cache_store_blob(os.path.join(output_dir, rel)), meta[0]])
+                size += meta[0]
+        log_blob = ""
+        if spill_path and os.path.isfile(spill_path):
+            log_blob = tool_cache_store_blob(spill_path)
+            size += os.path.getsize(spill_path)
+    except OSError as e:
+        append_log(task_id, f"[tool-cache] 写入失败：{e}")
+        return False
+
+    summary = {k: result[k] for k in ("lines", "bytes", "head", "tail", "errorLines")}
+    max_bytes = TOOL_CACHE_MAX_MB * 1024 * 1024
+    with db_conn() as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO tool_result_cache(
+                cache_key, command, rc, summary_json, log_blob, files_json, size_bytes, duration_sec, hit_count, created_at, last_used_at
+            ) VALUES(?,?,?,?,?,?,?,?,0,?,?)
+            """,
+            (
+                cache_key,
+                command,
+                result["rc"],
+                json.dumps(summary, ensure_ascii=False),
+                log_blob,
+                json.dumps(files, ensure_ascii=False),
+                size,
+                result.get("durationSec") or 0,
+                time.time(),
+                time.time(),
+            ),
+        )
+        total = conn.execute("SELECT COALESCE(SUM(size_bytes), 0) s FROM tool_result_cache").fetchone()["s"]
+        if total <= max_bytes:
+            return True
+        # LRU 淘汰到上限的 90%，再清理不再被任何条目引用的 blob
+        target = int(max_bytes * 0.9)
+        for row in conn.execute("SELECT cache_key, size_bytes FROM tool_result_cache ORDER BY last_used_at ASC").fetchall():
+            if total <= target:
+                break
+            conn.execute("DELETE FROM tool_result_cache WHERE cache_key=?", (row["cache_key"],))
+            total -= int(row["size_bytes"] or 0)
+        live = set()
+        for row in conn.execute("SELECT log_blob, files_json FROM tool_result_cache").fetchall():
+            live.add(row["log_blob"])
+            live.update(f[1] for f in json.loads(row["files_json"] or "[]"))
+    for root, _, names in os.walk(os.path.join(TOOL_CACHE_DIR, "blobs")):
+        for name in names:
+            if name not in live:
+                try:
+                    os.remove(os.path.join(root, name))
+                except OSError:
+                    pass
+    return True
+
 
-    if action == "final":
-        out["action"] = "final"
-        out["content"] = str(data.get("content") or raw).strip()
-        return out
+def tool_cache_restore(cache_key: str, ttl: int, output_dir: str, spill_path: str):
+    """命中且未过期时把缓存产物写回输出目录、完整输出写回 spill_path，返回与执行结果同结构的 dict；否则返回 None。"""
+    with db_conn() as conn:
+        row = conn.execute("SELECT * FROM tool_result_cache WHERE cache_key=?", (cache_key,)).fetchone()
+    if not row:
+        return None
+    age = time.time() - float(row["created_at"] or 0)
+    if age > ttl:
+        return None
+    files = json.loads(row["files_json"] or "[]")
+    blobs = [sha for _, sha, _ in files] + ([row["log_blob"]] if row["log_blob"] else [])
+    if not all(os.path.isfile(tool_cache_blob_path(sha)) for sha in blobs):
+        with db_conn() as conn:
+            conn.execute("DELETE FROM tool_result_cache WHERE cache_key=?", (cache_key,))
+        return None
 
-    return out
+    for rel, sha, _ in files:
+        dst = safe_join_under(output_dir, rel)
+        if not dst:
+            continue
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copyfile(tool_cache_blob_path(sha), dst)
+    if spill_path and row["log_blob"]:
+        shutil.copyfile(tool_cache_blob_path(row["log_blob"]), spill_path)
+        with open(spill_path, "a", encoding="utf-8") as f:
+            f.write(f"# 以上为工具缓存回放（{int(age)}s 前执行）\n")
+    with db_conn() as conn:
+        conn.execute(
+            "UPDATE tool_result_cache SET hit_count=hit_count+1, last_used_at=? WHERE cache_key=?",
+            (time.time(), cache_key),
+        )
+    return {
+        "rc": int(row["rc"]),
+        "timedOut": False,
+        "timeoutSec": None,
+        "durationSec": 0,
+        "launcher": "cache",
+        **json.loads(row["summary_json"] or "{}"),
+        "cache": {"hit": True, "ageSec": int(age), "savedSec": row["duration_sec"], "files": [f[0] for f in files]},
+    }
 
 
-def list_output_file_names(output_dir: str) -> set:
-    if not os.path.isdir(output_dir):
-        return set()
-    out = set()
-    for name in os.listdir(output_dir):
-        full = os.path.join(output_dir, name)
-        if os.path.isfile(full):
-            out.add(name)
-    return out
+def write_text_file(path: str, text: str):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
 
 
-def is_system_generated_output(name: str) -> bool:
-    n = (name or "").strip()
-    return n.startswith("步骤") or n in ("多Agent_最终交付.md", "多Agent_会话审计.json")
+async def write_text_async(path: str, text: str):
+    await asyncio.to_thread(write_text_file, path, text)
 
 
-def task_requires_real_artifacts(task_text: str) -> bool:
-    t = (task_text or "")
-    keys = ["爬取", "采集", "关键词", "文包", "报告", "导出", "csv", "json", "zip", "附件"]
-    return any(k in t for k in keys)
+def tool_output_path(base_dir: str, stage: str, tool_round: int, tag: str = "") -> tuple[str, str]:
+    """完整工具输出的落盘路径（任务产物目录下，不进入 output），返回 (绝对路径, 相对 base_dir 的 handle)。
+    批量执行时以命令 id 作 tag 区分同一轮的多条命令。"""
+    run_dir = os.path.join(base_dir, "tool_runs")
+    os.makedirs(run_dir, exist_ok=True)
+    slug = re.sub(r"[^\w\u4e00-\u9fff-]+", "_", stage or "stage")[:40]
+    name = f"{slug}_round{tool_round}{'_' + tag if tag else ''}_{int(time.time() * 1000) % 10000000}.log"
+    return os.path.join(run_dir, name), f"tool_runs/{name}"
 
 
-def is_safe_role_command(command: str) -> tuple[bool, str]:
-    cmd = (command or "").strip()
-    if not cmd:
-        return False, "命令为空"
-    if len(cmd) > 800:
-        return False, "命令过长（>800）"
-    if "\n" in cmd or "\r" in cmd:
-        return False, "命令不能包含换行"
+def tool_result_sections(command: str, result: dict, handle: str, produced_files=None, head_chars: int = 1500, tail_chars: int = 2500) -> list:
+    """单条命令的结果摘要段落；produced_files 为 None 时不列新增文件（批量执行时统一列出）。"""
+    head = "\n".join(result.get("head") or [])[:head_chars]
+    tail_lines = result.get("tail") or []
+    tail = "\n".join(tail_lines)[-tail_chars:]
+    error_lines = result.get("errorLines") or []
+    omitted = max(0, int(result.get("lines") or 0) - len(result.get("head") or []) - len(tail_lines))
 
-    blocked = [
-        "rm -rf /",
-        "shutdown",
-        "reboot",
-        "mkfs",
-        "fdisk",
-        "poweroff",
-        ":(){",
-        "halt",
-        "systemctl stop",
-        "systemctl disable",
+    parts = [
+        f"命令: {command}",
+        f"返回码: {result.get('rc')}",
+        f"是否超时: {result.get('timedOut')}",
+        f"耗时: {result.get('durationSec', '-')}s",
+        f"输出规模: {result.get('lines', 0)} 行 / {result.get('bytes', 0)} 字节",
     ]
-    lower = cmd.lower()
-    for b in blocked:
-        if b in lower:
-            return False, f"命中高危命令片段: {b}"
-    return True, "ok"
+    if produced_files is not None:
+        parts.append(f"新增/更新文件: {produced_files if produced_files else '无'}")
+    usage = result.get("usage") or {}
+    if usage:
+        parts.append(f"资源用量: CPU {usage.get('cpuSec', 0)}s / 峰值内存 {usage.get('maxRssMb', 0)}MB")
+    if result.get("exitReason") in ("cpu_limit", "memory_limit"):
+        parts.append(
+            f"注意：命令因资源限制被终止（{result['exitReason']}，限制 {proc_limits.format_limits(result.get('limits') or {})}），"
+            "请减少单次处理量（分批、限制并发/页数）后重试，不要原样重复执行。"
+        )
+    cache = result.get("cache") or {}
+    if cache.get("hit"):
+        parts.append(
+            f"注意：本次结果来自工具缓存（{cache.get('ageSec')}s 前以相同命令与输入执行，原耗时 {cache.get('savedSec')}s），产物已原样还原；"
+            '如需重新执行获取最新数据，请在 run_command JSON 中加 "refresh": true。'
+        )
+    if error_lines:
+        parts.append("错误相关行:\n" + "\n".join(error_lines))
+    parts.append(f"输出开头:\n{head}" if head else "输出开头: （无输出）")
+    if tail:
+        parts.append((f"…（省略 {omitted} 行）…\n" if omitted else "") + f"输出结尾:\n{tail}")
+    if handle:
+        parts.append(
+            f"完整输出句柄: {handle}\n"
+            '如需查看更多，可返回 {"action":"read_tool_output","handle":"' + handle + '","offset":0,"limit":4000}'
+            '（也可用 "pattern" 按正则筛选行）。'
+        )
+    return parts
 
 
-def execute_role_command(command: str, task_id: int, base_dir: str, input_dir: str, output_dir: str, timeout_sec: int = 240) -> dict:
-    env = os.environ.copy()
-    env.update(
-        {
-            "TASK_ID": str(task_id),
-            "TASK_ARTIFACT_DIR": base_dir,
-            "TASK_INPUT_DIR": input_dir,
-            "TASK_OUTPUT_DIR": output_dir,
-        }
-    )
+def build_tool_digest(command: str, result: dict, handle: str, produced_files: list) -> str:
+    parts = ["工具执行结果摘要如下，请基于结果继续。"]
+    parts += tool_result_sections(command, result, handle, produced_files)
+    parts.append("若还需要执行工具，可继续返回 run_command / run_commands JSON；若已完成，请返回 final JSON。")
+    return "\n".join(parts)
 
-    proc = subprocess.Popen(
-        command,
-        shell=True,
-        cwd=WORKDIR,
-        executable="/bin/bash",
-        env=env,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1,
-    )
+
+def build_batch_tool_digest(runs: list, produced_files: list, elapsed: float) -> str:
+    """批量执行的结果合并为一条反馈；每条命令的首尾输出按条数缩减，总长度与单条命令相当。"""
+    n = max(1, len(runs))
+    failed = [r["id"] for r in runs if r["status"] != "ok"]
+    parts = [
+        f"批量工具执行结果摘要如下（共 {len(runs)} 条，并发上限 {TOOL_BATCH_CONCURRENCY}，总耗时 {elapsed}s），请基于结果继续。",
+        f"未成功: {failed if failed else '无'}",
+        f"新增/更新文件: {produced_files if produced_files else '无'}",
+    ]
+    for r in runs:
+        parts.append(f"\n### [{r['id']}] {r['status']}" + (f"（依赖 {r['after']}）" if r["after"] else ""))
+        if r["status"] in ("rejected", "skipped"):
+            parts.append(f"命令: {r['command']}\n未执行：{r['note']}")
+            continue
+        parts += tool_result_sections(r["command"], r["result"], r["handle"], None, max(300, 1500 // n), max(500, 2500 // n))
+    parts.append("\n若还需要执行工具，可继续返回 run_command / run_commands JSON；若已完成，请返回 final JSON。")
+    return "\n".join(parts)
+
+
+def read_tool_output(base_dir: str, handle: str, offset: int = 0, limit: int = 4000, pattern: str = "") -> str:
+    full = safe_join_under(base_dir, handle) if handle.startswith("tool_runs/") else None
+    if not full or not os.path.isfile(full):
+        return f"[TOOL_BRIDGE] 无效的输出句柄：{handle}"
+    with open(full, "r", encoding="utf-8", errors="ignore") as f:
+        text = f.read()
+    if pattern:
+        try:
+            rx = re.compile(pattern, re.I)
+        except re.error as e:
+            return f"[TOOL_BRIDGE] 正则无效：{e}"
+        text = "\n".join(ln for ln in text.splitlines() if rx.search(ln))
+    chunk = text[offset : offset + limit]
+    nxt = offset + len(chunk)
+    more = f"（还有 {len(text) - nxt} 字符，下一段 offset={nxt}）" if nxt < len(text) else "（已到结尾）"
+    return f"输出句柄 {handle} 片段 [{offset}, {nxt}) / 共 {len(text)} 字符{more}：\n{chunk}"
+
+
+async def run_tool_batch(task_id: int, stage: str, role, items: list, base_dir: str, input_dir: str, output_dir: str, tool_round: int) -> list:
+    """并发执行 run_commands：互不依赖的命令在 ATC_TOOL_BATCH_CONCURRENCY 上限内同时执行，有依赖的等依赖成功后再执行，
+    依赖失败或未通过安全检查的命令不执行。任一命令抛出异常（取消/截止）时取消其余命令。"""
+    sem = asyncio.Semaphore(TOOL_BATCH_CONCURRENCY)
+    jobs = {}
+    # 共用输出目录：执行期间与其他命令有重叠的命令不写工具缓存，否则会把别的命令写出的文件记成自己的产物
+    running, overlapped = set(), set()
+
+    async def run_one(item: dict) -> dict:
+        run = {**item, "status": "ok", "note": "", "handle": "", "result": None}
+        ok, reason = is_safe_role_command(item["command"])
+        if not ok:
+            run.update(status="rejected", note=f"安全检查未通过（{reason}）")
+            return run
+        if item["badAfter"]:
+            run.update(status="rejected", note=f"依赖 {'、'.join(d or '（空）' for d in item['badAfter'])} 不存在或位于本命令之后")
+            return run
+        for dep in item["after"]:
+            if (await jobs[dep])["status"] != "ok":
+                run.update(status="skipped", note=f"依赖 {dep} 未成功")
+                return run
+        async with sem:
+            spill_path, run["handle"] = tool_output_path(base_dir, stage, tool_round, item["id"])
+            if running:
+                overlapped.update(running, [item["id"]])
+            running.add(item["id"])
+            try:
+                run["result"] = await execute_role_command(
+                    item["command"],
+                    task_id,
+                    base_dir,
+                    input_dir,
+                    output_dir,
+                    spill_path=spill_path,
+                    log_prefix=f"[{role['code']}] 工具输出[{item['id']}]｜",
+                    refresh=item["refresh"],
+                    cache_ttl=item["ttl"],
+                    cache_store=lambda: item["id"] not in overlapped,
+                )
+            finally:
+                running.discard(item["id"])
+        if run["result"]["rc"] != 0:
+            run["status"] = "timeout" if run["result"]["timedOut"] else "failed"
+        return run
+
+    for item in items:
+        jobs[item["id"]] = asyncio.ensure_future(run_one(item))
     try:
-        out, _ = proc.communicate(timeout=max(30, int(timeout_sec)))
-        rc = proc.returncode
-        timed_out = False
-    except subprocess.TimeoutExpired:
-        proc.kill()
-        out, _ = proc.communicate()
-        rc = 124
-        timed_out = True
+        return list(await asyncio.gather(*jobs.values()))
+    except BaseException:
+        for job in jobs.values():
+            job.cancel()
+        await asyncio.gather(*jobs.values(), return_exceptions=True)
+        raise
 
-    out = (out or "")[-6000:]
-    return {"rc": rc, "output": out, "timedOut": timed_out}
 
+def tool_event_from_result(tool_round: int, command: str, result: dict, handle: str, produced: list) -> dict:
+    usage = result.get("usage") or {}
+    cache = result.get("cache")
+    return {
+        "round": tool_round,
+        "command": command,
+        "rc": result["rc"],
+        "timedOut": result["timedOut"],
+        "timeoutSec": result.get("timeoutSec"),
+        "durationSec": result.get("durationSec"),
+        "launcher": result.get("launcher"),
+        "exitReason": result.get("exitReason"),
+        "cpuSec": usage.get("cpuSec"),
+        "maxRssMb": usage.get("maxRssMb"),
+        "ioReadBytes": usage.get("ioReadBytes"),
+        "ioWriteBytes": usage.get("ioWriteBytes"),
+        "admitWaitSec": result.get("admitWaitSec"),
+        "cache": ("hit" if cache["hit"] else "refresh" if cache["refresh"] else "miss") if cache else "",
+        "outputBytes": result["bytes"],
+        "outputLines": result["lines"],
+        "outputFile": handle,
+        "producedFiles": produced,
+    }
 
-def run_role_stage_with_tools(
+
+async def run_role_stage_with_tools(
     task_id: int,
     stage: str,
     role,
@@ -1308,42 +3800,91 @@ def run_role_stage_with_tools(
 
     while True:
         ensure_not_stopped(task_id)
-        assistant_text = call_role_llm(role, messages)
-        save_role_message(task_id, role["code"], stage, "assistant", assistant_text)
+        assistant_text = await call_role_llm(role, messages, task_id=task_id, stage=stage)
+        await db_write(save_role_message, task_id, role["code"], stage, "assistant", assistant_text)
 
         action = parse_role_action(assistant_text)
+        if action["action"] == "read_tool_output" and tool_round < max_tool_rounds:
+            tool_feedback = await asyncio.to_thread(read_tool_output, base_dir, action["handle"], action["offset"], action["limit"], action["pattern"])
+            tool_events.append({"round": tool_round + 1, "readOutput": action["handle"], "rc": 0, "timedOut": False})
+            await db_write(append_log, task_id, f"[{role['code']}] 读取工具输出 round={tool_round+1}/{max_tool_rounds} handle={action['handle']} offset={action['offset']}")
+            messages.append({"role": "assistant", "content": assistant_text})
+            messages.append({"role": "user", "content": tool_feedback})
+            await db_write(save_role_message, task_id, role["code"], stage, "user", tool_feedback)
+            tool_round += 1
+            continue
+
         if action["action"] == "run_command" and tool_round < max_tool_rounds:
             cmd = action.get("command", "")
             ok, reason = is_safe_role_command(cmd)
+            files_before = manifest_snapshot(task_id, [output_dir])
+            handle = ""
             if not ok:
-                result = {"rc": 1, "output": f"[TOOL_BRIDGE] 拒绝执行：{reason}", "timedOut": False}
+                ring = ToolOutputRing()
+                ring.feed(f"[TOOL_BRIDGE] 拒绝执行：{reason}")
+                result = {"rc": 1, "timedOut": False, "durationSec": 0, **ring.summary()}
             else:
-                result = execute_role_command(cmd, task_id, base_dir, input_dir, output_dir)
+                spill_path, handle = tool_output_path(base_dir, stage, tool_round + 1)
+                try:
+                    result = await execute_role_command(
+                        cmd,
+                        task_id,
+                        base_dir,
+                        input_dir,
+                        output_dir,
+                        spill_path=spill_path,
+                        log_prefix=f"[{role['code']}] 工具输出｜",
+                        refresh=action.get("refresh", False),
+                        cache_ttl=action.get("ttl"),
+                    )
+                finally:
+                    touch_task_files(task_id)
+            produced = changed_files(diff_file_manifests(files_before, manifest_snapshot(task_id, [output_dir])))
 
-            tool_events.append(
-                {
-                    "round": tool_round + 1,
-                    "command": cmd,
-                    "rc": result["rc"],
-                    "timedOut": result["timedOut"],
-                }
-            )
-            append_log(
+            tool_events.append(tool_event_from_result(tool_round + 1, cmd, result, handle, produced))
+            await db_write(
+                append_log,
                 task_id,
-                f"[{role['code']}] 工具执行 round={tool_round+1}/{max_tool_rounds} rc={result['rc']} timedOut={result['timedOut']} cmd={cmd}",
+                f"[{role['code']}] 工具执行 round={tool_round+1}/{max_tool_rounds} rc={result['rc']} timedOut={result['timedOut']}"
+                f"{' cache=hit' if (result.get('cache') or {}).get('hit') else ''} cmd={cmd}",
             )
 
-            tool_feedback = (
-                "工具执行结果如下，请基于结果继续。\n"
-                f"命令: {cmd}\n"
-                f"返回码: {result['rc']}\n"
-                f"是否超时: {result['timedOut']}\n"
-                f"输出片段:\n{result['output']}\n\n"
-                "若还需要执行工具，可继续返回 run_command JSON；若已完成，请返回 final JSON。"
+            tool_feedback = build_tool_digest(cmd, result, handle, produced)
+            messages.append({"role": "assistant", "content": assistant_text})
+            messages.append({"role": "user", "content": tool_feedback})
+            await db_write(save_role_message, task_id, role["code"], stage, "user", tool_feedback)
+            tool_round += 1
+            continue
+
+        if action["action"] == "run_commands" and action["commands"] and tool_round < max_tool_rounds:
+            files_before = manifest_snapshot(task_id, [output_dir])
+            t0 = time.perf_counter()
+            try:
+                runs = await run_tool_batch(task_id, stage, role, action["commands"], base_dir, input_dir, output_dir, tool_round + 1)
+            finally:
+                touch_task_files(task_id)
+            elapsed = round(time.perf_counter() - t0, 2)
+            produced = changed_files(diff_file_manifests(files_before, manifest_snapshot(task_id, [output_dir])))
+
+            for r in runs:
+                if r["result"] is None:
+                    event = {"round": tool_round + 1, "command": r["command"], "rc": None, "timedOut": False, "skipped": r["note"]}
+                else:
+                    event = tool_event_from_result(tool_round + 1, r["command"], r["result"], r["handle"], [])
+                tool_events.append({**event, "batchId": r["id"], "after": r["after"], "status": r["status"]})
+            if tool_events and produced:
+                tool_events[-1]["producedFiles"] = produced
+            await db_write(
+                append_log,
+                task_id,
+                f"[{role['code']}] 批量工具执行 round={tool_round+1}/{max_tool_rounds} 共 {len(runs)} 条，耗时 {elapsed}s："
+                + "，".join(f"{r['id']}={r['status']}" for r in runs),
             )
+
+            tool_feedback = build_batch_tool_digest(runs, produced, elapsed)
             messages.append({"role": "assistant", "content": assistant_text})
             messages.append({"role": "user", "content": tool_feedback})
-            save_role_message(task_id, role["code"], stage, "user", tool_feedback)
+            await db_write(save_role_message, task_id, role["code"], stage, "user", tool_feedback)
             tool_round += 1
             continue
 
@@ -1351,6 +3892,178 @@ def run_role_stage_with_tools(
         return final_content, tool_events
 
 
+def stage_modes(stage: str, stage_idx: int, role_code: str) -> tuple[bool, bool, bool]:
+    """返回 (复核阶段, Lead 分发阶段, Lead 验收阶段)；三者皆否即执行阶段。"""
+    verifier_mode = is_verifier_stage(stage, role_code)
+    lead_dispatch_mode = ("分发" in stage) or (stage_idx == 0 and any(k in stage for k in ["评估", "拆解", "规划"]))
+    lead_acceptance_mode = (
+        role_code == "Lead Agent"
+        and (not lead_dispatch_mode)
+        and any(k in stage for k in ["联合交付", "验收", "交付"])
+    )
+    return verifier_mode, lead_dispatch_mode, lead_acceptance_mode
+
+
+def branch_output_dir(base_dir: str, stage: str) -> str:
+    """并行分支的独立输出目录（不在 output 下），分支通过后再合并到 output。"""
+    slug = re.sub(r"[^\w\u4e00-\u9fff-]+", "_", stage or "stage")[:40]
+    path = os.path.join(base_dir, "branches", slug)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def merge_branch_output_dir(branch_dir: str, output_dir: str) -> list:
+    moved = []
+    for name in sorted(os.listdir(branch_dir)):
+        dst = os.path.join(output_dir, name)
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        elif os.path.exists(dst):
+            os.remove(dst)
+        shutil.move(os.path.join(branch_dir, name), dst)
+        moved.append(name)
+    return moved
+
+
+def seed_speculative_dir(output_dir: str, staging: str) -> dict:
+    """推测阶段的暂存目录以当前输出目录的副本为起点（复制而非硬链接：原地改写不能波及正在质控的输出），返回副本清单。"""
+    shutil.rmtree(staging, ignore_errors=True)
+    if os.path.isdir(output_dir):
+        shutil.copytree(output_dir, staging, symlinks=True)
+    else:
+        os.makedirs(staging, exist_ok=True)
+    return output_manifest(staging)
+
+
+def merge_speculative_dir(staging: str, output_dir: str, seed: dict) -> list:
+    """只把推测阶段相对副本新增/改动的文件写回输出目录，并同步其删除的文件；返回变更的相对路径。"""
+    after = output_manifest(staging)
+    changed = []
+    for rel, meta in sorted(after.items()):
+        if seed.get(rel) == meta:
+            continue
+        dst = os.path.join(output_dir, rel)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            shutil.rmtree(dst)
+        shutil.move(os.path.join(staging, rel), dst)
+        changed.append(rel)
+    for rel in sorted(set(seed) - set(after)):
+        try:
+            os.remove(os.path.join(output_dir, rel))
+        except FileNotFoundError:
+            continue
+        changed.append(rel)
+    shutil.rmtree(staging, ignore_errors=True)
+    return changed
+
+
+def latest_role_message_id(task_id: int) -> int:
+    with db_conn() as conn:
+        row = conn.execute("SELECT COALESCE(MAX(id), 0) AS mid FROM role_session_messages WHERE task_id=?", (task_id,)).fetchone()
+    return int(row["mid"])
+
+
+def rollback_role_messages(task_id: int, after_id: int, stage: str = "") -> int:
+    """撤销 after_id 之后写入的会话消息（指定 stage 时只撤销该阶段及其对抗评审/质控子阶段），并作废覆盖到这些消息的摘要块。"""
+    with db_conn() as conn:
+        if stage:
+            # 前缀按字面比较：阶段名里的 % / _ 不能当作 LIKE 通配符
+            prefix = f"{stage}-"
+            cur = conn.execute(
+                "DELETE FROM role_session_messages WHERE task_id=? AND id>? AND (stage=? OR substr(stage, 1, ?)=?)",
+                (task_id, after_id, stage, len(prefix), prefix),
+            )
+        else:
+            cur = conn.execute("DELETE FROM role_session_messages WHERE task_id=? AND id>?", (task_id, after_id))
+        conn.execute("DELETE FROM role_session_summaries WHERE task_id=? AND to_id>?", (task_id, after_id))
+    return cur.rowcount
+
+
+def output_manifest(output_dir: str) -> dict:
+    manifest = {}
+    for root, _, files in os.walk(output_dir):
+        for name in files:
+            full = os.path.join(root, name)
+            try:
+                st = os.stat(full)
+            except FileNotFoundError:
+                # 遍历期间被并发删除的文件不计入清单
+                continue
+            manifest[os.path.relpath(full, output_dir)] = [st.st_size, st.st_mtime_ns]
+    return manifest
+
+
+def save_checkpoint(task_id: int, stage_idx: int, stages: list, state_json: str, output_dir: str):
+    with db_conn() as conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO task_checkpoints(
+                task_id, run_id, stage_idx, stage, stages_json, state_json, manifest_json, message_mark, tokens_carried, created_at
+            ) VALUES(?,?,?,?,?,?,?,?,?,?)
+            """,
+            (
+                task_id,
+                task_run_context.get(task_id) or "",
+                stage_idx,
+                stages[stage_idx] if stage_idx < len(stages) else "",
+                json.dumps(stages, ensure_ascii=False),
+                state_json,
+                json.dumps(output_manifest(output_dir), ensure_ascii=False),
+                latest_role_message_id(task_id),
+                task_token_carry.get(task_id, 0),
+                now_str(),
+            ),
+        )
+
+
+def load_checkpoint(task_id: int):
+    with db_conn() as conn:
+        row = conn.execute("SELECT * FROM task_checkpoints WHERE task_id=?", (task_id,)).fetchone()
+    if not row:
+        return None
+    return {
+        "runId": row["run_id"],
+        "stageIdx": int(row["stage_idx"]),
+        "stage": row["stage"],
+        "stages": json.loads(row["stages_json"] or "[]"),
+        "state": json.loads(row["state_json"] or "{}"),
+        "manifest": json.loads(row["manifest_json"] or "{}"),
+        "messageMark": int(row["message_mark"] or 0),
+        "tokensCarried": int(row["tokens_carried"] or 0),
+        "createdAt": row["created_at"],
+    }
+
+
+def run_billed_tokens(task_id: int, run_id: str) -> int:
+    """某次运行计费的 token（不含缓存命中），含断点之后被丢弃的调用。"""
+    with db_conn() as conn:
+        row = conn.execute(
+            "SELECT COALESCE(SUM(prompt_tokens + completion_tokens), 0) FROM llm_usage WHERE task_id=? AND run_id=? AND cached=0",
+            (task_id, run_id),
+        ).fetchone()
+    return int(row[0] or 0)
+
+
+def clear_checkpoint(task_id: int):
+    with db_conn() as conn:
+        conn.execute("DELETE FROM task_checkpoints WHERE task_id=?", (task_id,))
+
+
+def restore_output_to_manifest(output_dir: str, manifest: dict):
+    """把输出目录还原到断点时的文件集合：断点后新增的文件删除；断点内文件若缺失或被改动则无法恢复，返回 (False, 原因)。"""
+    current = output_manifest(output_dir)
+    for rel, meta in manifest.items():
+        if current.get(rel) != meta:
+            return False, f"断点产物已缺失或被修改：{rel}"
+    removed = 0
+    for rel in current:
+        if rel not in manifest:
+            os.remove(os.path.join(output_dir, rel))
+            removed += 1
+    return True, removed
+
+
 def find_stage_index_by_role(stages: list, stage_roles: dict, role_code: str, before_idx: int, fallback_idx: int = 0) -> int:
     rc = (role_code or "").strip()
     if not rc:
@@ -1370,6 +4083,7 @@ def parse_dispatch_plan(text: str, allowed_stages: list, enabled_role_codes: set
         "skipped_stages": [],
         "acceptance_contract": None,
         "collision_rounds": None,
+        "depends_on": {},
     }
     if not raw:
         return out
@@ -1394,6 +4108,9 @@ def parse_dispatch_plan(text: str, allowed_stages: list, enabled_role_codes: set
             role = str(item.get("role") or item.get("assignee") or "").strip()
             if stage in allowed_stages and role in enabled_role_codes:
                 out["assignments"][stage] = role
+            after = item.get("after")
+            if stage in allowed_stages and isinstance(after, list):
+                out["depends_on"][stage] = [str(x).strip() for x in after if str(x).strip()]
 
     # 兼容直接 map
     if not out["assignments"]:
@@ -1419,6 +4136,13 @@ def parse_dispatch_plan(text: str, allowed_stages: list, enabled_role_codes: set
     if isinstance(contract_raw, dict):
         out["acceptance_contract"] = contract_raw
 
+    deps_raw = payload.get("depends_on")
+    if isinstance(deps_raw, dict):
+        for k, v in deps_raw.items():
+            ks = str(k).strip()
+            if ks in allowed_stages and isinstance(v, list):
+                out["depends_on"][ks] = [str(x).strip() for x in v if str(x).strip()]
+
     rounds_raw = payload.get("collision_rounds")
     if isinstance(rounds_raw, (int, float, str)):
         try:
@@ -1430,7 +4154,167 @@ def parse_dispatch_plan(text: str, allowed_stages: list, enabled_role_codes: set
     return out
 
 
-def run_stage_collision(
+@lru_cache(maxsize=4096)
+def _file_digest(path: str, size: int, mtime_ns: int) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def review_verdict_key(task_id: int, kind: str, stage: str, output: str, contract_text: str, dirs) -> str:
+    """评审结论缓存键：阶段 + 归一化输出 + 产物清单（文件内容哈希）+ 验收契约。"""
+    manifest = []
+    for d in sorted(set(dirs)):
+        files = task_file_manifest(task_id, d)
+        for name in sorted(files.refresh()):
+            if not is_system_generated_output(name):
+                manifest.append([name, files.digest(name)])
+    normalized = re.sub(r"\s+", " ", output or "").strip()
+    raw = json.dumps([kind, stage, normalized, manifest, contract_text], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def verdict_cache_get(task_id: int, key: str):
+    return (task_verdict_cache.get(task_id) or {}).get(key)
+
+
+def verdict_cache_put(task_id: int, key: str, decision: dict, raw: str):
+    if task_id in task_verdict_cache:
+        task_verdict_cache[task_id][key] = {"decision": decision, "raw": raw}
+
+
+def load_review_stats(workflow: str, stage: str, role_code: str, model: str) -> dict:
+    """对抗评审与独立质控分开统计：first_pass/rounds_to_pass 只来自碰撞轮次，qc_pass 只来自独立质控调用。"""
+    with db_conn() as conn:
+        rows = conn.execute(
+            """
+            SELECT first_pass, rounds_to_pass, qc_pass FROM stage_review_history
+            WHERE workflow=? AND stage=? AND role_code=? AND model=?
+            ORDER BY id DESC LIMIT ?
+            """,
+            (workflow, stage, role_code, model or "", ADAPTIVE_REVIEW_WINDOW),
+        ).fetchall()
+    collided = [r for r in rows if r["first_pass"] is not None]
+    qc = [int(r["qc_pass"]) for r in rows if r["qc_pass"] is not None]
+    stats = {"samples": len(collided), "qcSamples": len(qc), "qcPassRate": round(sum(qc) / len(qc), 3) if qc else None}
+    n = len(collided)
+    if not n:
+        return stats
+    passed = sorted(int(r["rounds_to_pass"]) for r in collided if r["rounds_to_pass"])
+    stats.update(
+        {
+            "firstPassRate": round(sum(int(r["first_pass"]) for r in collided) / n, 3),
+            "passRate": round(len(passed) / n, 3),
+            "meanRoundsToPass": round(sum(passed) / len(passed), 2) if passed else None,
+            "p80RoundsToPass": passed[max(0, int(len(passed) * 0.8 + 0.5) - 1)] if passed else None,
+        }
+    )
+    return stats
+
+
+def choose_review_policy(workflow: str, stage: str, role_code: str, model: str, base_rounds: int) -> dict:
+    """按 (工作流, 阶段, 角色, 模型) 的历史评审结果选择对抗评审轮次与质控力度。
+    qc: standard=常规；strict=独立严格质控（不沿用对抗评审结论）；light=单轮合并评审（结论兼作质控）、独立质控抽检。"""
+    policy = {"rounds": base_rounds, "baseRounds": base_rounds, "qc": "standard", "reason": ""}
+    if not ADAPTIVE_REVIEW:
+        policy["reason"] = "自适应策略未开启"
+        return policy
+    if base_rounds <= 0:
+        policy["reason"] = "基准轮次为0（已关闭对抗评审）"
+        return policy
+    stats = load_review_stats(workflow, stage, role_code, model)
+    policy["stats"] = stats
+    n = stats.get("samples") or 0
+    qc_rate = stats["qcPassRate"] if stats["qcSamples"] >= ADAPTIVE_REVIEW_QC_MIN_SAMPLES else None
+    qc_note = f"，独立质控通过率{qc_rate:.0%}" if qc_rate is not None else ""
+    if n < ADAPTIVE_REVIEW_MIN_SAMPLES:
+        policy["reason"] = f"样本不足（{n}/{ADAPTIVE_REVIEW_MIN_SAMPLES}），沿用基准"
+    elif qc_rate is not None and qc_rate < 0.5:
+        policy["qc"] = "strict"
+        policy["rounds"] = max(1, min(base_rounds, int(stats["p80RoundsToPass"] or base_rounds)))
+        policy["reason"] = f"独立质控通过率{qc_rate:.0%}<50%，对抗评审放行的输出常被质控打回，改为严格独立质控"
+    elif stats["firstPassRate"] >= 0.9 and (qc_rate is None or qc_rate >= 0.8):
+        policy.update({"rounds": 1, "qc": "light"})
+        policy["reason"] = (
+            f"首轮通过率{stats['firstPassRate']:.0%}≥90%{qc_note}，改为单轮合并评审（结论兼作质控），"
+            f"每{ADAPTIVE_REVIEW_SPOT_CHECK}次另做1次独立质控抽检"
+        )
+    elif stats["passRate"] < 0.3:
+        policy.update({"rounds": 1, "qc": "strict"})
+        policy["reason"] = f"评审内通过率{stats['passRate']:.0%}<30%，多轮碰撞收益低，改为1轮+严格独立质控"
+    elif qc_rate is None or qc_rate < 0.8:
+        # 减少碰撞轮次的前提是放行的输出能通过独立质控；质控样本不足或通过率低时维持基准
+        policy["reason"] = (
+            f"首轮通过率{stats['firstPassRate']:.0%}{qc_note}<80%，碰撞后仍常被质控打回，不减少碰撞轮次"
+            if qc_rate is not None
+            else f"首轮通过率{stats['firstPassRate']:.0%}，独立质控样本不足（{stats['qcSamples']}/{ADAPTIVE_REVIEW_QC_MIN_SAMPLES}），不减少碰撞轮次"
+        )
+    else:
+        policy["rounds"] = max(1, min(base_rounds, int(stats["p80RoundsToPass"])))
+        policy["reason"] = f"首轮通过率{stats['firstPassRate']:.0%}{qc_note}，80%的通过发生在第{stats['p80RoundsToPass']}轮内"
+    return policy
+
+
+def record_review_outcome(task_id: int, workflow: str, stage: str, role_code: str, model: str, policy: dict, stage_audit: dict):
+    # 碰撞结论与独立质控结论分列记录：沿用碰撞结论的质控与产物规则判定不算独立质控样本
+    verdicts = [((r.get("decision") or {}).get("decision") or "") for r in stage_audit.get("collisionRecords") or []]
+    gate = stage_audit.get("qualityGate") or {}
+    qc_pass = None
+    if gate.get("raw") and not gate.get("fusedFromCollisionRound") and not gate.get("autoRule"):
+        qc_pass = 1 if (gate.get("decision") or {}).get("decision") == "PASS" else 0
+    if not verdicts and qc_pass is None:
+        return
+    rounds_to_pass = verdicts.index("PASS") + 1 if "PASS" in verdicts else None
+    with db_conn() as conn:
+        conn.execute(
+            """
+            INSERT INTO stage_review_history(
+                task_id, run_id, workflow, stage, role_code, model, rounds_budget, rounds_used,
+                first_pass, rounds_to_pass, qc_decision, qc_pass, policy, created_at
+            ) VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+            """,
+            (
+                task_id,
+                task_run_context.get(task_id) or "",
+                workflow,
+                stage,
+                role_code,
+                model or "",
+                int(policy.get("rounds") or 0),
+                len(stage_audit.get("collisionRecords") or []),
+                (1 if verdicts[0] == "PASS" else 0) if verdicts else None,
+                rounds_to_pass,
+                (gate.get("decision") or {}).get("decision") or "",
+                qc_pass,
+                policy.get("qc") or "",
+                now_str(),
+            ),
+        )
+
+
+# 对抗评审与阶段质控共用的评审结论格式
+STAGE_REVIEW_SCHEMA = '{"decision":"PASS|FAIL","reason":"...","issues":["..."],"send_back_role":"当前角色code","rework_instructions":"..."}'
+
+
+def review_delta(previous: str, current: str) -> str:
+    """上一版与当前版的 unified diff，只保留变更块及少量上下文。"""
+    diff = difflib.unified_diff((previous or "").splitlines(), (current or "").splitlines(), "上一版", "当前版", n=2, lineterm="")
+    return "\n".join(diff)
+
+
+def pick_delta(previous: str, current: str):
+    """差异明显短于全文时返回 diff，否则返回 None（沿用全文）。"""
+    if not DELTA_REVIEW or previous is None:
+        return None
+    delta = review_delta(previous, current)
+    if not delta or estimate_tokens(delta) > estimate_tokens(current) * 0.6:
+        return None
+    return delta
+
+
+async def run_stage_collision(
     task_id: int,
     stage: str,
     role,
@@ -1444,6 +4328,7 @@ def run_stage_collision(
     input_dir: str,
     output_dir: str,
     rounds: int,
+    artifacts_fn=None,
 ):
     if not reviewer_role or rounds <= 0:
         return current_output, [], []
@@ -1452,37 +4337,60 @@ def run_stage_collision(
     output = current_output
     extra_tool_events = []
     collision_records = []
+    # 增量修订：第2轮起修订提示词只发当前输出相对上一轮修订基线的 diff（全文落盘到 review_versions/）；
+    # 评审方每轮都收到全文——评审无工具、无法回读文件，只看 diff 不足以可靠判断
+    revised_from = None
+    versions_dir = os.path.join(base_dir, "review_versions")
+    slug = re.sub(r"[^\w\u4e00-\u9fff-]+", "_", stage or "stage")[:40]
 
     for i in range(1, rounds + 1):
         ensure_not_stopped(task_id)
         review_stage = f"{stage}-对抗评审"
         review_prompt = (
             "你是对抗评审角色。目标不是复述，而是找出当前输出离‘可验收交付’还差什么。"
-            "请严格返回 JSON："
-            '{"decision":"PASS|FAIL","reason":"...","issues":["..."],"send_back_role":"当前角色code","rework_instructions":"..."}'
-            "。FAIL 时必须给出可执行修改要求。\n"
+            + ("本轮结论同时作为本阶段质控结论：PASS 即视为该阶段验收通过。" if artifacts_fn else "")
+            + "请严格返回 JSON："
+            + STAGE_REVIEW_SCHEMA
+            + "。FAIL 时必须给出可执行修改要求。\n"
             f"任务目标：{sections.get('task') or ''}\n"
             f"期望交付：{sections.get('delivery') or ''}\n"
             f"{contract_text}\n\n"
             f"当前阶段输出：\n{output}\n"
+            + (f"\n当前可验收产物（非系统生成）：{artifacts_fn()}\n" if artifacts_fn else "")
         )
-        review_msgs = [
-            {"role": "system", "content": (reviewer_role["system_prompt"] or "你是严苛评审。")},
-            {"role": "user", "content": review_prompt},
-        ]
-        save_role_message(task_id, reviewer_code, review_stage, "user", review_prompt)
-        review_output = call_role_llm(reviewer_role, review_msgs)
-        save_role_message(task_id, reviewer_code, review_stage, "assistant", review_output)
-        decision = parse_verifier_feedback(review_output)
+        version_path = ""
+        if DELTA_REVIEW:
+            os.makedirs(versions_dir, exist_ok=True)
+            version_path = os.path.join(versions_dir, f"{slug}_r{i}.md")
+            await write_text_async(version_path, output)
+        verdict_key = review_verdict_key(task_id, "collision", stage, output, contract_text, [output_dir])
+        cached = verdict_cache_get(task_id, verdict_key)
+        if cached:
+            review_output, decision = cached["raw"], cached["decision"]
+        else:
+            review_msgs = [
+                {"role": "system", "content": (reviewer_role["system_prompt"] or "你是严苛评审。")},
+                {"role": "user", "content": review_prompt},
+            ]
+            await db_write(save_role_message, task_id, reviewer_code, review_stage, "user", review_prompt)
+            review_output = await call_role_llm(reviewer_role, review_msgs, task_id=task_id, stage=review_stage)
+            await db_write(save_role_message, task_id, reviewer_code, review_stage, "assistant", review_output)
+            decision = parse_verifier_feedback(review_output)
+            verdict_cache_put(task_id, verdict_key, decision, review_output)
         dec = decision.get("decision", "UNKNOWN")
 
         collision_item = {
             "round": i,
             "reviewer": reviewer_code,
             "decision": decision,
+            "raw": review_output,
         }
+        if version_path:
+            collision_item["versionFile"] = os.path.relpath(version_path, base_dir)
+        if cached:
+            collision_item["verdictCache"] = "hit"
         collision_records.append(collision_item)
-        append_log(task_id, f"[{reviewer_code}] 对抗评审 第{i}/{rounds}轮：{dec} | reason={decision.get('reason','')[:120]}")
+        await db_write(append_log, task_id, f"[{reviewer_code}] 对抗评审 第{i}/{rounds}轮：{dec}{'（提交未变，沿用缓存结论）' if cached else ''} | reason={decision.get('reason','')[:120]}")
 
         if dec == "PASS":
             break
@@ -1497,25 +4405,40 @@ def run_stage_collision(
             f"{contract_text}"
         )
 
-        history = load_role_messages(task_id, role["code"], limit=ROLE_HISTORY_LIMIT)
-        msgs = [{"role": "system", "content": (role["system_prompt"] or f"你是{role['code']}") }]
-        for h in history:
-            turn = (h["turn"] or "").strip().lower()
-            if turn in ("user", "assistant", "system"):
-                msgs.append({"role": turn, "content": h["content"] or ""})
-        revise_prompt = (
+        revise_head = (
             f"你当前负责阶段：{stage}\n"
             f"任务描述：{sections.get('task') or ''}\n"
             f"期望交付：{sections.get('delivery') or ''}\n"
-            f"上一个阶段输出（可忽略）：\n{previous_output}\n\n"
-            f"返工/交接说明（可忽略）：\n{handoff_note}\n\n"
-            f"当前阶段已有输出：\n{output}\n\n"
-            f"本轮挑战与修改要求：\n{revise_instruction}"
         )
-        msgs.append({"role": "user", "content": revise_prompt})
-        save_role_message(task_id, role["code"], stage, "user", revise_prompt)
+        full_revise = (
+            revise_head
+            + f"上一个阶段输出（可忽略）：\n{previous_output}\n\n"
+            + f"返工/交接说明（可忽略）：\n{handoff_note}\n\n"
+            + f"当前阶段已有输出：\n{output}\n\n"
+            + f"本轮挑战与修改要求：\n{revise_instruction}"
+        )
+        revise_delta = pick_delta(revised_from, output)
+        if revise_delta:
+            # 上一阶段输出与交接说明在第1轮修订时已发送且未变化；当前输出只发相对上轮修订基线的 diff
+            revise_prompt = (
+                revise_head
+                + "上一个阶段输出、返工/交接说明：同第1轮修订，未变化。\n\n"
+                + f"当前阶段已有输出（相对上一轮修订基线的差异，全文见 {version_path}）：\n```diff\n{revise_delta}\n```\n\n"
+                + f"本轮挑战与修改要求：\n{revise_instruction}"
+            )
+        else:
+            revise_prompt = full_revise
+        revised_from = output
+        collision_item["revisePrompt"] = {
+            "mode": "delta" if revise_delta else "full",
+            "tokens": estimate_tokens(revise_prompt),
+            "fullTokens": estimate_tokens(full_revise),
+        }
+        msgs, compaction = build_role_messages(task_id, role, (role["system_prompt"] or f"你是{role['code']}"), revise_prompt)
+        collision_item["promptCompaction"] = compaction
+        await db_write(save_role_message, task_id, role["code"], stage, "user", revise_prompt)
 
-        new_output, new_tools = run_role_stage_with_tools(
+        new_output, new_tools = await run_role_stage_with_tools(
             task_id=task_id,
             stage=stage,
             role=role,
@@ -1529,14 +4452,15 @@ def run_stage_collision(
         extra_tool_events.extend(new_tools)
         collision_item["toolEvents"] = new_tools
         collision_item["revisedChars"] = len(new_output)
-        append_log(task_id, f"[{role['code']}] 对抗评审后修订完成（第{i}/{rounds}轮），输出长度={len(new_output)}")
+        await db_write(append_log, task_id, f"[{role['code']}] 对抗评审后修订完成（第{i}/{rounds}轮），输出长度={len(new_output)}")
 
     return output, extra_tool_events, collision_records
 
 
-def run_multi_agent_workflow(task_id: int, task, wf, base_dir: str, input_dir: str, output_dir: str):
+async def run_multi_agent_workflow(task_id: int, task, wf, base_dir: str, input_dir: str, output_dir: str, checkpoint: dict = None):
     stages = parse_stages(wf["stages_json"])
     stage_roles = parse_stage_roles(wf["stage_roles_json"])
+    stage_deps = parse_stage_deps(wf["stages_json"])
     if not stages:
         raise RuntimeError("工作流没有配置阶段")
 
@@ -1556,10 +4480,19 @@ def run_multi_agent_workflow(task_id: int, task, wf, base_dir: str, input_dir: s
     active_stage_set = set(stages)
     acceptance_contract = build_default_acceptance_contract(task["title"] or "", sections)
     collision_rounds = ROLE_CROSS_REVIEW_ROUNDS
+    token_budget = task_token_budget(task, wf)
+    budget_degraded = False
+    # 截止时间已由 _execute_task 登记（计时从运行开始）
+    deadline_sec = task_deadline_sec(task, wf)
+    deadline_degraded = False
+    deadline_hit = None
+    task_tool_limits[task_id] = workflow_tool_limits(wf)
     last_execution_output = ""
     last_execution_stage = ""
     last_execution_role = ""
     lead_acceptance_result = None
+    branch_outputs = {}
+    rework_only = set()
 
     audit = {
         "taskId": task_id,
@@ -1571,36 +4504,108 @@ def run_multi_agent_workflow(task_id: int, task, wf, base_dir: str, input_dir: s
         "dynamicAssignments": {},
         "acceptanceContract": acceptance_contract,
         "collisionRounds": collision_rounds,
+        "tokenBudget": token_budget,
+        "deadlineSec": deadline_sec,
+        "toolLimits": task_limits(task_id),
+        "stageDeps": stage_deps,
+        "parallelGroups": [],
         "startedAt": now_str(),
     }
+    if SPECULATIVE_STAGES:
+        audit["speculation"] = {"attempts": 0, "hits": 0, "rollbacks": 0, "hitRate": None, "savedSec": 0.0, "events": []}
+    speculated = None
+
+    if checkpoint:
+        # 断点恢复：还原已提交阶段之后的引擎状态，已完成阶段不再调用模型
+        state = checkpoint["state"]
+        stage_idx = checkpoint["stageIdx"]
+        stage_roles = state["stageRoles"]
+        stage_deps = state["stageDeps"]
+        acceptance_contract = state["acceptanceContract"]
+        collision_rounds = state["collisionRounds"]
+        active_stage_set = set(state["activeStages"])
+        previous_output = state["previousOutput"]
+        handoff_note = state["handoffNote"]
+        rework_round = state["reworkRound"]
+        stage_retry_counts.update(state["stageRetryCounts"])
+        execution_no = state["executionNo"]
+        budget_degraded = state["budgetDegraded"]
+        last_execution_output = state["lastExecutionOutput"]
+        last_execution_stage = state["lastExecutionStage"]
+        last_execution_role = state["lastExecutionRole"]
+        lead_acceptance_result = state["leadAcceptanceResult"]
+        branch_outputs = {k: tuple(v) for k, v in state["branchOutputs"].items()}
+        audit = state["audit"]
+        audit.setdefault("resumes", []).append(
+            {"fromStage": checkpoint["stage"], "stageIdx": stage_idx, "checkpointAt": checkpoint["createdAt"], "resumedAt": now_str()}
+        )
+        if SPECULATIVE_STAGES and "speculation" not in audit:
+            audit["speculation"] = {"attempts": 0, "hits": 0, "rollbacks": 0, "hitRate": None, "savedSec": 0.0, "events": []}
 
-    while stage_idx < len(stages):
-        iterations += 1
-        if iterations > max_iterations:
-            raise RuntimeError(f"超过最大迭代限制（{max_iterations}），已自动终止避免循环")
-
-        ensure_not_stopped(task_id)
-        stage = stages[stage_idx]
-
-        # 动态分发后可跳过非必要阶段
-        if (stage_idx > 0) and (stage not in active_stage_set):
-            append_log(task_id, f"[Lead Agent] 跳过阶段{stage_idx+1}：{stage}（本轮未分配）")
-            audit["stages"].append(
-                {
-                    "executionNo": None,
-                    "index": stage_idx + 1,
-                    "stage": stage,
-                    "role": stage_roles.get(stage) or "-",
-                    "model": "-",
-                    "status": "SKIPPED",
-                    "reason": "动态分发未纳入本轮执行",
-                    "finishedAt": now_str(),
-                }
-            )
-            stage_idx += 1
-            continue
-
-        role_code = stage_roles.get(stage) or (wf["default_assignee"] or "") or (task["assignee"] or "Lead Agent")
+    async def checkpoint_stage(next_idx: int):
+        # 状态在事件循环上序列化成快照（推测执行的协程可能同时修改 audit），落库与产物清单扫描交给写入器线程
+        state_json = json.dumps(
+            {
+                "stageRoles": stage_roles,
+                "stageDeps": stage_deps,
+                "acceptanceContract": acceptance_contract,
+                "collisionRounds": collision_rounds,
+                "activeStages": sorted(active_stage_set),
+                "previousOutput": previous_output,
+                "handoffNote": handoff_note,
+                "reworkRound": rework_round,
+                "stageRetryCounts": stage_retry_counts,
+                "executionNo": execution_no,
+                "budgetDegraded": budget_degraded,
+                "lastExecutionOutput": last_execution_output,
+                "lastExecutionStage": last_execution_stage,
+                "lastExecutionRole": last_execution_role,
+                "leadAcceptanceResult": lead_acceptance_result,
+                "branchOutputs": branch_outputs,
+                "audit": audit,
+            },
+            ensure_ascii=False,
+        )
+        await db_write(save_checkpoint, task_id, next_idx, stages, state_json, output_dir)
+
+    def stage_role_code(idx: int) -> str:
+        return stage_roles.get(stages[idx]) or (wf["default_assignee"] or "") or (task["assignee"] or "Lead Agent")
+
+    def is_execution_stage(idx: int) -> bool:
+        return stage_modes(stages[idx], idx, stage_role_code(idx)) == (False, False, False)
+
+    def parallel_group_at(idx: int) -> list:
+        # 从 idx 起连续的执行阶段中，互不依赖且角色不同的阶段组成一个并行组
+        if not PARALLEL_STAGES or not is_execution_stage(idx):
+            return [idx]
+        group = [idx]
+        roles = {stage_role_code(idx)}
+        for j in range(idx + 1, len(stages)):
+            st = stages[j]
+            if st not in active_stage_set or not is_execution_stage(j) or stage_role_code(j) in roles:
+                break
+            deps = stage_deps.get(st) if st in stage_deps else [stages[j - 1]]
+            if any(stages[g] in deps for g in group):
+                break
+            group.append(j)
+            roles.add(stage_role_code(j))
+        return group
+
+    def group_containing(idx: int) -> list:
+        found = [idx]
+        for start in range(idx, -1, -1):
+            g = parallel_group_at(start)
+            if idx not in g:
+                break
+            found = g
+        return found
+
+    async def run_stage_attempt(
+        idx: int, prev_output: str, note: str, stage_output_dir: str, stage_file_dir: str = "", defer_qc: bool = False, speculative: bool = False
+    ):
+        nonlocal execution_no, acceptance_contract, collision_rounds, active_stage_set
+        stage = stages[idx]
+        role_code = stage_role_code(idx)
         role = get_role_by_code(role_code)
         if not role:
             raise RuntimeError(f"阶段 {stage} 找不到角色: {role_code}")
@@ -1608,21 +4613,16 @@ def run_multi_agent_workflow(task_id: int, task, wf, base_dir: str, input_dir: s
             raise RuntimeError(f"阶段 {stage} 角色未启用: {role_code}")
 
         stage_retry = stage_retry_counts.get(stage, 0)
-        append_log(task_id, f"[Lead Agent] 阶段{stage_idx+1}/{len(stages)}：{stage} -> {role_code}（返工轮次={rework_round}，本阶段重试={stage_retry}/{max_stage_review_retries}）")
+        execution_no += 1
+        exec_no = execution_no
+        llm_round_ctx.set(exec_no)
+        await db_write(append_log, task_id, f"[Lead Agent] 阶段{idx+1}/{len(stages)}：{stage} -> {role_code}（返工轮次={rework_round}，本阶段重试={stage_retry}/{max_stage_review_retries}）")
 
-        history = load_role_messages(task_id, role_code, limit=ROLE_HISTORY_LIMIT)
         sys_prompt = (role["system_prompt"] or "").strip()
         if not sys_prompt:
             sys_prompt = f"你是{role['name']}（{role['code']}），职责：{role['description'] or '完成被分配阶段并输出可执行结果'}。"
 
-        verifier_mode = is_verifier_stage(stage, role_code)
-        dispatch_stage = ("分发" in stage) or (stage_idx == 0 and any(k in stage for k in ["评估", "拆解", "规划"]))
-        lead_dispatch_mode = bool(dispatch_stage)
-        lead_acceptance_mode = (
-            role_code == "Lead Agent"
-            and (not lead_dispatch_mode)
-            and any(k in stage for k in ["联合交付", "验收", "交付"])
-        )
+        verifier_mode, lead_dispatch_mode, lead_acceptance_mode = stage_modes(stage, idx, role_code)
         if verifier_mode:
             stage_instruction = (
                 "你只负责当前复核阶段，不负责开发实现。请严格依据任务要求判定是否通过。"
@@ -1635,10 +4635,11 @@ def run_multi_agent_workflow(task_id: int, task, wf, base_dir: str, input_dir: s
                 "你是当前总控分发阶段：先评估需求复杂度、阻塞风险与执行成本，再按后续角色分发任务。"
                 "请输出“分发清单”，至少包含：角色、该角色目标、输入、输出、验收标准。"
                 "不要替执行角色完成实现，只做评估、拆解和分发。"
-                "并在结尾附上 JSON（assignments + active_stages + acceptance_contract + collision_rounds）用于动态分发，例如："
-                '{"assignments":[{"stage":"前端实现","role":"frontend"},{"stage":"后端实现","role":"backend"}],"active_stages":["前端实现","后端实现","复核","联合交付"],"skip_stages":[],"acceptance_contract":{"must_answer":["必须回答的问题"],"evidence_requirements":["证据要求"],"delivery_form":"交付形式不限"},"collision_rounds":3}'
+                "并在结尾附上 JSON（assignments + active_stages + acceptance_contract + collision_rounds + depends_on）用于动态分发，例如："
+                '{"assignments":[{"stage":"前端实现","role":"frontend"},{"stage":"后端实现","role":"backend"}],"active_stages":["前端实现","后端实现","复核","联合交付"],"skip_stages":[],"acceptance_contract":{"must_answer":["必须回答的问题"],"evidence_requirements":["证据要求"],"delivery_form":"交付形式不限"},"collision_rounds":3,"depends_on":{"前端实现":[],"后端实现":[]}}'
                 "。stage 必须是现有阶段名，role 必须是可用角色 code。"
                 "若某阶段本轮不需要执行，请明确写入 skip_stages。"
+                "depends_on 声明阶段依赖（空列表表示只依赖本分发阶段），互不依赖的执行阶段会并行执行；后一阶段需要前一阶段结果时请写明依赖。"
                 "acceptance_contract 只定义验收维度，不要写死具体文件名。"
             )
         elif lead_acceptance_mode:
@@ -1660,10 +4661,19 @@ def run_multi_agent_workflow(task_id: int, task, wf, base_dir: str, input_dir: s
                 "如果任务涉及爬取/采集/关键词/文包，必须通过 run_command 产出真实文件到 $TASK_OUTPUT_DIR。"
                 "如果需要实际执行工具/脚本，请只输出 JSON："
                 '{"action":"run_command","command":"python3 scripts/xxx.py ...","reason":"为什么要执行"}'
-                "。系统会执行后把结果回传给你。"
+                "。系统会执行后回传结果摘要（返回码/耗时/首尾输出/错误行/新增文件）与完整输出句柄，"
+                '需要细看时可返回 {"action":"read_tool_output","handle":"句柄","offset":0,"limit":4000}。'
+                "需要同时执行多条命令时，可一次返回 "
+                '{"action":"run_commands","commands":[{"id":"a","command":"..."},{"id":"b","command":"..."},{"id":"c","command":"...","after":["a"]}],"reason":"..."}'
+                "，互不依赖的命令并发执行，after 中的命令成功后才执行依赖它的命令，全部结果一次回传。"
                 "当阶段完成时，请输出 JSON："
                 '{"action":"final","content":"你的阶段交付内容"}'
             )
+            if TOOL_CACHE:
+                stage_instruction += (
+                    "相同命令与输入的成功执行结果会直接复用缓存（产物原样还原）；"
+                    '需要重新抓取最新数据时，在 run_command JSON 中加 "refresh": true，或用 "ttl": 秒数 限定可接受的缓存时效。'
+                )
 
         task_text_all = "\n".join([
             sections.get("task") or "",
@@ -1689,93 +4699,110 @@ def run_multi_agent_workflow(task_id: int, task, wf, base_dir: str, input_dir: s
             f"任务描述：{sections.get('task') or task['description'] or ''}\n"
             f"期望交付：{sections.get('delivery') or ''}\n"
             f"补充说明：{sections.get('extra') or ''}\n"
-            f"上一个阶段输出（若为空可忽略）：\n{previous_output}\n\n"
-            f"返工/交接说明（若为空可忽略）：\n{handoff_note}\n\n"
+            f"上一个阶段输出（若为空可忽略）：\n{prev_output}\n\n"
+            f"返工/交接说明（若为空可忽略）：\n{note}\n\n"
             f"{contract_text}\n\n"
             f"阶段规则：{stage_instruction}"
             f"{command_hint}"
         )
 
-        messages = [{"role": "system", "content": sys_prompt}]
-        for h in history:
-            turn = (h["turn"] or "").strip().lower()
-            if turn in ("user", "assistant", "system"):
-                messages.append({"role": turn, "content": h["content"] or ""})
-        messages.append({"role": "user", "content": user_prompt})
+        messages, prompt_compaction = build_role_messages(task_id, role, sys_prompt, user_prompt)
+
+        def current_files() -> dict:
+            return manifest_snapshot(task_id, [stage_output_dir, output_dir])
+
+        def artifact_files(files: dict) -> list:
+            # 空文件不算可验收产物
+            return [x for x in sorted(files) if files[x][0] > 0 and not is_system_generated_output(x)]
 
-        stage_files_before = list_output_file_names(output_dir)
+        stage_files_before = current_files()
+        stage_llm_mark = len(task_llm_calls.get(task_id) or [])
         stage_started_at = now_str()
         stage_t0 = time.perf_counter()
-        save_role_message(task_id, role_code, stage, "user", user_prompt)
-        output, tool_events = run_role_stage_with_tools(
+        await db_write(save_role_message, task_id, role_code, stage, "user", user_prompt)
+        output, tool_events = await run_role_stage_with_tools(
             task_id=task_id,
             stage=stage,
             role=role,
             messages=messages,
             base_dir=base_dir,
             input_dir=input_dir,
-            output_dir=output_dir,
+            output_dir=stage_output_dir,
             max_tool_rounds=ROLE_MAX_TOOL_ROUNDS,
         )
-        stage_duration_sec = round(time.perf_counter() - stage_t0, 2)
-        stage_files_after = list_output_file_names(output_dir)
-        produced_files = sorted(list(stage_files_after - stage_files_before))
+        stage_files_after = current_files()
+        file_changes = diff_file_manifests(stage_files_before, stage_files_after)
+        produced_files = changed_files(file_changes)
         produced_non_system = [x for x in produced_files if not is_system_generated_output(x)]
-        existing_non_system = [x for x in sorted(stage_files_after) if not is_system_generated_output(x)]
+        existing_non_system = artifact_files(stage_files_after)
 
-        execution_no += 1
         stage_file = os.path.join(
-            output_dir,
-            f"步骤{execution_no}_阶段{stage_idx+1}_{stage}_{role_code.replace('@', 'at_').replace(' ', '_')}.md",
+            stage_file_dir or output_dir,
+            f"步骤{exec_no}_阶段{idx+1}_{stage}_{role_code.replace('@', 'at_').replace(' ', '_')}.md",
         )
-        with open(stage_file, "w", encoding="utf-8") as f:
-            f.write(f"# 步骤{execution_no}｜阶段{stage_idx+1}：{stage}\n\n")
-            f.write(f"角色：{role['name']}（{role['code']}）\n")
-            f.write(f"返工轮次：{rework_round}\n\n")
-            f.write(output + "\n")
+        await write_text_async(
+            stage_file,
+            f"# 步骤{exec_no}｜阶段{idx+1}：{stage}\n\n"
+            f"角色：{role['name']}（{role['code']}）\n"
+            f"返工轮次：{rework_round}\n\n"
+            f"{output}\n",
+        )
+        touch_task_files(task_id)
 
         stage_audit = {
-            "executionNo": execution_no,
-            "index": stage_idx + 1,
+            "executionNo": exec_no,
+            "index": idx + 1,
             "stage": stage,
             "role": role_code,
             "model": role["default_model"],
             "reworkRound": rework_round,
             "startedAt": stage_started_at,
-            "durationSec": stage_duration_sec,
+            "durationSec": round(time.perf_counter() - stage_t0, 2),
             "toolEvents": tool_events,
             "producedFiles": produced_files,
+            "fileChanges": file_changes,
             "producedNonSystemFiles": produced_non_system,
             "existingNonSystemFiles": existing_non_system,
             "outputFile": os.path.basename(stage_file),
             "outputChars": len(output),
+            "promptCompaction": prompt_compaction,
             "finishedAt": now_str(),
         }
 
         # 动态分发：Lead 在“需求接收与分发”阶段可动态改写后续阶段角色 + 阶段激活计划
         if lead_dispatch_mode:
-            allowed_following_stages = stages[stage_idx + 1 :]
+            allowed_following_stages = stages[idx + 1 :]
             plan = parse_dispatch_plan(output, allowed_following_stages, enabled_role_codes)
             dynamic = plan.get("assignments") or {}
             if dynamic:
                 stage_roles.update(dynamic)
                 audit["dynamicAssignments"].update(dynamic)
                 stage_audit["dynamicAssignments"] = dynamic
-                append_log(task_id, f"[Lead Agent] 动态分发生效：{json.dumps(dynamic, ensure_ascii=False)}")
+                await db_write(append_log, task_id, f"[Lead Agent] 动态分发生效：{json.dumps(dynamic, ensure_ascii=False)}")
 
             contract_raw = plan.get("acceptance_contract")
             if isinstance(contract_raw, dict):
                 acceptance_contract = normalize_acceptance_contract(contract_raw, task["title"] or "", sections)
                 audit["acceptanceContract"] = acceptance_contract
                 stage_audit["acceptanceContract"] = acceptance_contract
-                append_log(task_id, "[Lead Agent] 已更新任务验收契约（动态生成）")
+                await db_write(append_log, task_id, "[Lead Agent] 已更新任务验收契约（动态生成）")
 
             rounds_raw = plan.get("collision_rounds")
             if isinstance(rounds_raw, int):
                 collision_rounds = max(0, min(6, rounds_raw))
                 audit["collisionRounds"] = collision_rounds
                 stage_audit["collisionRounds"] = collision_rounds
-                append_log(task_id, f"[Lead Agent] 已设置角色碰撞轮次：{collision_rounds}")
+                await db_write(append_log, task_id, f"[Lead Agent] 已设置角色碰撞轮次：{collision_rounds}")
+
+            deps_raw = plan.get("depends_on") or {}
+            if deps_raw:
+                for st, deps in deps_raw.items():
+                    pos = stages.index(st)
+                    # 空依赖表示只依赖分发阶段本身
+                    stage_deps[st] = [d for d in deps if d in stages[:pos]] or [stage]
+                audit["stageDeps"] = stage_deps
+                stage_audit["stageDeps"] = deps_raw
+                await db_write(append_log, task_id, f"[Lead Agent] 已更新阶段依赖：{json.dumps(deps_raw, ensure_ascii=False)}")
 
             active_stages = plan.get("active_stages")
             if isinstance(active_stages, list):
@@ -1799,70 +4826,100 @@ def run_multi_agent_workflow(task_id: int, task, wf, base_dir: str, input_dir: s
                         preferred = exec_candidates[0]
                     active_final = list(dict.fromkeys(active_final + [preferred]))
                     stage_audit["autoAddedExecutionStage"] = preferred
-                    append_log(task_id, f"[Lead Agent] 检测到执行阶段被全部跳过，已自动补回：{preferred}")
+                    await db_write(append_log, task_id, f"[Lead Agent] 检测到执行阶段被全部跳过，已自动补回：{preferred}")
 
                 active_stage_set = {stages[0], *active_final}
                 skipped = [s for s in allowed_following_stages if s not in active_stage_set]
                 stage_audit["activeStages"] = active_final
                 stage_audit["skippedStages"] = skipped
-                append_log(task_id, f"[Lead Agent] 阶段执行计划：active={active_final} | skipped={skipped}")
+                await db_write(append_log, task_id, f"[Lead Agent] 阶段执行计划：active={active_final} | skipped={skipped}")
             elif not dynamic:
-                append_log(task_id, "[Lead Agent] 未解析到有效动态分发JSON，沿用工作流默认分配")
+                await db_write(append_log, task_id, "[Lead Agent] 未解析到有效动态分发JSON，沿用工作流默认分配")
+
+        # 自适应评审策略：按历史首轮通过率/通过轮次决定本阶段碰撞轮次与质控力度
+        review_policy = None
+        stage_rounds = collision_rounds
+        light_review = False
+        if (not verifier_mode) and (not lead_dispatch_mode) and (not lead_acceptance_mode):
+            review_policy = choose_review_policy(wf["code"], stage, role_code, role["default_model"] or "", collision_rounds)
+            stage_rounds = review_policy["rounds"]
+            light_review = review_policy["qc"] == "light"
+            stage_audit["reviewPolicy"] = review_policy
+            if ADAPTIVE_REVIEW and collision_rounds > 0:
+                await db_write(append_log, task_id, f"[Lead Agent] 自适应评审策略：{stage}/{role_code} 碰撞轮次 {collision_rounds}→{stage_rounds}，质控={review_policy['qc']}（{review_policy['reason']}）")
 
         # 多角色碰撞：执行阶段先做 reviewer 对抗评审，再由当前角色修订（可多轮）
-        if (not verifier_mode) and (not lead_dispatch_mode) and (not lead_acceptance_mode) and collision_rounds > 0:
+        if (not verifier_mode) and (not lead_dispatch_mode) and (not lead_acceptance_mode) and stage_rounds > 0 and not (budget_degraded or deadline_degraded):
             reviewer_role, reviewer_code = get_reviewer_role()
             if reviewer_role and int(reviewer_role["enabled"] or 0) == 1:
-                output, extra_tools, collision_records = run_stage_collision(
+                output, extra_tools, collision_records = await run_stage_collision(
                     task_id=task_id,
                     stage=stage,
                     role=role,
                     reviewer_role=reviewer_role,
                     sections=sections,
                     contract_text=contract_text,
-                    previous_output=previous_output,
-                    handoff_note=handoff_note,
+                    previous_output=prev_output,
+                    handoff_note=note,
                     current_output=output,
                     base_dir=base_dir,
                     input_dir=input_dir,
-                    output_dir=output_dir,
-                    rounds=collision_rounds,
+                    output_dir=stage_output_dir,
+                    rounds=stage_rounds,
+                    artifacts_fn=(lambda: artifact_files(current_files())) if FUSED_REVIEW or light_review else None,
                 )
                 if extra_tools:
                     tool_events.extend(extra_tools)
                     stage_audit["toolEvents"] = tool_events
                 if collision_records:
                     stage_audit["collisionRecords"] = collision_records
+                    prompts = [r["revisePrompt"] for r in collision_records if "revisePrompt" in r]
+                    sent, full = sum(p["tokens"] for p in prompts), sum(p["fullTokens"] for p in prompts)
+                    if full > sent:
+                        stage_audit["deltaReview"] = {"sentTokens": sent, "fullTokens": full, "savedTokens": full - sent}
+                        await db_write(append_log, task_id, f"[Lead Agent] 增量修订：修订提示词 {full}→{sent} tokens（节省 {full - sent}）")
 
                 # 碰撞轮次后重新计算产物与输出统计
-                stage_files_after = list_output_file_names(output_dir)
-                produced_files = sorted(list(stage_files_after - stage_files_before))
+                stage_files_after = current_files()
+                file_changes = diff_file_manifests(stage_files_before, stage_files_after)
+                produced_files = changed_files(file_changes)
                 produced_non_system = [x for x in produced_files if not is_system_generated_output(x)]
-                existing_non_system = [x for x in sorted(stage_files_after) if not is_system_generated_output(x)]
+                existing_non_system = artifact_files(stage_files_after)
                 stage_audit["producedFiles"] = produced_files
+                stage_audit["fileChanges"] = file_changes
                 stage_audit["producedNonSystemFiles"] = produced_non_system
                 stage_audit["existingNonSystemFiles"] = existing_non_system
                 stage_audit["outputChars"] = len(output)
 
-                with open(stage_file, "w", encoding="utf-8") as f:
-                    f.write(f"# 步骤{execution_no}｜阶段{stage_idx+1}：{stage}\n\n")
-                    f.write(f"角色：{role['name']}（{role['code']}）\n")
-                    f.write(f"返工轮次：{rework_round}\n")
-                    f.write(f"对抗评审轮次：{len(collision_records)}\n\n")
-                    f.write(output + "\n")
+                await write_text_async(
+                    stage_file,
+                    f"# 步骤{exec_no}｜阶段{idx+1}：{stage}\n\n"
+                    f"角色：{role['name']}（{role['code']}）\n"
+                    f"返工轮次：{rework_round}\n"
+                    f"对抗评审轮次：{len(collision_records)}\n\n"
+                    f"{output}\n",
+                )
+                touch_task_files(task_id)
 
-        # 每个执行角色完成后都做阶段质控（由 reviewer 复核）
+        # 每个执行角色完成后都做阶段质控（由 reviewer 复核）；需要调用 reviewer 时 qc_call 为待执行的质控协程
+        quality = None
+        qc_call = None
         if (not verifier_mode) and (not lead_dispatch_mode) and (not lead_acceptance_mode):
             auto_fail_reason = ""
-            if tool_events and all(int(e.get("rc", 1)) != 0 for e in tool_events):
+            if tool_events and all(e.get("rc") != 0 for e in tool_events):
                 auto_fail_reason = "执行了工具命令但全部失败（rc非0），请先修复命令/环境后再提交。"
 
             needs_artifacts = task_requires_real_artifacts(task_text_all)
             if (not auto_fail_reason) and needs_artifacts and (stage in ["执行", "采集", "开发", "文包", "交付", "联合交付"]) and len(existing_non_system) == 0:
-                auto_fail_reason = "任务要求包含可验收产物（爬取/关键词/文包等），但当前输出目录无可验收真实文件。"
-
-            quality = None
-            review_output = ""
+                auto_fail_reason = "任务要求包含可验收产物（爬取/关键词/文包等），但当前输出目录无可验收真实文件（空文件不计）。"
+                if file_changes["deleted"]:
+                    auto_fail_reason += f"本阶段删除了：{file_changes['deleted']}。"
+
+            last_review = (stage_audit.get("collisionRecords") or [{}])[-1]
+            fused_pass = (FUSED_REVIEW or light_review) and (last_review.get("decision") or {}).get("decision") == "PASS"
+            qc_mode = (review_policy or {}).get("qc") or "standard"
+            # light 模式下合并评审通过后，每 ADAPTIVE_REVIEW_SPOT_CHECK 次仍做一次独立质控，用于校准质控通过率
+            spot_check = light_review and (task_id + exec_no) % ADAPTIVE_REVIEW_SPOT_CHECK == 0
             if auto_fail_reason:
                 quality = {
                     "decision": "FAIL",
@@ -1872,150 +4929,456 @@ def run_multi_agent_workflow(task_id: int, task, wf, base_dir: str, input_dir: s
                     "rework_instructions": "请通过 run_command 真实执行并产出文件到 $TASK_OUTPUT_DIR，再提交 final。",
                 }
                 stage_audit["qualityGate"] = {"raw": "", "decision": quality, "autoRule": "artifact_or_tool_guard"}
-                append_log(task_id, f"[reviewer] 阶段质控结论：FAIL | stage={stage} | reason={auto_fail_reason}")
+                await db_write(append_log, task_id, f"[reviewer] 阶段质控结论：FAIL | stage={stage} | reason={auto_fail_reason}")
+            elif deadline_degraded:
+                quality = {"decision": "SKIP", "reason": "任务临近截止时间，跳过阶段质控"}
+                stage_audit["qualityGate"] = {"decision": quality, "policy": "deadline"}
+                await db_write(append_log, task_id, f"[Lead Agent] 阶段质控：SKIP（{quality['reason']}）| stage={stage}")
+            elif fused_pass and qc_mode != "strict" and not spot_check:
+                # 合并评审：最后一轮对抗评审 PASS 后输出未再改动，直接作为质控结论，省去一次复核调用
+                quality = last_review["decision"]
+                stage_audit["qualityGate"] = {"raw": last_review.get("raw") or "", "decision": quality, "fusedFromCollisionRound": last_review.get("round")}
+                await db_write(append_log, task_id, f"[{last_review.get('reviewer')}] 阶段质控结论：PASS（沿用第{last_review.get('round')}轮对抗评审，输出未变更）| stage={stage}")
             else:
                 reviewer_role, reviewer_code = get_reviewer_role()
                 if reviewer_role and int(reviewer_role["enabled"] or 0) == 1:
-                    review_stage = f"{stage}-阶段质控"
-                    review_prompt = (
-                        "你是阶段质控复核。请只对当前阶段输出进行验收，不要重写实现。"
-                        f"当前阶段：{stage}，执行角色：{role_code}。\n"
-                        f"任务目标：{sections.get('task') or task['description'] or ''}\n"
-                        f"期望交付：{sections.get('delivery') or ''}\n"
-                        f"{contract_text}\n"
-                        f"本阶段输出：\n{output}\n\n"
-                        f"本阶段新增产出（非系统生成）：{produced_non_system}\n"
-                        f"当前可验收产物（非系统生成）：{existing_non_system}\n"
-                        "注意：不要把固定文件名当成硬约束，按验收契约判断是否满足任务。"
-                        "请返回 JSON："
-                        '{"decision":"PASS|FAIL","reason":"...","issues":["..."],"send_back_role":"当前角色code","rework_instructions":"..."}'
-                        "。若 FAIL，send_back_role 优先填当前角色。"
-                    )
-                    review_msgs = [
-                        {
-                            "role": "system",
-                            "content": (reviewer_role["system_prompt"] or "你是严格质控复核角色。"),
-                        },
-                        {"role": "user", "content": review_prompt},
-                    ]
-                    save_role_message(task_id, reviewer_code, review_stage, "user", review_prompt)
-                    review_output = call_role_llm(reviewer_role, review_msgs)
-                    save_role_message(task_id, reviewer_code, review_stage, "assistant", review_output)
-                    quality = parse_verifier_feedback(review_output)
-                    stage_audit["qualityGate"] = {"raw": review_output, "decision": quality}
-
-                    q_dec = quality.get("decision", "UNKNOWN")
-                    append_log(task_id, f"[{reviewer_code}] 阶段质控结论：{q_dec} | stage={stage} | reason={quality.get('reason','')[:120]}")
+                    async def reviewer_qc():
+                        review_stage = f"{stage}-阶段质控"
+                        review_prompt = (
+                            "你是阶段质控复核。请只对当前阶段输出进行验收，不要重写实现。"
+                            f"当前阶段：{stage}，执行角色：{role_code}。\n"
+                            f"任务目标：{sections.get('task') or task['description'] or ''}\n"
+                            f"期望交付：{sections.get('delivery') or ''}\n"
+                            f"{contract_text}\n"
+                            f"本阶段输出：\n{output}\n\n"
+                            f"本阶段新增/修改产出（非系统生成）：{produced_non_system}\n"
+                            + (f"本阶段删除的文件：{file_changes['deleted']}\n" if file_changes["deleted"] else "")
+                            + f"当前可验收产物（非系统生成）：{existing_non_system}\n"
+                            "注意：不要把固定文件名当成硬约束，按验收契约判断是否满足任务。"
+                            + ("严格模式：该阶段历史通过率低，请逐条核对验收契约与证据要求，任何未被证据支持的结论都判 FAIL。" if qc_mode == "strict" else "")
+                            + "请返回 JSON："
+                            + STAGE_REVIEW_SCHEMA
+                            + "。若 FAIL，send_back_role 优先填当前角色。"
+                        )
+                        review_msgs = [
+                            {
+                                "role": "system",
+                                "content": (reviewer_role["system_prompt"] or "你是严格质控复核角色。"),
+                            },
+                            {"role": "user", "content": review_prompt},
+                        ]
+                        verdict_key = review_verdict_key(task_id, "qc", stage, output, contract_text, [stage_output_dir, output_dir])
+                        cached = verdict_cache_get(task_id, verdict_key)
+                        if cached:
+                            review_output, quality = cached["raw"], cached["decision"]
+                        else:
+                            await db_write(save_role_message, task_id, reviewer_code, review_stage, "user", review_prompt)
+                            review_output = await call_role_llm(reviewer_role, review_msgs, task_id=task_id, stage=review_stage)
+                            await db_write(save_role_message, task_id, reviewer_code, review_stage, "assistant", review_output)
+                            quality = parse_verifier_feedback(review_output)
+                            verdict_cache_put(task_id, verdict_key, quality, review_output)
+                        stage_audit["qualityGate"] = {"raw": review_output, "decision": quality}
+                        if cached:
+                            stage_audit["qualityGate"]["verdictCache"] = "hit"
+
+                        q_dec = quality.get("decision", "UNKNOWN")
+                        await db_write(append_log, task_id, f"[{reviewer_code}] 阶段质控结论：{q_dec}{'（提交未变，沿用缓存结论）' if cached else ''} | stage={stage} | reason={quality.get('reason','')[:120]}")
+                        return quality
+
+                    qc_call = reviewer_qc
                 else:
                     quality = {"decision": "SKIP", "reason": "reviewer不可用，跳过阶段质控"}
                     stage_audit["qualityGate"] = {"decision": quality}
 
-            q_dec = (quality or {}).get("decision", "UNKNOWN")
-            if q_dec != "PASS" and q_dec != "SKIP":
-                if stage_retry >= max_stage_review_retries:
-                    stage_audit["terminatedByStageReview"] = True
-                    audit["stages"].append(stage_audit)
-                    raise RuntimeError(f"阶段 {stage} 质控未通过，且已达本阶段最大重试 {max_stage_review_retries}")
-
-                stage_retry_counts[stage] = stage_retry + 1
-                handoff_note = (
-                    f"阶段质控未通过（{stage}，第{stage_retry_counts[stage]}次重试）。"
-                    f"原因：{(quality or {}).get('reason','')}。"
-                    f"问题：{'；'.join((quality or {}).get('issues') or [])}。"
-                    f"修改要求：{(quality or {}).get('rework_instructions','请根据质控意见修改后重新提交本阶段。')}"
-                )
-                append_log(
-                    task_id,
-                    f"[Lead Agent] 阶段质控未通过，打回当前阶段重做：{stage}（{stage_retry_counts[stage]}/{max_stage_review_retries}）",
+        def finalize(quality):
+            stage_audit["durationSec"] = round(time.perf_counter() - stage_t0, 2)
+            deferred_outcome = None
+            if review_policy is not None:
+                outcome = (task_id, wf["code"], stage, role_code, role["default_model"] or "", review_policy, stage_audit)
+                if speculative:
+                    # 推测阶段可能被回滚，评审历史等提交后再写，避免自适应策略从丢弃的运行中学习
+                    deferred_outcome = outcome
+                else:
+                    record_review_outcome(*outcome)
+            cache_hits = len([r for r in stage_audit.get("collisionRecords") or [] if r.get("verdictCache") == "hit"])
+            cache_hits += 1 if (stage_audit.get("qualityGate") or {}).get("verdictCache") == "hit" else 0
+            if cache_hits:
+                stage_audit["verdictCacheHits"] = cache_hits
+            attach_stage_llm_audit(stage_audit, task_id, stage_llm_mark)
+            return {
+                "stage": stage,
+                "roleCode": role_code,
+                "output": output,
+                "stageAudit": stage_audit,
+                "quality": quality,
+                "stageRetry": stage_retry,
+                "modes": (verifier_mode, lead_dispatch_mode, lead_acceptance_mode),
+                "deferredReviewOutcome": deferred_outcome,
+            }
+
+        if qc_call is None:
+            return finalize(quality)
+
+        async def finish_qc():
+            return finalize(await qc_call())
+
+        if defer_qc:
+            # 推测执行：质控在后台进行，调用方先拿到暂定输出启动下一阶段，再等待 qcJob 得到最终结果
+            return {"stage": stage, "roleCode": role_code, "output": output, "qcJob": asyncio.ensure_future(finish_qc())}
+        return await finish_qc()
+
+    def stage_review_handoff(stage: str, quality: dict) -> str:
+        return (
+            f"阶段质控未通过（{stage}，第{stage_retry_counts[stage]}次重试）。"
+            f"原因：{(quality or {}).get('reason','')}。"
+            f"问题：{'；'.join((quality or {}).get('issues') or [])}。"
+            f"修改要求：{(quality or {}).get('rework_instructions','请根据质控意见修改后重新提交本阶段。')}"
+        )
+
+    async def speculate_next(idx: int, res: dict):
+        """质控进行期间基于暂定输出先跑下一阶段（输出写入暂存目录）；PASS 则提交，FAIL 则回滚其消息、文件、
+        执行序号与模型调用记录，评审历史只在提交时写入。"""
+        nonlocal execution_no
+        qc_job = res["qcJob"]
+        nxt = idx + 1
+        eligible = (
+            nxt < len(stages)
+            and stages[nxt] in active_stage_set
+            and len(parallel_group_at(nxt)) == 1
+            and not stage_modes(stages[nxt], nxt, stage_role_code(nxt))[1]
+        )
+        if not eligible:
+            return await qc_job, None
+
+        nxt_stage = stages[nxt]
+        staging = os.path.join(base_dir, "speculative", re.sub(r"[^\w\u4e00-\u9fff-]+", "_", nxt_stage)[:40])
+        # 暂存目录先复制一份当前输出，推测阶段与正常执行时看到的已有产物一致
+        seed = await asyncio.to_thread(seed_speculative_dir, output_dir, staging)
+        touch_task_files(task_id)
+        msg_mark = latest_role_message_id(task_id)
+        exec_mark = execution_no
+        await db_write(append_log, task_id, f"[Lead Agent] 推测执行：{stages[idx]} 质控进行中，先基于暂定输出启动 {nxt_stage}")
+        t0 = time.perf_counter()
+        spec_job = asyncio.ensure_future(run_stage_attempt(nxt, res["output"], "", staging, stage_file_dir=staging, speculative=True))
+        try:
+            res = await qc_job
+        except BaseException:
+            spec_job.cancel()
+            raise
+        qc_sec = time.perf_counter() - t0
+        q_dec = (res["quality"] or {}).get("decision", "UNKNOWN")
+        spec = audit["speculation"]
+        spec["attempts"] += 1
+        event = {"stage": stages[idx], "speculativeStage": nxt_stage, "qcDecision": q_dec, "qcSec": round(qc_sec, 2)}
+        committed = None
+        if q_dec in ("PASS", "SKIP"):
+            spec_res = await spec_job
+            deferred = spec_res.pop("deferredReviewOutcome", None)
+            if deferred:
+                record_review_outcome(*deferred)
+            saved = round(min(qc_sec, spec_res["stageAudit"].get("durationSec") or 0), 2)
+            spec_res["stageAudit"]["speculative"] = {"committed": True, "overlapSec": saved}
+            spec["hits"] += 1
+            spec["savedSec"] = round(spec["savedSec"] + saved, 2)
+            event.update({"committed": True, "savedSec": saved})
+            await db_write(append_log, task_id, f"[Lead Agent] 推测执行命中：{nxt_stage} 已提交，节省约 {saved}s")
+            # 暂存产物在轮到该阶段时再合并，保证本阶段断点的文件清单不含下一阶段产物
+            committed = {"idx": nxt, "result": spec_res, "staging": staging, "seed": seed}
+        else:
+            spec_job.cancel()
+            await asyncio.gather(spec_job, return_exceptions=True)
+            removed = rollback_role_messages(task_id, msg_mark, nxt_stage)
+            shutil.rmtree(staging, ignore_errors=True)
+            touch_task_files(task_id)
+            # 推测阶段的执行序号为 exec_mark + 1（期间没有其他阶段启动）；序号收回，重跑时沿用
+            dropped = discard_llm_calls(task_id, exec_mark + 1)
+            execution_no = exec_mark
+            spec["rollbacks"] += 1
+            event.update(
+                {
+                    "committed": False,
+                    "wastedSec": round(time.perf_counter() - t0, 2),
+                    "rolledBackMessages": removed,
+                    "wastedCalls": dropped["calls"],
+                    "wastedTokens": dropped["tokens"],
+                }
+            )
+            await db_write(append_log, task_id, f"[Lead Agent] 推测执行回滚：{stages[idx]} 质控 {q_dec}，已撤销 {nxt_stage} 的消息 {removed} 条及暂存产物")
+        spec["hitRate"] = round(spec["hits"] / spec["attempts"], 3)
+        spec["events"].append(event)
+        return res, committed
+
+    def send_back(target_role: str, from_idx: int) -> int:
+        target_idx = find_stage_index_by_role(stages, stage_roles, target_role, from_idx, fallback_idx=max(0, from_idx - 1))
+        group = group_containing(target_idx)
+        if len(group) > 1:
+            # 并行组只重跑被打回的分支，其余分支沿用上次通过的输出
+            rework_only.add(stages[target_idx])
+            return group[0]
+        return target_idx
+
+    try:
+        while stage_idx < len(stages):
+            iterations += 1
+            if iterations > max_iterations:
+                raise RuntimeError(f"超过最大迭代限制（{max_iterations}），已自动终止避免循环")
+
+            ensure_not_stopped(task_id)
+            stage = stages[stage_idx]
+
+            budget_state, tokens_used = check_token_budget(task_id, token_budget)
+            if budget_state == "exceeded":
+                audit["budgetExceeded"] = {"used": tokens_used, "budget": token_budget, "stage": stage}
+                raise RuntimeError(f"任务 token 预算已耗尽（已用 {tokens_used}/{token_budget}），在阶段 {stage} 前终止")
+            if budget_state == "degrade" and not budget_degraded:
+                budget_degraded = True
+                audit["budgetDegraded"] = {"used": tokens_used, "budget": token_budget, "stage": stage}
+                await db_write(append_log, task_id, f"[Lead Agent] token 用量已达预算 {int(TOKEN_BUDGET_DEGRADE_RATIO * 100)}%（{tokens_used}/{token_budget}），后续阶段跳过对抗评审以节省预算")
+
+            deadline_state, elapsed = check_deadline(task_id)
+            if deadline_state == "exceeded":
+                raise DeadlineExceeded(f"任务已到截止时间（{deadline_sec}s），在阶段 {stage} 前收尾")
+            if deadline_state == "degrade" and not deadline_degraded:
+                deadline_degraded = True
+                audit["deadlineDegraded"] = {"elapsedSec": round(elapsed, 1), "deadlineSec": deadline_sec, "stage": stage}
+                await db_write(append_log, task_id, f"[Lead Agent] 已用时 {int(elapsed)}s，达截止时间 {int(DEADLINE_DEGRADE_RATIO * 100)}%（{deadline_sec}s），后续阶段跳过对抗评审、阶段质控与返工")
+
+            # 动态分发后可跳过非必要阶段
+            if (stage_idx > 0) and (stage not in active_stage_set):
+                await db_write(append_log, task_id, f"[Lead Agent] 跳过阶段{stage_idx+1}：{stage}（本轮未分配）")
+                audit["stages"].append(
+                    {
+                        "executionNo": None,
+                        "index": stage_idx + 1,
+                        "stage": stage,
+                        "role": stage_roles.get(stage) or "-",
+                        "model": "-",
+                        "status": "SKIPPED",
+                        "reason": "动态分发未纳入本轮执行",
+                        "finishedAt": now_str(),
+                    }
                 )
-                previous_output = output
-                audit["stages"].append(stage_audit)
+                stage_idx += 1
                 continue
-            else:
-                stage_retry_counts[stage] = 0
 
-        # 工作流中的“验证/复核”正式阶段：可触发跨阶段打回
-        if verifier_mode:
-            decision = parse_verifier_feedback(output)
-            stage_audit["reviewDecision"] = decision
-            dec = decision.get("decision", "UNKNOWN")
-            append_log(task_id, f"[{role_code}] 复核结论：{dec} | reason={decision.get('reason','')[:120]}")
-
-            if dec != "PASS":
-                if rework_round >= max_rework_rounds:
-                    stage_audit["terminatedByMaxRework"] = True
-                    audit["stages"].append(stage_audit)
-                    audit["reworkRoundsUsed"] = rework_round
-                    raise RuntimeError(f"复核未通过，已达最大返工轮次 {max_rework_rounds}，任务终止")
-
-                target_role = (decision.get("send_back_role") or "").strip()
-                target_idx = find_stage_index_by_role(stages, stage_roles, target_role, stage_idx, fallback_idx=max(0, stage_idx - 1))
-                rework_round += 1
-                audit["reworkRoundsUsed"] = rework_round
-                handoff_note = (
-                    f"复核不通过（第{rework_round}轮返工）。"
-                    f"原因：{decision.get('reason','')}。"
-                    f"问题：{'；'.join(decision.get('issues') or [])}。"
-                    f"修改要求：{decision.get('rework_instructions','请根据复核意见修改后提交。')}"
-                )
-                append_log(
-                    task_id,
-                    f"[Lead Agent] 复核未通过，打回到阶段{target_idx+1}（{stages[target_idx]}），返工轮次={rework_round}/{max_rework_rounds}",
-                )
-                previous_output = output
-                audit["stages"].append(stage_audit)
-                stage_idx = target_idx
+            # 并行组：互不依赖的执行阶段并发执行，各分支独立会话、独立输出目录，完成后合并
+            group = parallel_group_at(stage_idx)
+            if len(group) > 1:
+                names = [stages[i] for i in group]
+                reuse_ok = all(st in branch_outputs for st in names)
+                targets = [i for i in group if stages[i] in rework_only] if (reuse_ok and rework_only & set(names)) else list(group)
+                rework_only.clear()
+                inputs = {i: (previous_output, handoff_note) for i in targets}
+                await db_write(append_log, task_id, f"[Lead Agent] 并行执行阶段组：{names}（本轮执行：{[stages[i] for i in targets]}）")
+                group_t0 = time.perf_counter()
+                attempt_secs = 0.0
+                while targets:
+                    iterations += 1
+                    if iterations > max_iterations:
+                        raise RuntimeError(f"超过最大迭代限制（{max_iterations}），已自动终止避免循环")
+                    ensure_not_stopped(task_id)
+                    branch_dirs = {i: branch_output_dir(base_dir, stages[i]) for i in targets}
+                    jobs = [asyncio.ensure_future(run_stage_attempt(i, *inputs[i], branch_dirs[i])) for i in targets]
+                    try:
+                        results = await asyncio.gather(*jobs)
+                    except BaseException:
+                        for job in jobs:
+                            job.cancel()
+                        raise
+
+                    retry_targets = []
+                    for i, res in zip(targets, results):
+                        st = res["stage"]
+                        stage_audit = res["stageAudit"]
+                        stage_audit["parallelGroup"] = names
+                        attempt_secs += stage_audit.get("durationSec") or 0
+                        q_dec = (res["quality"] or {}).get("decision", "UNKNOWN")
+                        if q_dec != "PASS" and q_dec != "SKIP":
+                            if res["stageRetry"] >= max_stage_review_retries:
+                                stage_audit["terminatedByStageReview"] = True
+                                audit["stages"].append(stage_audit)
+                                raise RuntimeError(f"阶段 {st} 质控未通过，且已达本阶段最大重试 {max_stage_review_retries}")
+                            stage_retry_counts[st] = res["stageRetry"] + 1
+                            inputs[i] = (res["output"], stage_review_handoff(st, res["quality"]))
+                            await db_write(append_log, task_id, f"[Lead Agent] 阶段质控未通过，仅打回并行分支重做：{st}（{stage_retry_counts[st]}/{max_stage_review_retries}）")
+                            audit["stages"].append(stage_audit)
+                            retry_targets.append(i)
+                            continue
+
+                        stage_retry_counts[st] = 0
+                        moved = merge_branch_output_dir(branch_dirs[i], output_dir)
+                        touch_task_files(task_id)
+                        stage_audit["mergedFiles"] = moved
+                        branch_outputs[st] = (res["roleCode"], res["output"])
+                        audit["stages"].append(stage_audit)
+                        await db_write(append_log, task_id, f"[{res['roleCode']}] 并行分支完成：{st}，输出长度={len(res['output'])}，合并产物={len(moved)}")
+                    targets = retry_targets
+
+                wall_sec = round(time.perf_counter() - group_t0, 2)
+                audit["parallelGroups"].append({"stages": names, "wallSec": wall_sec, "branchSec": round(attempt_secs, 2)})
+                await db_write(append_log, task_id, f"[Lead Agent] 并行阶段组完成：{names}，耗时={wall_sec}s（分支累计={round(attempt_secs, 2)}s）")
+
+                merged = "\n\n".join(f"## {st}（{branch_outputs[st][0]}）\n{branch_outputs[st][1]}" for st in names)
+                last_execution_output = merged
+                last_execution_stage = "、".join(names)
+                last_execution_role = "、".join(branch_outputs[st][0] for st in names)
+                previous_output = merged
+                handoff_note = ""
+                stage_idx = group[-1] + 1
+                await checkpoint_stage(stage_idx)
                 continue
 
-        # Lead 最终验收阶段：Lead 也有打回权限
-        if lead_acceptance_mode:
-            decision = parse_verifier_feedback(output)
-            lead_acceptance_result = decision
-            stage_audit["leadAcceptance"] = decision
-            dec = decision.get("decision", "UNKNOWN")
-            append_log(task_id, f"[Lead Agent] 验收结论：{dec} | reason={decision.get('reason','')[:120]}")
-
-            if dec != "PASS":
-                if rework_round >= max_rework_rounds:
-                    stage_audit["terminatedByMaxRework"] = True
+            if speculated and speculated["idx"] == stage_idx:
+                res = speculated["result"]
+                res["stageAudit"]["mergedFiles"] = await asyncio.to_thread(merge_speculative_dir, speculated["staging"], output_dir, speculated["seed"])
+                touch_task_files(task_id)
+            else:
+                res = await run_stage_attempt(stage_idx, previous_output, handoff_note, output_dir, defer_qc=SPECULATIVE_STAGES)
+            speculated = None
+            if "qcJob" in res:
+                res, speculated = await speculate_next(stage_idx, res)
+            role_code = res["roleCode"]
+            output = res["output"]
+            stage_audit = res["stageAudit"]
+            stage_retry = res["stageRetry"]
+            verifier_mode, lead_dispatch_mode, lead_acceptance_mode = res["modes"]
+
+            if (not verifier_mode) and (not lead_dispatch_mode) and (not lead_acceptance_mode):
+                quality = res["quality"]
+                q_dec = (quality or {}).get("decision", "UNKNOWN")
+                if q_dec != "PASS" and q_dec != "SKIP":
+                    if stage_retry >= max_stage_review_retries:
+                        stage_audit["terminatedByStageReview"] = True
+                        audit["stages"].append(stage_audit)
+                        raise RuntimeError(f"阶段 {stage} 质控未通过，且已达本阶段最大重试 {max_stage_review_retries}")
+
+                    stage_retry_counts[stage] = stage_retry + 1
+                    handoff_note = stage_review_handoff(stage, quality)
+                    await db_write(
+                        append_log,
+                        task_id,
+                        f"[Lead Agent] 阶段质控未通过，打回当前阶段重做：{stage}（{stage_retry_counts[stage]}/{max_stage_review_retries}）",
+                    )
+                    previous_output = output
                     audit["stages"].append(stage_audit)
+                    continue
+                else:
+                    stage_retry_counts[stage] = 0
+
+            # 工作流中的“验证/复核”正式阶段：可触发跨阶段打回
+            if verifier_mode:
+                decision = parse_verifier_feedback(output)
+                stage_audit["reviewDecision"] = decision
+                dec = decision.get("decision", "UNKNOWN")
+                await db_write(append_log, task_id, f"[{role_code}] 复核结论：{dec} | reason={decision.get('reason','')[:120]}")
+
+                if dec != "PASS":
+                    if deadline_degraded:
+                        audit["stages"].append(stage_audit)
+                        raise DeadlineExceeded("复核未通过，但任务临近截止时间，不再发起返工")
+                    if rework_round >= max_rework_rounds:
+                        stage_audit["terminatedByMaxRework"] = True
+                        audit["stages"].append(stage_audit)
+                        audit["reworkRoundsUsed"] = rework_round
+                        raise RuntimeError(f"复核未通过，已达最大返工轮次 {max_rework_rounds}，任务终止")
+
+                    target_idx = send_back((decision.get("send_back_role") or "").strip(), stage_idx)
+                    rework_round += 1
                     audit["reworkRoundsUsed"] = rework_round
-                    raise RuntimeError(f"Lead验收未通过，已达最大返工轮次 {max_rework_rounds}，任务终止")
-
-                target_role = (decision.get("send_back_role") or "").strip()
-                target_idx = find_stage_index_by_role(stages, stage_roles, target_role, stage_idx, fallback_idx=max(0, stage_idx - 1))
-                rework_round += 1
-                audit["reworkRoundsUsed"] = rework_round
-                handoff_note = (
-                    f"Lead验收不通过（第{rework_round}轮返工）。"
-                    f"原因：{decision.get('reason','')}。"
-                    f"问题：{'；'.join(decision.get('issues') or [])}。"
-                    f"修改要求：{decision.get('rework_instructions','请根据Lead验收意见修改后提交。')}"
-                )
-                append_log(
-                    task_id,
-                    f"[Lead Agent] 验收未通过，打回到阶段{target_idx+1}（{stages[target_idx]}），返工轮次={rework_round}/{max_rework_rounds}",
-                )
-                previous_output = output
-                audit["stages"].append(stage_audit)
-                stage_idx = target_idx
-                continue
-
-        if (not verifier_mode) and (not lead_dispatch_mode) and (not lead_acceptance_mode):
-            last_execution_output = output
-            last_execution_stage = stage
-            last_execution_role = role_code
-
-        previous_output = output
-        handoff_note = ""
-        audit["stages"].append(stage_audit)
-        append_log(task_id, f"[{role_code}] 阶段完成，输出长度={len(output)}，耗时={stage_duration_sec}s")
-        stage_idx += 1
+                    handoff_note = (
+                        f"复核不通过（第{rework_round}轮返工）。"
+                        f"原因：{decision.get('reason','')}。"
+                        f"问题：{'；'.join(decision.get('issues') or [])}。"
+                        f"修改要求：{decision.get('rework_instructions','请根据复核意见修改后提交。')}"
+                    )
+                    await db_write(
+                        append_log,
+                        task_id,
+                        f"[Lead Agent] 复核未通过，打回到阶段{target_idx+1}（{stages[target_idx]}），返工轮次={rework_round}/{max_rework_rounds}"
+                        + (f"，仅重跑分支：{sorted(rework_only)}" if rework_only else ""),
+                    )
+                    previous_output = output
+                    audit["stages"].append(stage_audit)
+                    stage_idx = target_idx
+                    continue
+
+            # Lead 最终验收阶段：Lead 也有打回权限
+            if lead_acceptance_mode:
+                decision = parse_verifier_feedback(output)
+                lead_acceptance_result = decision
+                stage_audit["leadAcceptance"] = decision
+                dec = decision.get("decision", "UNKNOWN")
+                await db_write(append_log, task_id, f"[Lead Agent] 验收结论：{dec} | reason={decision.get('reason','')[:120]}")
+
+                if dec != "PASS":
+                    if deadline_degraded:
+                        audit["stages"].append(stage_audit)
+                        raise DeadlineExceeded("Lead验收未通过，但任务临近截止时间，不再发起返工")
+                    if rework_round >= max_rework_rounds:
+                        stage_audit["terminatedByMaxRework"] = True
+                        audit["stages"].append(stage_audit)
+                        audit["reworkRoundsUsed"] = rework_round
+                        raise RuntimeError(f"Lead验收未通过，已达最大返工轮次 {max_rework_rounds}，任务终止")
+
+                    target_idx = send_back((decision.get("send_back_role") or "").strip(), stage_idx)
+                    rework_round += 1
+                    audit["reworkRoundsUsed"] = rework_round
+                    handoff_note = (
+                        f"Lead验收不通过（第{rework_round}轮返工）。"
+                        f"原因：{decision.get('reason','')}。"
+                        f"问题：{'；'.join(decision.get('issues') or [])}。"
+                        f"修改要求：{decision.get('rework_instructions','请根据Lead验收意见修改后提交。')}"
+                    )
+                    await db_write(
+                        append_log,
+                        task_id,
+                        f"[Lead Agent] 验收未通过，打回到阶段{target_idx+1}（{stages[target_idx]}），返工轮次={rework_round}/{max_rework_rounds}"
+                        + (f"，仅重跑分支：{sorted(rework_only)}" if rework_only else ""),
+                    )
+                    previous_output = output
+                    audit["stages"].append(stage_audit)
+                    stage_idx = target_idx
+                    continue
+
+            if (not verifier_mode) and (not lead_dispatch_mode) and (not lead_acceptance_mode):
+                last_execution_output = output
+                last_execution_stage = stage
+                last_execution_role = role_code
+
+            previous_output = output
+            handoff_note = ""
+            audit["stages"].append(stage_audit)
+            await db_write(append_log, task_id, f"[{role_code}] 阶段完成，输出长度={len(output)}，耗时={stage_audit['durationSec']}s")
+            stage_idx += 1
+            await checkpoint_stage(stage_idx)
+
+    except DeadlineExceeded as e:
+        _, elapsed = check_deadline(task_id)
+        deadline_hit = {
+            "deadlineSec": deadline_sec,
+            "elapsedSec": round(elapsed, 1),
+            "stage": stages[stage_idx] if stage_idx < len(stages) else "",
+            "reason": str(e),
+            "deliveredFrom": last_execution_stage,
+        }
+        audit["deadline"] = deadline_hit
+        await db_write(append_log, task_id, f"[Lead Agent] {e}：停止后续阶段，按已完成内容尽力交付（来源阶段：{last_execution_stage or '无'}）")
 
-    final_non_system_files = [x for x in sorted(list_output_file_names(output_dir)) if not is_system_generated_output(x)]
+    final_non_system_files = [x for x in sorted(manifest_snapshot(task_id, [output_dir])) if not is_system_generated_output(x)]
     final_body = previous_output
 
-    if lead_acceptance_result and (lead_acceptance_result.get("decision") == "PASS") and last_execution_output:
+    if deadline_hit:
+        final_body = (
+            "## 截止时间已到（尽力交付）\n"
+            f"- 截止时间：{deadline_sec}s，已用时：{deadline_hit['elapsedSec']}s\n"
+            f"- 收尾位置：{deadline_hit['stage'] or '收尾'}\n"
+            f"- 原因：{deadline_hit['reason']}\n"
+            "- 说明：以下为截止前最后一次完成的执行阶段输出，未经完整复核/验收\n"
+            "\n## 核心交付正文\n"
+            + (f"（来源：阶段【{last_execution_stage}】角色【{last_execution_role}】）\n\n" if last_execution_output else "")
+            + f"{last_execution_output or previous_output}\n"
+        )
+    elif lead_acceptance_result and (lead_acceptance_result.get("decision") == "PASS") and last_execution_output:
         reason = lead_acceptance_result.get("reason") or "通过最终验收。"
         issues = lead_acceptance_result.get("issues") or []
         final_body = (
@@ -2029,22 +5392,22 @@ def run_multi_agent_workflow(task_id: int, task, wf, base_dir: str, input_dir: s
         )
 
     final_file = os.path.join(output_dir, "多Agent_最终交付.md")
-    with open(final_file, "w", encoding="utf-8") as f:
-        f.write(f"# 多Agent最终交付\n\n任务：{task['title']}\n\n")
-        if final_non_system_files:
-            f.write("## 可验收产物清单\n")
-            for fn in final_non_system_files:
-                f.write(f"- {fn}\n")
-            f.write("\n")
-        f.write(final_body + "\n")
+    final_text = f"# 多Agent最终交付\n\n任务：{task['title']}\n\n"
+    if final_non_system_files:
+        final_text += "## 可验收产物清单\n" + "".join(f"- {fn}\n" for fn in final_non_system_files) + "\n"
+    await write_text_async(final_file, final_text + final_body + "\n")
 
     audit["finishedAt"] = now_str()
     audit["finalFile"] = os.path.basename(final_file)
+    audit["usage"] = summarize_llm_usage(task_llm_calls.get(task_id))
+    audit["resources"] = load_task_resources(task_id)
+    if llm_cache_mode() != "off":
+        audit["llmCache"] = summarize_llm_cache(task_llm_calls.get(task_id))
     audit_file = os.path.join(output_dir, "多Agent_会话审计.json")
-    with open(audit_file, "w", encoding="utf-8") as f:
-        json.dump(audit, f, ensure_ascii=False, indent=2)
+    await write_text_async(audit_file, json.dumps(audit, ensure_ascii=False, indent=2))
 
-    append_log(task_id, f"[Lead Agent] 多Agent独立会话完成，最终交付：{os.path.basename(final_file)}")
+    await db_write(append_log, task_id, f"[Lead Agent] 多Agent独立会话完成，最终交付：{os.path.basename(final_file)}")
+    return audit
 
 
 def login_required(fn):
@@ -2063,122 +5426,265 @@ def payload_too_large(_):
     return redirect(url_for("dashboard")), 413
 
 
-def run_task(task_id: int):
+def run_task(task_id: int, resume: bool = False):
+    """thread 引擎入口：每个任务占一个线程，线程内用独立事件循环驱动执行。"""
     task = get_task(task_id)
     if not task:
         running_processes.pop(task_id, None)
         task_run_context.pop(task_id, None)
         return
 
+    if not resume and try_auto_reuse(task_id, task):
+        running_processes.pop(task_id, None)
+        task_run_context.pop(task_id, None)
+        return
+
     with limiter.acquire():
-        update_task(task_id, status="running", started_at=now_str(), return_code=None)
-        base_dir, input_dir, output_dir = task_artifact_dirs(task_id)
+        asyncio.run(execute_task(task_id, task, resume=resume))
+
+
+async def run_task_async(task_id: int, resume: bool = False):
+    """asyncio 引擎入口：所有任务共享一个事件循环，排队与等待模型/工具都不占线程。"""
+    task = get_task(task_id)
+    if not task:
+        running_processes.pop(task_id, None)
+        task_run_context.pop(task_id, None)
+        return
+
+    if not resume and await asyncio.to_thread(try_auto_reuse, task_id, task):
+        running_processes.pop(task_id, None)
+        task_run_context.pop(task_id, None)
+        return
 
-        run_id = build_task_run_id(task_id)
-        task_run_context[task_id] = run_id
+    async with limiter.acquire_async():
+        await execute_task(task_id, task, resume=resume)
 
+
+def usable_checkpoint(task_id: int, task):
+    """断点可用：工作流阶段定义未变，且输出目录能还原到断点时的文件集合。"""
+    checkpoint = load_checkpoint(task_id)
+    if not checkpoint:
+        return None, "没有可用的阶段断点"
+    wf = get_workflow_by_code((task["workflow_code"] or "").strip()) if "workflow_code" in task.keys() else None
+    if not wf or parse_stages(wf["stages_json"]) != checkpoint["stages"]:
+        return None, "工作流阶段定义已变化，断点失效"
+    return checkpoint, ""
+
+
+async def execute_task(task_id: int, task, resume: bool = False):
+    token = CancelToken(asyncio.get_running_loop(), asyncio.current_task())
+    task_cancel_tokens[task_id] = token
+    try:
+        await _execute_task(task_id, task, resume=resume)
+    except asyncio.CancelledError:
+        if token.cancelled_at is None:
+            raise
+        asyncio.current_task().uncancel()
+        await db_write(append_log, task_id, f"[SYSTEM] 已中止在途模型请求/工具命令（{token.reason}），取消耗时 {int((time.perf_counter() - token.cancelled_at) * 1000)}ms")
+    finally:
+        task_cancel_tokens.pop(task_id, None)
+
+
+async def _execute_task(task_id: int, task, resume: bool = False):
+    await db_write(update_task, task_id, status="running", started_at=now_str(), return_code=None)
+    base_dir, input_dir, output_dir = task_artifact_dirs(task_id)
+
+    run_id = build_task_run_id(task_id)
+    task_run_context[task_id] = run_id
+    task_llm_calls[task_id] = []
+    task_token_carry[task_id] = 0
+    task_verdict_cache[task_id] = {}
+    task_file_manifests[task_id] = {}
+    # 截止时间从本次运行开始计，对工作流、命令与演示任务都生效（命令任务无工作流时只取任务级/全局默认值）
+    wf_code = (task["workflow_code"] or "").strip() if "workflow_code" in task.keys() else ""
+    deadline_sec = task_deadline_sec(task, get_workflow_by_code(wf_code) if wf_code else None)
+    if deadline_sec:
+        task_deadlines[task_id] = (time.perf_counter(), deadline_sec)
+
+    checkpoint = None
+    if resume:
+        checkpoint, reason = usable_checkpoint(task_id, task)
+        if checkpoint:
+            ok, detail = restore_output_to_manifest(output_dir, checkpoint["manifest"])
+            if not ok:
+                checkpoint, reason = None, detail
+        if not checkpoint:
+            await db_write(append_log, task_id, f"[SYSTEM] 无法从断点恢复（{reason}），改为从头执行")
+
+    await db_write(append_log, task_id, f"[SYSTEM] 本次运行ID: {run_id}")
+    await db_write(append_log, task_id, f"[SYSTEM] 任务启动，当前并发上限={limiter.get_limit()}")
+    await db_write(append_log, task_id, f"[SYSTEM] 任务产物目录: {base_dir}")
+    await db_write(append_log, task_id, f"[SYSTEM] 输入附件目录: {input_dir}")
+    await db_write(append_log, task_id, f"[SYSTEM] 输出产物目录: {output_dir}")
+    clear_dir_contents(os.path.join(base_dir, "branches"))
+    clear_dir_contents(os.path.join(base_dir, "speculative"))
+    if checkpoint:
+        trimmed = rollback_role_messages(task_id, checkpoint["messageMark"])
+        # 预算按整条断点链计：写断点的那次运行已带入的 + 它自身花掉的（含断点之后的调用）
+        task_token_carry[task_id] = checkpoint["tokensCarried"] + run_billed_tokens(task_id, checkpoint["runId"])
+        await db_write(
+            append_log,
+            task_id,
+            f"[SYSTEM] 从断点恢复：阶段{checkpoint['stageIdx'] + 1}（{checkpoint['stage'] or '收尾'}）起执行，"
+            f"已完成阶段不再调用模型；已清理断点后产物 {detail} 项、会话消息 {trimmed} 条；此前运行已用 token {task_token_carry[task_id]}",
+        )
+    else:
+        clear_checkpoint(task_id)
+        await db_write(update_task, task_id, resource_json=None)
         removed_outputs = clear_dir_contents(output_dir)
+        clear_dir_contents(os.path.join(base_dir, "tool_runs"))
         cleared_msgs = clear_role_session_messages(task_id)
-
-        append_log(task_id, f"[SYSTEM] 本次运行ID: {run_id}")
-        append_log(task_id, f"[SYSTEM] 任务启动，当前并发上限={limiter.get_limit()}")
-        append_log(task_id, f"[SYSTEM] 任务产物目录: {base_dir}")
-        append_log(task_id, f"[SYSTEM] 输入附件目录: {input_dir}")
-        append_log(task_id, f"[SYSTEM] 输出产物目录: {output_dir}")
-        append_log(task_id, f"[SYSTEM] 已清理上一轮输出文件: {removed_outputs} 项")
+        await db_write(append_log, task_id, f"[SYSTEM] 已清理上一轮输出文件: {removed_outputs} 项")
         if cleared_msgs > 0:
-            append_log(task_id, f"[SYSTEM] 已清理上一轮角色会话消息: {cleared_msgs} 条")
-
-        cmd = (task["command"] or "").strip()
-        if not cmd:
-            wf_code = (task["workflow_code"] or "").strip() if "workflow_code" in task.keys() else ""
-            if wf_code:
-                try:
-                    wf = get_workflow_by_code(wf_code)
-                    if not wf:
-                        raise RuntimeError(f"未找到工作流: {wf_code}")
-                    append_log(task_id, f"[SYSTEM] 启动多Agent独立会话流程：{wf_code}")
-                    run_multi_agent_workflow(task_id, task, wf, base_dir, input_dir, output_dir)
-                    update_task(task_id, status="done", finished_at=now_str(), return_code=0)
-                    append_log(task_id, "[SYSTEM] 任务完成（多Agent独立会话）")
-                except Exception as e:
-                    update_task(task_id, status="failed", finished_at=now_str(), return_code=1)
-                    append_log(task_id, f"[SYSTEM] 多Agent流程失败：{e}")
-                finally:
-                    running_processes.pop(task_id, None)
-                    task_run_context.pop(task_id, None)
-                return
+            await db_write(append_log, task_id, f"[SYSTEM] 已清理上一轮角色会话消息: {cleared_msgs} 条")
 
-            # 无工作流时保留演示流程
+    cmd = (task["command"] or "").strip()
+    if not cmd:
+        wf_code = (task["workflow_code"] or "").strip() if "workflow_code" in task.keys() else ""
+        if wf_code:
             try:
-                for step in [
-                    "Lead Agent 正在拆解任务...",
-                    "Developer Agent 正在执行任务...",
-                    "Tester Agent 正在复核结果...",
-                    "Verifier Agent 正在做最终核验...",
-                    "Lead Agent 正在汇总交付...",
-                ]:
-                    ensure_not_stopped(task_id)
-                    append_log(task_id, step)
-                    time.sleep(2)
-                update_task(task_id, status="done", finished_at=now_str(), return_code=0)
-                append_log(task_id, "[SYSTEM] 任务完成（演示模式）")
+                wf = get_workflow_by_code(wf_code)
+                if not wf:
+                    raise RuntimeError(f"未找到工作流: {wf_code}")
+                await db_write(append_log, task_id, f"[SYSTEM] 启动多Agent独立会话流程：{wf_code}")
+                audit = await run_multi_agent_workflow(task_id, task, wf, base_dir, input_dir, output_dir, checkpoint=checkpoint)
+                if audit.get("deadline"):
+                    # 截止收尾保留断点，恢复时以新的截止时间继续剩余阶段
+                    await db_write(update_task, task_id, status="done", finished_at=now_str(), return_code=124)
+                    await db_write(append_log, task_id, "[SYSTEM] 任务完成（已到截止时间，尽力交付）")
+                else:
+                    clear_checkpoint(task_id)
+                    await db_write(update_task, task_id, status="done", finished_at=now_str(), return_code=0)
+                    await db_write(append_log, task_id, "[SYSTEM] 任务完成（多Agent独立会话）")
             except Exception as e:
-                update_task(task_id, status="failed", finished_at=now_str(), return_code=1)
-                append_log(task_id, f"[SYSTEM] 任务失败：{e}")
+                await db_write(update_task, task_id, status="failed", finished_at=now_str(), return_code=1)
+                await db_write(append_log, task_id, f"[SYSTEM] 多Agent流程失败：{e}")
             finally:
                 running_processes.pop(task_id, None)
                 task_run_context.pop(task_id, None)
+                task_llm_calls.pop(task_id, None)
+                task_verdict_cache.pop(task_id, None)
+                task_file_manifests.pop(task_id, None)
+                task_deadlines.pop(task_id, None)
+                task_tool_limits.pop(task_id, None)
             return
 
+        # 无工作流时保留演示流程
         try:
-            append_log(task_id, f"[SYSTEM] 执行命令: {cmd}")
-            env = os.environ.copy()
-            env.update(
-                {
-                    "TASK_ID": str(task_id),
-                    "TASK_RUN_ID": run_id,
-                    "TASK_ARTIFACT_DIR": base_dir,
-                    "TASK_INPUT_DIR": input_dir,
-                    "TASK_OUTPUT_DIR": output_dir,
-                }
-            )
-            proc = subprocess.Popen(
-                cmd,
-                shell=True,
-                cwd=WORKDIR,
-                executable="/bin/bash",
-                env=env,
-                start_new_session=True,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                bufsize=1,
-            )
-            running_processes[task_id] = proc
-
-            for line in iter(proc.stdout.readline, ""):
-                if not line:
-                    break
-                append_log(task_id, line.rstrip())
-
-            rc = proc.wait()
-            update_task(
-                task_id,
-                status="done" if rc == 0 else "failed",
-                finished_at=now_str(),
-                return_code=rc,
-            )
-            append_log(task_id, f"[SYSTEM] 任务结束，rc={rc}")
+            for step in [
+                "Lead Agent 正在拆解任务...",
+                "Developer Agent 正在执行任务...",
+                "Tester Agent 正在复核结果...",
+                "Verifier Agent 正在做最终核验...",
+                "Lead Agent 正在汇总交付...",
+            ]:
+                ensure_not_stopped(task_id)
+                await db_write(append_log, task_id, step)
+                await asyncio.sleep(clamp_to_deadline(task_id, 2))
+            await db_write(update_task, task_id, status="done", finished_at=now_str(), return_code=0)
+            await db_write(append_log, task_id, "[SYSTEM] 任务完成（演示模式）")
         except Exception as e:
-            update_task(task_id, status="failed", finished_at=now_str(), return_code=1)
-            append_log(task_id, f"[SYSTEM] 执行异常：{e}")
+            await db_write(update_task, task_id, status="failed", finished_at=now_str(), return_code=1)
+            await db_write(append_log, task_id, f"[SYSTEM] 任务失败：{e}")
         finally:
             running_processes.pop(task_id, None)
             task_run_context.pop(task_id, None)
+            task_deadlines.pop(task_id, None)
+        return
+
+    try:
+        await db_write(append_log, task_id, f"[SYSTEM] 执行命令: {cmd}")
+        env = os.environ.copy()
+        env.update(
+            {
+                "TASK_ID": str(task_id),
+                "TASK_RUN_ID": run_id,
+                "TASK_ARTIFACT_DIR": base_dir,
+                "TASK_INPUT_DIR": input_dir,
+                "TASK_OUTPUT_DIR": output_dir,
+            }
+        )
+        task_tool_limits[task_id] = workflow_tool_limits(get_workflow_by_code(wf_code) if wf_code else None)
+        limits = task_limits(task_id)
+        if limits:
+            await db_write(append_log, task_id, f"[SYSTEM] 资源限制：{proc_limits.format_limits(limits)}")
+
+        async def stream_output(proc):
+            while True:
+                line = await proc.stdout.readline()
+                if not line:
+                    break
+                await db_write(append_log, task_id, line.decode("utf-8", errors="replace").rstrip())
+            return await proc.wait()
+
+        t0 = time.perf_counter()
+        timed_out = False
+        async with limited_tool_process(task_id, cmd, WORKDIR, env, limit=1 << 20, log_prefix="[SYSTEM] ") as run:
+            proc = run["proc"]
+            running_processes[task_id] = proc
+            if run["launcher"] == "warm":
+                await db_write(append_log, task_id, f"[SYSTEM] 由预热执行器启动，pid={proc.pid}")
+            # 墙钟上限与任务截止时间取较小者；都未设置时不限
+            wall = limits.get("wall_sec") or float("inf")
+            timeout = clamp_to_deadline(task_id, wall)
+            try:
+                rc = await asyncio.wait_for(stream_output(proc), timeout=None if timeout == float("inf") else timeout)
+            except asyncio.TimeoutError:
+                kill_process_group(proc)
+                await proc.wait()
+                rc, timed_out = 124, True
+                if timeout < wall:
+                    await db_write(append_log, task_id, f"[SYSTEM] 已到任务截止时间（{deadline_sec}s），命令已终止")
+            except asyncio.CancelledError:
+                kill_process_group(proc)
+                raise
+        usage = run["usage"]
+        exit_reason = proc_limits.exit_reason(rc, timed_out, usage, limits)
+        record_task_resources(task_id, {**usage, "wallSec": round(time.perf_counter() - t0, 2), "exitReason": exit_reason})
+        await db_write(
+            update_task,
+            task_id,
+            status="done" if rc == 0 else "failed",
+            finished_at=now_str(),
+            return_code=rc,
+        )
+        await db_write(
+            append_log,
+            task_id,
+            f"[SYSTEM] 任务结束，rc={rc} 退出原因={exit_reason} CPU={usage.get('cpuSec', '-')}s "
+            f"峰值内存={usage.get('maxRssMb', '-')}MB I/O={usage.get('ioReadBytes', 0) + usage.get('ioWriteBytes', 0)}B",
+        )
+    except Exception as e:
+        await db_write(update_task, task_id, status="failed", finished_at=now_str(), return_code=1)
+        await db_write(append_log, task_id, f"[SYSTEM] 执行异常：{e}")
+    finally:
+        running_processes.pop(task_id, None)
+        task_run_context.pop(task_id, None)
+        task_tool_limits.pop(task_id, None)
+        task_file_manifests.pop(task_id, None)
+        task_deadlines.pop(task_id, None)
+
+
+def get_workflow_loop():
+    global workflow_loop
+    with workflow_loop_lock:
+        if workflow_loop is None:
+            workflow_loop = asyncio.new_event_loop()
+            threading.Thread(target=workflow_loop.run_forever, name="workflow-loop", daemon=True).start()
+        return workflow_loop
+
+
+def _on_async_task_done(task_id: int, fut):
+    if fut.cancelled() or fut.exception() is None:
+        return
+    running_processes.pop(task_id, None)
+    task_run_context.pop(task_id, None)
+    task_deadlines.pop(task_id, None)
+    update_task(task_id, status="failed", finished_at=now_str(), return_code=1)
+    append_log(task_id, f"[SYSTEM] 执行异常：{fut.exception()}")
 
 
-def start_task(task_id: int):
+def start_task(task_id: int, resume: bool = False):
     if task_id in running_processes:
         return False, "任务已在运行或排队中"
     task = get_task(task_id)
@@ -2188,14 +5694,20 @@ def start_task(task_id: int):
         return False, "任务状态已是 running"
 
     running_processes[task_id] = None
-    t = threading.Thread(target=run_task, args=(task_id,), daemon=True)
-    t.start()
-    return True, "已启动（如并发已满会自动排队）"
+    if WORKFLOW_ENGINE == "asyncio":
+        fut = asyncio.run_coroutine_threadsafe(run_task_async(task_id, resume=resume), get_workflow_loop())
+        fut.add_done_callback(lambda f: _on_async_task_done(task_id, f))
+    else:
+        t = threading.Thread(target=run_task, args=(task_id, resume), daemon=True)
+        t.start()
+    return True, "已从断点恢复执行（如并发已满会自动排队）" if resume else "已启动（如并发已满会自动排队）"
 
 
 @app.before_request
 def _attach_globals():
     g.max_concurrent = limiter.get_limit()
+    g.max_concurrent_cap = MAX_CONCURRENT_CAP
+    g.workflow_engine = WORKFLOW_ENGINE
     g.active_workers = limiter.get_running()
     g.artifact_root = ARTIFACT_ROOT
     g.workdir = WORKDIR
@@ -2208,6 +5720,7 @@ def healthz():
         "time": now_str(),
         "maxConcurrent": limiter.get_limit(),
         "activeWorkers": limiter.get_running(),
+        "workflowEngine": WORKFLOW_ENGINE,
     }
 
 
@@ -2244,6 +5757,7 @@ def dashboard():
             "done": conn.execute("SELECT COUNT(*) c FROM tasks WHERE status='done'").fetchone()["c"],
             "failed": conn.execute("SELECT COUNT(*) c FROM tasks WHERE status='failed'").fetchone()["c"],
         }
+        resumable_ids = {r["task_id"] for r in conn.execute("SELECT task_id FROM task_checkpoints").fetchall()}
 
     phase_order = ["待处理", "执行中", "待确认"]
     tasks_by_phase = {k: [] for k in phase_order}
@@ -2265,6 +5779,7 @@ def dashboard():
         workflows=workflows,
         running_count=len(running_processes),
         queue_count=queue_count,
+        resumable_ids=resumable_ids,
     )
 
 
@@ -2300,11 +5815,11 @@ def set_concurrency():
     try:
         val = int(raw)
     except Exception:
-        flash("并发上限必须是数字（1-16）")
+        flash(f"并发上限必须是数字（1-{MAX_CONCURRENT_CAP}）")
         return redirect(url_for("dashboard"))
 
-    if val < 1 or val > 16:
-        flash("并发上限范围必须在 1-16")
+    if val < 1 or val > MAX_CONCURRENT_CAP:
+        flash(f"并发上限范围必须在 1-{MAX_CONCURRENT_CAP}")
         return redirect(url_for("dashboard"))
 
     set_setting("max_concurrent", str(val))
@@ -2370,6 +5885,10 @@ def update_role_config(role_id: int):
     system_prompt = (request.form.get("system_prompt") or "").strip()
     temperature = (request.form.get("temperature") or "").strip()
     max_tokens = (request.form.get("max_tokens") or "").strip()
+    retry_max = (request.form.get("retry_max") or "").strip()
+    fallback_models = request.form.get("fallback_models")
+    hedge_enabled = (request.form.get("hedge_enabled") or "").strip()
+    prompt_token_budget = (request.form.get("prompt_token_budget") or "").strip()
 
     with db_conn() as conn:
         row = conn.execute("SELECT * FROM roles WHERE id=?", (role_id,)).fetchone()
@@ -2397,10 +5916,25 @@ def update_role_config(role_id: int):
         except Exception:
             fields["max_tokens"] = row["max_tokens"] if row["max_tokens"] is not None else 1200
 
+        try:
+            fields["retry_max"] = max(0, min(8, int(retry_max))) if retry_max else row["retry_max"]
+        except Exception:
+            fields["retry_max"] = row["retry_max"]
+
+        # 回退链：JSON 列表或逗号分隔的 model / model@api_base；提交空串表示清空
+        fields["fallback_models"] = fallback_models.strip() if fallback_models is not None else (row["fallback_models"] or "")
+        fields["hedge_enabled"] = (1 if hedge_enabled == "1" else 0) if hedge_enabled else row["hedge_enabled"]
+
+        try:
+            fields["prompt_token_budget"] = max(2000, int(prompt_token_budget)) if prompt_token_budget else row["prompt_token_budget"]
+        except Exception:
+            fields["prompt_token_budget"] = row["prompt_token_budget"]
+
         conn.execute(
             """
             UPDATE roles
-            SET default_model=?, api_base=?, api_key=?, system_prompt=?, temperature=?, max_tokens=?, updated_at=?
+            SET default_model=?, api_base=?, api_key=?, system_prompt=?, temperature=?, max_tokens=?,
+                retry_max=?, fallback_models=?, hedge_enabled=?, prompt_token_budget=?, updated_at=?
             WHERE id=?
             """,
             (
@@ -2410,6 +5944,10 @@ def update_role_config(role_id: int):
                 fields["system_prompt"],
                 fields["temperature"],
                 fields["max_tokens"],
+                fields["retry_max"],
+                fields["fallback_models"],
+                fields["hedge_enabled"],
+                fields["prompt_token_budget"],
                 fields["updated_at"],
                 role_id,
             ),
@@ -2430,6 +5968,20 @@ def create_workflow():
     default_task_type = (request.form.get("default_task_type") or "general").strip()
     default_assignee = (request.form.get("default_assignee") or "Lead Agent").strip()
     command_template = (request.form.get("command_template") or "").strip()
+    tool_limits = proc_limits.parse_limits(request.form.get("tool_limits") or "")
+    try:
+        reuse_ttl_raw = (request.form.get("reuse_ttl_sec") or "").strip()
+        reuse_ttl_sec = max(0, int(reuse_ttl_raw)) if reuse_ttl_raw else None
+    except Exception:
+        reuse_ttl_sec = None
+    try:
+        token_budget = max(0, int((request.form.get("token_budget") or "0").strip() or 0))
+    except Exception:
+        token_budget = 0
+    try:
+        deadline_sec = max(0, int((request.form.get("deadline_sec") or "0").strip() or 0))
+    except Exception:
+        deadline_sec = 0
     enabled = 1 if (request.form.get("enabled") or "1") == "1" else 0
 
     if not code or not name:
@@ -2438,15 +5990,20 @@ def create_workflow():
 
     stages = [x.strip() for x in re.split(r"[,，\n]+", stages_text) if x.strip()]
     stage_roles = parse_stage_roles(stage_roles_text)
-    stages_json = json.dumps(stages, ensure_ascii=False)
+    # 阶段依赖：阶段:依赖1|依赖2（依赖需为更早的阶段）
+    stage_deps = {k: [d.strip() for d in re.split(r"[|+]", v) if d.strip() in stages[: stages.index(k)]] for k, v in parse_stage_roles(request.form.get("stage_deps") or "").items() if k in stages}
+    stages_json = json.dumps([{"name": st, "after": stage_deps[st]} if st in stage_deps else st for st in stages], ensure_ascii=False)
     stage_roles_json = json.dumps(stage_roles, ensure_ascii=False)
 
     try:
         with db_conn() as conn:
             conn.execute(
                 """
-                INSERT INTO workflows(code, name, description, stages_json, stage_roles_json, default_task_type, default_assignee, command_template, enabled, created_at, updated_at)
-                VALUES(?,?,?,?,?,?,?,?,?,?,?)
+                INSERT INTO workflows(
+                    code, name, description, stages_json, stage_roles_json, default_task_type, default_assignee, command_template,
+                    tool_limits, reuse_ttl_sec, token_budget, deadline_sec, enabled, created_at, updated_at
+                )
+                VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
                 """,
                 (
                     code,
@@ -2457,6 +6014,10 @@ def create_workflow():
                     default_task_type,
                     default_assignee,
                     command_template,
+                    proc_limits.format_limits(tool_limits) if tool_limits else "",
+                    reuse_ttl_sec,
+                    token_budget,
+                    deadline_sec,
                     enabled,
                     now_str(),
                     now_str(),
@@ -2471,6 +6032,38 @@ def create_workflow():
     return redirect(url_for("dashboard"))
 
 
+@app.post("/workflows/<int:workflow_id>/config")
+@login_required
+def update_workflow_config(workflow_id: int):
+    """工作流级默认值（任务未单独设置时生效）；字段留空保持原值，填 0 表示不限/沿用全局默认。"""
+    token_budget = (request.form.get("token_budget") or "").strip()
+    deadline_sec = (request.form.get("deadline_sec") or "").strip()
+
+    with db_conn() as conn:
+        row = conn.execute("SELECT * FROM workflows WHERE id=?", (workflow_id,)).fetchone()
+        if not row:
+            flash("工作流不存在")
+            return redirect(url_for("dashboard"))
+
+        fields = {"updated_at": now_str()}
+        try:
+            fields["token_budget"] = max(0, int(token_budget)) if token_budget else row["token_budget"]
+        except Exception:
+            fields["token_budget"] = row["token_budget"]
+        try:
+            fields["deadline_sec"] = max(0, int(deadline_sec)) if deadline_sec else row["deadline_sec"]
+        except Exception:
+            fields["deadline_sec"] = row["deadline_sec"]
+
+        conn.execute(
+            "UPDATE workflows SET token_budget=?, deadline_sec=?, updated_at=? WHERE id=?",
+            (fields["token_budget"], fields["deadline_sec"], fields["updated_at"], workflow_id),
+        )
+
+    flash(f"工作流配置已更新：{row['name']}")
+    return redirect(url_for("dashboard"))
+
+
 @app.post("/workflows/<int:workflow_id>/toggle")
 @login_required
 def toggle_workflow(workflow_id: int):
@@ -2536,24 +6129,67 @@ def build_command_from_template(template_name: str, project_dir: str, task_brief
     return ""
 
 
-@app.post("/tasks")
-@login_required
-def create_task():
-    workflow_template = (request.form.get("workflow_template") or "intelligent_dual").strip()
-    task_brief = (request.form.get("task_brief") or "").strip()
-    delivery_expectation = (request.form.get("delivery_expectation") or "").strip()
-    project_dir = (request.form.get("project_dir") or "").strip()
-    raw_command = (request.form.get("command") or "").strip()
+def blob_path(sha: str) -> str:
+    return os.path.join(BLOB_DIR, sha[:2], sha)
+
+
+def store_blob(stream) -> tuple[str, int]:
+    """流式写入共享附件存储，按内容 sha256 去重，返回 (sha256, 字节数)。"""
+    os.makedirs(BLOB_DIR, exist_ok=True)
+    tmp = os.path.join(BLOB_DIR, f".upload.{os.getpid()}.{threading.get_ident()}.tmp")
+    h, size = hashlib.sha256(), 0
+    with open(tmp, "wb") as f:
+        for chunk in iter(lambda: stream.read(1 << 20), b""):
+            h.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    sha = h.hexdigest()
+    dst = blob_path(sha)
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    os.replace(tmp, dst)
+    return sha, size
 
-    # 重构后默认不做“强制自动路由”，让双角色自主评估与分配执行路径
-    auto_routed = False
 
-    title = derive_title(request.form.get("title", ""), task_brief, workflow_template)
+def parse_blob_attachments(items) -> list:
+    """[{"name": 文件名, "blob": sha256}, ...] -> [(安全文件名, sha256)]；blob 不存在时抛 ValueError。"""
+    out = []
+    for item in items or []:
+        if not isinstance(item, dict):
+            raise ValueError("附件需为 {name, blob} 对象")
+        name = secure_filename(str(item.get("name") or ""))
+        sha = str(item.get("blob") or "").strip().lower()
+        if not name or not re.fullmatch(r"[0-9a-f]{64}", sha):
+            raise ValueError(f"附件参数无效：{item}")
+        if not os.path.isfile(blob_path(sha)):
+            raise ValueError(f"附件 blob 不存在，请先上传：{sha}")
+        out.append((name, sha))
+    return out
+
+
+def build_task_spec(form, wf) -> dict:
+    """表单与批量接口共用：由提交字段得到任务行字段与创建日志。form 只需支持 get。"""
+
+    def field(key: str, default: str = "") -> str:
+        v = form.get(key)
+        return (str(v) if v not in (None, "") else default).strip()
+
+    workflow_template = field("workflow_template", "intelligent_dual")
+    task_brief = field("task_brief")
+    delivery_expectation = field("delivery_expectation")
+    try:
+        token_budget = max(0, int(field("token_budget", "0") or 0))
+    except Exception:
+        token_budget = 0
+    try:
+        deadline_sec = max(0, int(field("deadline_sec", "0") or 0))
+    except Exception:
+        deadline_sec = 0
+
+    title = derive_title(field("title"), task_brief, workflow_template)
     if not title:
-        flash("请至少填写任务描述或标题")
-        return redirect(url_for("dashboard"))
+        raise ValueError("请至少填写任务描述或标题")
 
-    description_raw = (request.form.get("description", "") or "").strip()
+    description_raw = field("description")
     desc_parts = []
     if task_brief:
         desc_parts.append(f"【任务描述】\n{task_brief}")
@@ -2563,12 +6199,8 @@ def create_task():
         desc_parts.append(f"【补充说明】\n{description_raw}")
     description = "\n\n".join(desc_parts).strip()
 
-    wf = get_workflow_by_code(workflow_template)
-
-    task_type = (request.form.get("task_type") or "general").strip()
-    assignee = (request.form.get("assignee") or "Lead Agent").strip()
-    priority = (request.form.get("priority") or "P2").strip()
-
+    task_type = field("task_type", "general")
+    assignee = field("assignee", "Lead Agent")
     # 若未手工指定，优先套用工作流默认角色/类型
     if wf:
         if task_type == "general" and (wf["default_task_type"] or "").strip():
@@ -2576,28 +6208,70 @@ def create_task():
         if assignee in ("", "Lead Agent", "backend") and (wf["default_assignee"] or "").strip():
             assignee = (wf["default_assignee"] or "Lead Agent").strip()
 
-    command = raw_command
-    if not command:
-        command = build_command_from_template(workflow_template, project_dir, task_brief)
-
-    with db_conn() as conn:
-        cur = conn.execute(
-            """
-            INSERT INTO tasks(title, description, task_type, assignee, priority, status, command, workflow_code, created_at, updated_at)
-            VALUES(?,?,?,?,?,'pending',?,?,?,?)
-            """,
-            (title, description, task_type, assignee, priority, command, workflow_template, now_str(), now_str()),
-        )
-        task_id = cur.lastrowid
+    command = field("command") or build_command_from_template(workflow_template, field("project_dir"), task_brief)
 
-    append_log(task_id, f"[SYSTEM] 任务创建：{title}")
-    append_log(task_id, f"[SYSTEM] 工作流模板：{workflow_template}")
-    if auto_routed:
-        append_log(task_id, "[SYSTEM] 已根据任务内容自动路由到 novel_multiagent 专用流水线")
+    logs = [f"[SYSTEM] 任务创建：{title}", f"[SYSTEM] 工作流模板：{workflow_template}"]
     if task_brief:
-        append_log(task_id, f"[SYSTEM] 口语化任务描述：{task_brief[:1200]}")
+        logs.append(f"[SYSTEM] 口语化任务描述：{task_brief[:1200]}")
     if delivery_expectation:
-        append_log(task_id, f"[SYSTEM] 期望交付：{delivery_expectation[:800]}")
+        logs.append(f"[SYSTEM] 期望交付：{delivery_expectation[:800]}")
+    return {
+        "title": title,
+        "description": description,
+        "task_type": task_type,
+        "assignee": assignee,
+        "priority": field("priority", "P2"),
+        "command": command,
+        "workflow_code": workflow_template,
+        "token_budget": token_budget or None,
+        "deadline_sec": deadline_sec or None,
+        "fingerprint": None,
+        "logs": logs,
+    }
+
+
+def insert_tasks(specs: list) -> list:
+    """单个事务写入任务行与创建日志，返回新任务 id。"""
+    ids, logs = [], []
+    ts = now_str()
+    with db_conn() as conn:
+        for spec in specs:
+            cur = conn.execute(
+                """
+                INSERT INTO tasks(title, description, task_type, assignee, priority, status, command, workflow_code, token_budget, deadline_sec, fingerprint, created_at, updated_at)
+                VALUES(?,?,?,?,?,'pending',?,?,?,?,?,?,?)
+                """,
+                (
+                    spec["title"],
+                    spec["description"],
+                    spec["task_type"],
+                    spec["assignee"],
+                    spec["priority"],
+                    spec["command"],
+                    spec["workflow_code"],
+                    spec["token_budget"],
+                    spec["deadline_sec"],
+                    spec["fingerprint"],
+                    ts,
+                    ts,
+                ),
+            )
+            ids.append(cur.lastrowid)
+            logs.extend((cur.lastrowid, ts, line[:4000]) for line in spec["logs"])
+        conn.executemany("INSERT INTO task_logs(task_id, ts, line) VALUES(?,?,?)", logs)
+    return ids
+
+
+@app.post("/tasks")
+@login_required
+def create_task():
+    wf = get_workflow_by_code((request.form.get("workflow_template") or "intelligent_dual").strip())
+    try:
+        spec = build_task_spec(request.form, wf)
+    except ValueError as e:
+        flash(str(e))
+        return redirect(url_for("dashboard"))
+    task_id = insert_tasks([spec])[0]
 
     _, input_dir, _ = task_artifact_dirs(task_id)
     uploaded = 0
@@ -2612,10 +6286,17 @@ def create_task():
         uploaded += 1
         append_log(task_id, f"[SYSTEM] 已上传附件: {safe_name}")
 
+    refresh_task_fingerprint(task_id)
+    source = find_reusable_task(get_task(task_id))
+    reuse_note = ""
+    if source:
+        append_log(task_id, f"[SYSTEM] 与任务 #{source['id']} 指纹相同（{source['ageSec']}s 前成功完成），可复用其结果")
+        reuse_note = f"；与任务 #{source['id']} 相同，" + ("启动时将直接复用其结果" if TASK_REUSE == "auto" else "可在任务详情页一键复用其结果")
+
     if uploaded > 0:
-        flash(f"任务 #{task_id} 创建成功，已上传 {uploaded} 个附件")
+        flash(f"任务 #{task_id} 创建成功，已上传 {uploaded} 个附件{reuse_note}")
     else:
-        flash(f"任务 #{task_id} 创建成功")
+        flash(f"任务 #{task_id} 创建成功{reuse_note}")
     return redirect(url_for("dashboard"))
 
 
@@ -2627,6 +6308,42 @@ def start_task_route(task_id: int):
     return redirect(url_for("dashboard"))
 
 
+@app.post("/tasks/<int:task_id>/resume")
+@login_required
+def resume_task_route(task_id: int):
+    task = get_task(task_id)
+    if not task:
+        flash("任务不存在")
+        return redirect(url_for("dashboard"))
+    checkpoint, reason = usable_checkpoint(task_id, task)
+    if not checkpoint:
+        flash(f"任务 #{task_id}: {reason}，请使用“启动”从头执行")
+        return redirect(request.referrer or url_for("dashboard"))
+    ok, msg = start_task(task_id, resume=True)
+    flash(f"任务 #{task_id}: {msg}")
+    return redirect(request.referrer or url_for("dashboard"))
+
+
+@app.post("/tasks/<int:task_id>/reuse")
+@login_required
+def reuse_task_route(task_id: int):
+    task = get_task(task_id)
+    if not task:
+        flash("任务不存在")
+        return redirect(url_for("dashboard"))
+    if task_id in running_processes or task["status"] == "running":
+        flash(f"任务 #{task_id} 正在运行或排队中，请先停止")
+        return redirect(request.referrer or url_for("dashboard"))
+    refresh_task_fingerprint(task_id)
+    source = find_reusable_task(get_task(task_id))
+    if not source:
+        flash(f"任务 #{task_id}: 没有时效内可复用的相同任务结果，请使用“启动”执行")
+        return redirect(request.referrer or url_for("dashboard"))
+    files = apply_task_reuse(task_id, source)
+    flash(f"任务 #{task_id}: 已复用任务 #{source['id']} 的结果（{files} 个产物文件）")
+    return redirect(url_for("task_detail", task_id=task_id))
+
+
 @app.post("/tasks/<int:task_id>/retry")
 @login_required
 def retry_task(task_id: int):
@@ -2635,6 +6352,12 @@ def retry_task(task_id: int):
         flash("任务不存在")
         return redirect(url_for("dashboard"))
 
+    if "reused_from" in task.keys() and task["reused_from"]:
+        # 复用结果后再重置，视为要求完整重新执行
+        update_task(task_id, status="pending", finished_at=None, started_at=None, return_code=None, reused_from=None, reuse_disabled=1)
+        append_log(task_id, "[SYSTEM] 任务重置为 pending（之前复用了其他任务的结果，重新启动时将完整执行）")
+        flash(f"任务 #{task_id} 已重置")
+        return redirect(url_for("dashboard"))
     update_task(task_id, status="pending", finished_at=None, started_at=None, return_code=None)
     append_log(task_id, "[SYSTEM] 任务重置为 pending")
     flash(f"任务 #{task_id} 已重置")
@@ -2644,6 +6367,15 @@ def retry_task(task_id: int):
 @app.post("/tasks/<int:task_id>/stop")
 @login_required
 def stop_task(task_id: int):
+    token = task_cancel_tokens.get(task_id)
+    if token is not None:
+        running_processes.pop(task_id, None)
+        update_task(task_id, status="failed", finished_at=now_str(), return_code=143)
+        append_log(task_id, "[SYSTEM] 手动停止任务，正在中止在途模型请求与工具命令")
+        token.cancel("手动停止")
+        flash(f"任务 #{task_id} 已停止")
+        return redirect(url_for("dashboard"))
+
     proc = running_processes.get(task_id)
     if proc is None and task_id in running_processes:
         running_processes.pop(task_id, None)
@@ -2689,6 +6421,11 @@ def delete_task(task_id: int):
         with db_conn() as conn:
             conn.execute("DELETE FROM task_logs WHERE task_id=?", (task_id,))
             conn.execute("DELETE FROM role_session_messages WHERE task_id=?", (task_id,))
+            conn.execute("DELETE FROM role_session_summaries WHERE task_id=?", (task_id,))
+            conn.execute("DELETE FROM llm_usage WHERE task_id=?", (task_id,))
+            conn.execute("DELETE FROM task_checkpoints WHERE task_id=?", (task_id,))
+            conn.execute("DELETE FROM webhook_deliveries WHERE webhook_id IN (SELECT id FROM webhooks WHERE task_id=?)", (task_id,))
+            conn.execute("DELETE FROM webhooks WHERE task_id=?", (task_id,))
             conn.execute("DELETE FROM tasks WHERE id=?", (task_id,))
 
         task_dir = os.path.join(ARTIFACT_ROOT, f"task_{task_id}")
@@ -2722,6 +6459,8 @@ def task_upload(task_id: int):
         f.save(target)
         uploaded += 1
         append_log(task_id, f"[SYSTEM] 已追加上传附件: {safe_name}")
+    if uploaded:
+        refresh_task_fingerprint(task_id)
 
     if uploaded == 0:
         flash("未检测到可上传文件")
@@ -2762,6 +6501,11 @@ def task_detail(task_id: int):
     output_files = list_task_files(task_id, "output")
     delivery = build_delivery_overview(task, output_files, logs)
     multiagent = load_multiagent_summary(output_dir)
+    usage = load_task_usage(task_id, task_token_budget(task, get_workflow_by_code(task["workflow_code"] or "")))
+    resources = json.loads(task["resource_json"] or "{}") if "resource_json" in task.keys() else {}
+    # 失败或到截止时间收尾（done/rc=124）的任务都可能保留断点
+    checkpoint = load_checkpoint(task_id) if task["status"] != "running" else None
+    reuse_source = find_reusable_task(task) if task["status"] in ("pending", "failed") and task_id not in running_processes else None
 
     return render_template(
         "task_detail.html",
@@ -2769,26 +6513,331 @@ def task_detail(task_id: int):
         logs=logs,
         delivery=delivery,
         multiagent=multiagent,
+        usage=usage,
+        resources=resources,
         base_dir=base,
         input_dir=input_dir,
         output_dir=output_dir,
         input_files=input_files,
         output_files=output_files,
+        checkpoint=checkpoint,
+        reuse_source=reuse_source,
     )
 
 
+@app.route("/usage")
+@login_required
+def usage_page():
+    try:
+        days = max(1, min(90, int(request.args.get("days") or 7)))
+    except Exception:
+        days = 7
+    return render_template("usage.html", usage=load_usage_overview(days))
+
+
+def encode_task_cursor(kind: str, *values) -> str:
+    return base64.urlsafe_b64encode(json.dumps([kind, *values]).encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_task_cursor(text: str) -> list:
+    raw = base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+    cursor = json.loads(raw)
+    if not isinstance(cursor, list) or cursor[:1] not in (["d"], ["i"], ["u"]) or len(cursor) != (3 if cursor[0] == "u" else 2):
+        raise ValueError("cursor 无效")
+    if cursor[0] == "u" and not isinstance(cursor[1], str):
+        raise ValueError("cursor 无效")
+    if not isinstance(cursor[-1], int) or isinstance(cursor[-1], bool):
+        raise ValueError("cursor 无效")
+    return cursor
+
+
 @app.route("/api/tasks")
 @login_required
 def api_tasks():
+    """任务列表。默认按 id 倒序返回最新 limit 条；增量拉取：
+    after_id=N 返回 id>N 的新任务，since_updated_at=TS 返回 updated_at>=TS 的任务（按 updated_at, id 正序）；
+    响应头 X-Next-Cursor 为下一页/下次拉取的游标（传 cursor= 续拉，不重复不遗漏），fields= 只返回指定列；
+    带弱 ETag，If-None-Match 命中时返回 304。"""
+    args = request.args
+    try:
+        limit = max(1, min(1000, int(args.get("limit") or 200)))
+        if args.get("cursor"):
+            cursor = decode_task_cursor(args["cursor"])
+        elif args.get("since_updated_at"):
+            cursor = ["u", args["since_updated_at"].strip(), 0]
+        elif args.get("after_id"):
+            cursor = ["i", int(args["after_id"])]
+        else:
+            cursor = ["d", None]
+    except (ValueError, TypeError):
+        return jsonify({"error": "limit / after_id / cursor 参数无效"}), 400
+
+    with db_conn() as conn:
+        columns = [r[1] for r in conn.execute("PRAGMA table_info(tasks)").fetchall()]
+        fields = [f.strip() for f in (args.get("fields") or "").split(",") if f.strip()]
+        unknown = [f for f in fields if f not in columns]
+        if unknown:
+            return jsonify({"error": f"未知字段：{','.join(unknown)}", "fields": columns}), 400
+        # 游标依赖 id / updated_at，投影时总是带上
+        select = ", ".join(dict.fromkeys(["id", "updated_at", *fields])) if fields else "*"
+        kind = cursor[0]
+        if kind == "u":
+            rows = conn.execute(
+                f"SELECT {select} FROM tasks WHERE updated_at>? OR (updated_at=? AND id>?) ORDER BY updated_at, id LIMIT ?",
+                (cursor[1], cursor[1], int(cursor[2]), limit + 1),
+            ).fetchall()
+        elif kind == "i":
+            rows = conn.execute(f"SELECT {select} FROM tasks WHERE id>? ORDER BY id LIMIT ?", (int(cursor[1]), limit + 1)).fetchall()
+        elif cursor[1] is None:
+            rows = conn.execute(f"SELECT {select} FROM tasks ORDER BY id DESC LIMIT ?", (limit + 1,)).fetchall()
+        else:
+            rows = conn.execute(f"SELECT {select} FROM tasks WHERE id<? ORDER BY id DESC LIMIT ?", (int(cursor[1]), limit + 1)).fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    items = [{k: r[k] for k in fields} if fields else dict(r) for r in rows]
+    next_cursor = ""
+    if kind == "u":
+        if not rows:
+            next_cursor = encode_task_cursor("u", cursor[1], int(cursor[2]))
+        elif not has_more and rows[-1]["updated_at"] >= now_str():
+            # updated_at 只精确到秒：追平时若最后一秒尚未结束，同一秒内稍后更新的小 id 任务会落在 (ts, id) 之前，游标退回该秒开头
+            next_cursor = encode_task_cursor("u", rows[-1]["updated_at"], 0)
+        else:
+            next_cursor = encode_task_cursor("u", rows[-1]["updated_at"], rows[-1]["id"])
+    elif kind == "i":
+        next_cursor = encode_task_cursor("i", rows[-1]["id"] if rows else int(cursor[1]))
+    elif has_more:
+        next_cursor = encode_task_cursor("d", rows[-1]["id"])
+
+    body = json.dumps(items, ensure_ascii=False, separators=(",", ":"))
+    etag = hashlib.sha256(body.encode("utf-8")).hexdigest()[:32]
+    headers = {"Cache-Control": "private, no-cache", "X-Has-More": "1" if has_more else "0"}
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
+        if has_more:
+            headers["Link"] = f'<{url_for("api_tasks", cursor=next_cursor, limit=limit, fields=args.get("fields") or None)}>; rel="next"'
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304, headers=headers)
+    else:
+        resp = app.response_class(body, mimetype="application/json", headers=headers)
+    resp.set_etag(etag, weak=True)
+    return resp
+
+
+@app.post("/api/blobs")
+@login_required
+def api_upload_blobs():
+    """上传共享附件（multipart 的 file 字段可多个，或直接以请求体上传单个文件），返回各文件的 blob 哈希。"""
+    out = []
+    for f in request.files.getlist("file"):
+        if f and f.filename:
+            sha, size = store_blob(f.stream)
+            out.append({"name": secure_filename(f.filename), "blob": sha, "size": size})
+    if not out and not request.files:
+        sha, size = store_blob(request.stream)
+        out.append({"name": secure_filename(request.args.get("name") or ""), "blob": sha, "size": size})
+    return jsonify({"blobs": out})
+
+
+@app.route("/api/blobs/<sha>")
+@login_required
+def api_blob_info(sha: str):
+    path = blob_path(sha.lower()) if re.fullmatch(r"[0-9a-fA-F]{64}", sha) else ""
+    if not path or not os.path.isfile(path):
+        return jsonify({"error": "blob 不存在"}), 404
+    return jsonify({"blob": sha.lower(), "size": os.path.getsize(path)})
+
+
+@app.post("/api/tasks/bulk")
+@login_required
+def api_create_tasks_bulk():
+    """批量创建任务：{"tasks": [任务字段...], "attachments": [共享附件], "start": false}。
+    任务字段同创建表单，另可带 attachments: [{"name", "blob"}]；全部任务与创建日志在一个事务内写入。"""
+    payload = request.get_json(silent=True) or {}
+    items = payload.get("tasks")
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "tasks 需为非空列表"}), 400
+    if len(items) > BULK_TASK_MAX:
+        return jsonify({"error": f"单次最多 {BULK_TASK_MAX} 个任务"}), 400
+
+    try:
+        shared = parse_blob_attachments(payload.get("attachments"))
+    except ValueError as e:
+        return jsonify({"error": f"共享附件：{e}"}), 400
+
+    workflows, specs, attachments = {}, [], []
+    roles = load_fingerprint_roles()
+    for i, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise ValueError("任务需为对象")
+            code = str(item.get("workflow_template") or "intelligent_dual").strip()
+            if code not in workflows:
+                workflows[code] = get_workflow_by_code(code)
+            spec = build_task_spec(item, workflows[code])
+            files = dict(shared)
+            files.update(parse_blob_attachments(item.get("attachments")))
+        except ValueError as e:
+            return jsonify({"error": f"第 {i + 1} 个任务：{e}"}), 400
+        spec["fingerprint"] = compute_task_fingerprint(
+            spec["workflow_code"], spec["command"], spec["description"], workflows[code], roles, [list(x) for x in files.items()]
+        )
+        spec["logs"] += [f"[SYSTEM] 已添加共享附件: {name}（blob {sha[:12]}）" for name, sha in files.items()]
+        specs.append(spec)
+        attachments.append(files)
+
+    ids = insert_tasks(specs)
+    for task_id, files in zip(ids, attachments):
+        if files:
+            _, input_dir, _ = task_artifact_dirs(task_id)
+            for name, sha in files.items():
+                shutil.copyfile(blob_path(sha), os.path.join(input_dir, name))
+
+    started = []
+    if payload.get("start"):
+        for task_id in ids:
+            ok, _ = start_task(task_id)
+            if ok:
+                started.append(task_id)
+    return jsonify({"ids": ids, "count": len(ids), "started": started}), 201
+
+
+@app.route("/api/tasks/<int:task_id>/wait")
+@login_required
+def api_wait_task(task_id: int):
+    """长轮询：任务进入终态（done/failed）即返回，最多等待 timeout 秒（上限 ATC_TASK_WAIT_MAX_SEC）。
+    挂起的等待数达到 ATC_TASK_WAIT_MAX_WAITERS 时不再等待，返回 429 与当前状态。"""
+    try:
+        timeout = max(0.0, min(float(request.args.get("timeout") or 30), TASK_WAIT_MAX_SEC))
+    except ValueError:
+        timeout = 30.0
+    if not task_waiters.acquire(blocking=False):
+        task = get_task(task_id)
+        if not task:
+            return jsonify({"error": "任务不存在"}), 404
+        payload = {**task_status_payload(task), "timedOut": task["status"] not in TASK_TERMINAL_STATUSES, "error": "等待中的请求过多，请稍后重试"}
+        return jsonify(payload), 429, {"Retry-After": "1"}
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            with task_status_cond:
+                seen = task_status_state["seq"]
+            task = get_task(task_id)
+            if not task:
+                return jsonify({"error": "任务不存在"}), 404
+            remaining = deadline - time.monotonic()
+            if task["status"] in TASK_TERMINAL_STATUSES or remaining <= 0:
+                return jsonify({**task_status_payload(task), "timedOut": task["status"] not in TASK_TERMINAL_STATUSES})
+            # 本进程内的状态变更立即唤醒；其他进程（多 worker 部署）改的状态最迟 1 秒后被看到
+            with task_status_cond:
+                task_status_cond.wait_for(lambda: task_status_state["seq"] != seen, timeout=min(remaining, 1.0))
+    finally:
+        task_waiters.release()
+
+
+def webhook_to_dict(row) -> dict:
+    return {
+        "id": row["id"],
+        "url": row["url"],
+        "taskId": row["task_id"],
+        "events": [x for x in (row["events"] or "").split(",") if x],
+        "enabled": bool(row["enabled"]),
+        "secret": mask_secret(row["secret"] or ""),
+        "createdAt": row["created_at"],
+    }
+
+
+@app.route("/api/webhooks")
+@login_required
+def api_list_webhooks():
+    with db_conn() as conn:
+        hooks = conn.execute("SELECT * FROM webhooks ORDER BY id").fetchall()
+        counts = conn.execute("SELECT webhook_id, status, COUNT(*) c FROM webhook_deliveries GROUP BY webhook_id, status").fetchall()
+    out = []
+    for h in hooks:
+        d = webhook_to_dict(h)
+        d["deliveries"] = {r["status"]: r["c"] for r in counts if r["webhook_id"] == h["id"]}
+        out.append(d)
+    return jsonify(out)
+
+
+@app.post("/api/webhooks")
+@login_required
+def api_create_webhook():
+    """订阅任务状态变更：{"url", "task_id"（省略为全局）, "events": ["done", "failed"]（省略为全部状态）, "secret"}。
+    未提供 secret 且未配置 ATC_WEBHOOK_SECRET 时生成一个，仅在本次响应中返回。"""
+    payload = request.get_json(silent=True) or {}
+    url = str(payload.get("url") or "").strip()
+    if urllib.parse.urlsplit(url).scheme not in ("http", "https"):
+        return jsonify({"error": "url 需为 http(s) 地址"}), 400
+    events = payload.get("events") or []
+    if isinstance(events, str):
+        events = re.split(r"[,，\s]+", events)
+    events = [x.strip() for x in events if x and x.strip()]
+    if any(x not in ("pending", "running", "done", "failed") for x in events):
+        return jsonify({"error": "events 只能包含 pending/running/done/failed"}), 400
+    task_id = payload.get("task_id")
+    if task_id is not None:
+        try:
+            task_id = int(task_id)
+        except (TypeError, ValueError):
+            return jsonify({"error": "task_id 无效"}), 400
+        if not get_task(task_id):
+            return jsonify({"error": "任务不存在"}), 404
+    secret = str(payload.get("secret") or "").strip()
+    generated = not secret and not WEBHOOK_SECRET
+    if generated:
+        secret = secrets.token_hex(16)
+    with db_conn() as conn:
+        hook_id = conn.execute(
+            "INSERT INTO webhooks(url, secret, task_id, events, enabled, created_at) VALUES(?,?,?,?,1,?)",
+            (url, secret or None, task_id, ",".join(events), now_str()),
+        ).lastrowid
+        row = conn.execute("SELECT * FROM webhooks WHERE id=?", (hook_id,)).fetchone()
+    out = webhook_to_dict(row)
+    if generated:
+        out["secret"] = secret
+    return jsonify(out), 201
+
+
+@app.delete("/api/webhooks/<int:hook_id>")
+@login_required
+def api_delete_webhook(hook_id: int):
+    with db_conn() as conn:
+        cur = conn.execute("DELETE FROM webhooks WHERE id=?", (hook_id,))
+        conn.execute("DELETE FROM webhook_deliveries WHERE webhook_id=? AND status IN ('pending', 'sending')", (hook_id,))
+    if not cur.rowcount:
+        return jsonify({"error": "webhook 不存在"}), 404
+    return jsonify({"deleted": hook_id})
+
+
+@app.route("/api/webhooks/<int:hook_id>/deliveries")
+@login_required
+def api_webhook_deliveries(hook_id: int):
+    try:
+        limit = max(1, min(500, int(request.args.get("limit") or 50)))
+    except ValueError:
+        limit = 50
     with db_conn() as conn:
-        rows = conn.execute("SELECT * FROM tasks ORDER BY id DESC LIMIT 200").fetchall()
+        rows = conn.execute(
+            """
+            SELECT id, task_id, event, status, attempts, last_status, last_error, created_at, delivered_at
+            FROM webhook_deliveries WHERE webhook_id=? ORDER BY id DESC LIMIT ?
+            """,
+            (hook_id, limit),
+        ).fetchall()
     return jsonify([dict(r) for r in rows])
 
 
 if __name__ == "__main__":
     init_db()
+    init_llm_cache()
     sync_runtime_settings()
+    resume_webhook_deliveries()
     app.run(host="127.0.0.1", port=3100, debug=False)
 else:
     init_db()
+    init_llm_cache()
     sync_runtime_settings()
+    resume_webhook_deliveries()
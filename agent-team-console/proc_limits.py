@@ -0,0 +1,309 @@
+"""
+工具/命令子进程的资源限制与用量统计
+
+限制（在子进程 exec 前生效）：bash 路径由 shell 前缀（ulimit、写 cgroup.procs）设置后再 exec 命令，
+不在多线程的服务进程 fork 出的子进程里执行 Python；预热执行器（单线程）在 fork 后的子进程内设置：
+  cpu_sec   RLIMIT_CPU，超出软限制收到 SIGXCPU，再超 5 秒被 SIGKILL
+  mem_mb    配置 cgroup 时写 memory.max（按整个进程树的常驻内存计）；否则退化为 RLIMIT_AS（按虚拟地址空间计）
+  pids      仅在配置 cgroup 时写 pids.max（RLIMIT_NPROC 按用户统计，不适合单条命令）
+  wall_sec  由调用方作为超时处理
+用量：wait4 回收得到 rusage（CPU 秒、峰值 RSS、块 I/O）；配置 cgroup 时以 cpu.stat / memory.peak / io.stat 为准，
+覆盖脱离进程组或未被回收的后代进程。
+
+cgroup v2：ATC_TOOL_CGROUP_ROOT 指向一个已委派、本身不含进程且 subtree_control 已开启 memory/pids 的目录，
+每条命令在其下建独立子 cgroup，结束后删除。
+"""
+
+import asyncio
+import json
+import os
+import re
+import resource
+import shlex
+import signal
+import threading
+import time
+
+LIMIT_KEYS = ("cpu_sec", "mem_mb", "pids", "wall_sec")
+LIMIT_ALIASES = {"cpu": "cpu_sec", "mem": "mem_mb", "memory": "mem_mb", "pids": "pids", "wall": "wall_sec", "timeout": "wall_sec"}
+CPU_KILL_GRACE_SEC = 5
+MEMORY_ERROR_RE = re.compile(r"MemoryError|Cannot allocate memory|std::bad_alloc|out of memory", re.I)
+
+
+def parse_limits(text) -> dict:
+    """解析 `cpu=60,mem=1024,pids=64,wall=300` 或等价 JSON；未知键与非正数忽略。"""
+    if isinstance(text, dict):
+        raw = text
+    else:
+        text = (text or "").strip()
+        if not text:
+            return {}
+        try:
+            raw = json.loads(text)
+        except ValueError:
+            raw = dict(part.split("=", 1) for part in re.split(r"[,，\s]+", text) if "=" in part)
+    out = {}
+    for k, v in (raw or {}).items():
+        key = LIMIT_ALIASES.get(str(k).strip().lower(), str(k).strip().lower())
+        try:
+            n = int(float(v))
+        except (TypeError, ValueError):
+            continue
+        if key in LIMIT_KEYS and n > 0:
+            out[key] = n
+    return out
+
+
+def merge_limits(*layers) -> dict:
+    """后面的层覆盖前面的层。"""
+    out = {}
+    for layer in layers:
+        out.update({k: v for k, v in (layer or {}).items() if v})
+    return out
+
+
+def format_limits(limits: dict) -> str:
+    return ",".join(f"{k}={limits[k]}" for k in LIMIT_KEYS if limits.get(k)) or "不限"
+
+
+def apply_rlimits(limits: dict, use_cgroup: bool = False):
+    """在子进程内调用。cgroup 生效时内存交给 memory.max，不再设 RLIMIT_AS。"""
+    cpu = limits.get("cpu_sec")
+    if cpu:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + CPU_KILL_GRACE_SEC))
+    mem = limits.get("mem_mb")
+    if mem and not use_cgroup:
+        resource.setrlimit(resource.RLIMIT_AS, (mem * 1024 * 1024, mem * 1024 * 1024))
+
+
+def enter_cgroup(path: str):
+    """在子进程内调用：把当前进程移入 cgroup（写 0 表示写入者自身）。"""
+    with open(os.path.join(path, "cgroup.procs"), "w") as f:
+        f.write("0")
+
+
+def child_setup(limits: dict, cgroup_path: str = ""):
+    """返回 exec 前在子进程执行的回调；无需限制时返回 None。"""
+    if not limits and not cgroup_path:
+        return None
+
+    def setup():
+        in_cgroup = False
+        if cgroup_path:
+            try:
+                enter_cgroup(cgroup_path)
+                in_cgroup = True
+            except OSError:
+                pass
+        apply_rlimits(limits, use_cgroup=in_cgroup)
+
+    return setup
+
+
+def shell_prefix(limits: dict, cgroup_path: str = "") -> str:
+    """bash 路径下与 child_setup 等价的 shell 语句：先进 cgroup（失败则退化为 rlimit），再设 ulimit；无需限制时返回空串。"""
+    lines = []
+    cpu = limits.get("cpu_sec")
+    if cpu:
+        lines.append(f"ulimit -t {cpu + CPU_KILL_GRACE_SEC} && ulimit -S -t {cpu}")
+    mem = limits.get("mem_mb")
+    mem_line = f"ulimit -v {mem * 1024}" if mem else ":"
+    if cgroup_path:
+        procs = shlex.quote(os.path.join(cgroup_path, "cgroup.procs"))
+        lines.append(f"{{ printf 0 > {procs}; }} 2>/dev/null || {mem_line}")
+    elif mem:
+        lines.append(mem_line)
+    return "".join(f"{ln}\n" for ln in lines)
+
+
+def create_cgroup(root: str, name: str, limits: dict) -> str:
+    """在 root 下建子 cgroup 并写入限制；root 未配置或不可写时返回空串，调用方退化为 rlimit。"""
+    if not root:
+        return ""
+    path = os.path.join(root, name)
+    try:
+        os.makedirs(path, exist_ok=True)
+        if limits.get("mem_mb"):
+            _write(path, "memory.max", str(limits["mem_mb"] * 1024 * 1024))
+            _write(path, "memory.swap.max", "0", required=False)
+        if limits.get("pids"):
+            _write(path, "pids.max", str(limits["pids"]))
+    except OSError:
+        remove_cgroup(path)
+        return ""
+    return path
+
+
+def remove_cgroup(path: str):
+    if not path:
+        return
+    try:
+        _write(path, "cgroup.kill", "1", required=False)
+        for _ in range(50):
+            try:
+                os.rmdir(path)
+                return
+            except OSError:
+                time.sleep(0.02)
+    except OSError:
+        pass
+
+
+def _write(path: str, name: str, value: str, required: bool = True):
+    try:
+        with open(os.path.join(path, name), "w") as f:
+            f.write(value)
+    except OSError:
+        if required:
+            raise
+
+
+def _read_kv(path: str, name: str) -> dict:
+    try:
+        with open(os.path.join(path, name)) as f:
+            return {k: int(v) for k, v in (ln.split() for ln in f if len(ln.split()) == 2)}
+    except (OSError, ValueError):
+        return {}
+
+
+def cgroup_usage(path: str) -> dict:
+    """读取 cgroup 内整个进程树的用量；读不到的项不返回。"""
+    out = {}
+    cpu = _read_kv(path, "cpu.stat")
+    if "usage_usec" in cpu:
+        out["cpuSec"] = round(cpu["usage_usec"] / 1e6, 3)
+    try:
+        with open(os.path.join(path, "memory.peak")) as f:
+            out["maxRssMb"] = round(int(f.read().strip()) / 1024 / 1024, 1)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(os.path.join(path, "io.stat")) as f:
+            rbytes = wbytes = 0
+            for ln in f:
+                fields = dict(x.split("=", 1) for x in ln.split()[1:] if "=" in x)
+                rbytes += int(fields.get("rbytes", 0))
+                wbytes += int(fields.get("wbytes", 0))
+            out["ioReadBytes"], out["ioWriteBytes"] = rbytes, wbytes
+    except (OSError, ValueError):
+        pass
+    events = _read_kv(path, "memory.events")
+    if events.get("oom_kill"):
+        out["oomKill"] = events["oom_kill"]
+    return out
+
+
+def rusage_to_usage(ru) -> dict:
+    return {
+        "cpuSec": round(ru.ru_utime + ru.ru_stime, 3),
+        "maxRssMb": round(ru.ru_maxrss / 1024, 1),
+        "ioReadBytes": ru.ru_inblock * 512,
+        "ioWriteBytes": ru.ru_oublock * 512,
+    }
+
+
+# 子进程已被别处回收、拿不到真实退出状态时使用的返回码
+UNKNOWN_EXIT_RC = -1
+
+
+def status_to_rc(status: int) -> int:
+    """被信号终止时为 128+信号值，与 bash 一致。"""
+    rc = os.waitstatus_to_exitcode(status)
+    return 128 - rc if rc < 0 else rc
+
+
+async def wait_pid(pid: int):
+    """异步回收子进程并取得 rusage，返回 (rc, usage)。优先用 pidfd 挂到事件循环上，不占线程；不支持时退化为专用线程。"""
+    loop = asyncio.get_running_loop()
+    fut = loop.create_future()
+
+    def reap(block: bool) -> bool:
+        try:
+            got, status, ru = os.wait4(pid, 0 if block else os.WNOHANG)
+        except ChildProcessError:
+            # 已被别处回收，退出码与用量都拿不到，不能当作成功
+            got, status, ru = pid, None, None
+        if got == 0:
+            return False
+        result = (status_to_rc(status) if status is not None else UNKNOWN_EXIT_RC, rusage_to_usage(ru) if ru else {})
+        if block:
+            try:
+                loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(result))
+            except RuntimeError:
+                pass
+        elif not fut.done():
+            fut.set_result(result)
+        return True
+
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    if pidfd is None:
+        threading.Thread(target=reap, args=(True,), name=f"wait4-{pid}", daemon=True).start()
+        return await fut
+
+    def on_ready():
+        if reap(False):
+            loop.remove_reader(pidfd)
+
+    loop.add_reader(pidfd, on_ready)
+    try:
+        return await fut
+    except asyncio.CancelledError:
+        # 调用方放弃等待（随后会结束进程组），交给后台线程回收，避免留下僵尸进程
+        reap_in_background(pid)
+        raise
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+
+
+def reap_in_background(pid: int):
+    def reap():
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+
+    threading.Thread(target=reap, name=f"wait4-{pid}", daemon=True).start()
+
+
+def exit_reason(rc: int, timed_out: bool, usage: dict, limits: dict, error_text: str = "") -> str:
+    if timed_out:
+        return "timeout"
+    if rc == UNKNOWN_EXIT_RC:
+        return "unknown_exit"
+    if rc == 0:
+        return "ok"
+    if usage.get("oomKill"):
+        return "memory_limit"
+    cpu = limits.get("cpu_sec")
+    if rc == 128 + signal.SIGXCPU or (cpu and rc == 128 + signal.SIGKILL and usage.get("cpuSec", 0) >= cpu):
+        return "cpu_limit"
+    if limits.get("mem_mb") and MEMORY_ERROR_RE.search(error_text or ""):
+        return "memory_limit"
+    if rc > 128:
+        try:
+            return f"signal:{signal.Signals(rc - 128).name}"
+        except ValueError:
+            return f"signal:{rc - 128}"
+    return "error"
+
+
+def mem_available_mb() -> float:
+    try:
+        with open("/proc/meminfo") as f:
+            for ln in f:
+                if ln.startswith("MemAvailable:"):
+                    return int(ln.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return float("inf")
+
+
+def load_per_cpu() -> float:
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except OSError:
+        return 0.0
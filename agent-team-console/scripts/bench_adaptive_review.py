@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+自适应评审基准：固定碰撞轮次 vs 按历史通过率自适应
+
+mock 模型按阶段给出确定性的评审结果（前端首轮通过率高、后端低），
+先用一批任务积累 stage_review_history，再把同一批任务分别在
+ATC_ADAPTIVE_REVIEW 关闭/开启下回放，对比 LLM 调用数与完成情况。
+
+示例：
+  python3 scripts/bench_adaptive_review.py --tasks 40 --warmup 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from bench_workflow_engine import MockLLM
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--tasks", type=int, default=40, help="回放语料任务数")
+    p.add_argument("--warmup", type=int, default=20, help="积累历史用的任务数")
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--latency", type=float, default=0.05, help="mock 模型每次调用的延迟秒数")
+    p.add_argument("--pass-rates", default="前端实现:95/90,后端实现:30/60", help="阶段:首版通过率/修订后通过率（百分比）")
+    return p.parse_args()
+
+
+class ReplayModel:
+    """确定性评审：同一 (任务, 阶段, 版本) 每次回放得到相同结论。"""
+
+    def __init__(self, pass_rates: dict):
+        self.pass_rates = pass_rates
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.versions.clear()
+
+    def verdict(self, marker: str) -> str:
+        head, _, version = marker.rpartition("#")
+        stage = head.partition("/")[2]
+        first, later = self.pass_rates.get(stage, (100, 100))
+        rate = first if version == "v1" else later
+        return "PASS" if zlib.crc32(marker.encode("utf-8")) % 100 < rate else "FAIL"
+
+    def reply(self, messages):
+        last = messages[-1]["content"]
+        if "总控分发" in last:
+            return (
+                '分发清单\n{"assignments":[{"stage":"前端实现","role":"frontend"},{"stage":"后端实现","role":"backend"}],'
+                '"active_stages":["前端实现","后端实现","复核","联合交付"]}'
+            )
+        if "对抗评审角色" in last or "阶段质控复核" in last:
+            markers = re.findall(r"阶段交付\[([^\]]+)\]", last)
+            dec = self.verdict(markers[-1]) if markers else "PASS"
+            return json.dumps(
+                {"decision": dec, "reason": "mock", "issues": [] if dec == "PASS" else ["缺口"], "send_back_role": "", "rework_instructions": "补齐"},
+                ensure_ascii=False,
+            )
+        if "复核阶段" in last or "Lead最终验收" in last:
+            return json.dumps({"decision": "PASS", "reason": "ok", "issues": [], "send_back_role": "", "rework_instructions": ""})
+        if "工具执行结果" in last:
+            text = "\n".join(m["content"] for m in messages)
+            stage = (re.findall(r"负责阶段：(\S+)", text) or ["-"])[-1]
+            case = (re.findall(r"case-\d+", text) or ["case-0"])[0]
+            with self.lock:
+                key = (case, stage)
+                self.versions[key] = self.versions.get(key, 0) + 1
+                version = self.versions[key]
+            return json.dumps({"action": "final", "content": f"阶段交付[{case}/{stage}#v{version}]，见 bench.txt"}, ensure_ascii=False)
+        return json.dumps({"action": "run_command", "command": "echo ok > $TASK_OUTPUT_DIR/bench.txt; echo done", "reason": "bench"})
+
+
+def create_tasks(A, cases) -> list:
+    ids = []
+    with A.db_conn() as conn:
+        for i in cases:
+            cur = conn.execute(
+                "INSERT INTO tasks(title, description, status, workflow_code, created_at, updated_at) VALUES(?,?,?,?,?,?)",
+                (f"case-{i}", f"【任务描述】\n生成一份报告 case-{i}", "pending", "intelligent_dual", A.now_str(), A.now_str()),
+            )
+            ids.append(cur.lastrowid)
+    for tid in ids:
+        A.running_processes[tid] = None
+    return ids
+
+
+def run_batch(A, ids):
+    async def _all():
+        await asyncio.gather(*[A.run_task_async(tid) for tid in ids])
+
+    asyncio.run(_all())
+
+
+def main():
+    args = parse_args()
+    rates = {}
+    for part in args.pass_rates.split(","):
+        stage, _, pct = part.partition(":")
+        first, _, later = pct.partition("/")
+        rates[stage.strip()] = (int(first), int(later or first))
+    model = ReplayModel(rates)
+    mock = MockLLM(args.latency, reply_fn=model.reply)
+    port = mock.start()
+
+    work = tempfile.mkdtemp(prefix="atc_bench_")
+    os.environ["ATC_DB_PATH"] = os.path.join(work, "tasks.db")
+    os.environ["ATC_ARTIFACT_ROOT"] = os.path.join(work, "artifacts")
+    os.environ["ATC_WORKDIR"] = work
+    os.environ["ATC_ROLE_DEFAULT_API_BASE"] = f"http://127.0.0.1:{port}"
+    os.environ["ATC_ROLE_DEFAULT_API_KEY"] = "bench"
+    os.environ["ATC_WORKFLOW_ENGINE"] = "asyncio"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+
+    A.limiter.set_limit(args.concurrency)
+    A.ADAPTIVE_REVIEW = False
+    model.reset()
+    run_batch(A, create_tasks(A, range(10000, 10000 + args.warmup)))
+
+    print(f"mock latency={args.latency}s pass-rates={rates} workdir={work}")
+    print(f"{'mode':<10} {'tasks':>6} {'done':>5} {'failed':>6} {'sec':>8} {'llm calls':>10} {'calls/task':>11}")
+    for adaptive in (False, True):
+        A.ADAPTIVE_REVIEW = adaptive
+        model.reset()
+        ids = create_tasks(A, range(args.tasks))
+        calls0 = mock.calls
+        t0 = time.perf_counter()
+        run_batch(A, ids)
+        elapsed = time.perf_counter() - t0
+        statuses = [A.get_task(tid)["status"] for tid in ids]
+        calls = mock.calls - calls0
+        print(
+            f"{'adaptive' if adaptive else 'fixed':<10} {len(ids):>6} {statuses.count('done'):>5} {statuses.count('failed'):>6} "
+            f"{elapsed:>8.2f} {calls:>10} {calls / len(ids):>11.2f}"
+        )
+
+    with A.db_conn() as conn:
+        rows = conn.execute(
+            "SELECT stage, role_code, model FROM stage_review_history GROUP BY stage, role_code, model"
+        ).fetchall()
+    for r in rows:
+        policy = A.choose_review_policy("intelligent_dual", r["stage"], r["role_code"], r["model"], A.ROLE_CROSS_REVIEW_ROUNDS)
+        stats = policy.get("stats") or {}
+        print(
+            f"  {r['stage']}/{r['role_code']}: rounds={policy['rounds']} qc={policy['qc']} "
+            f"碰撞首轮通过率={stats.get('firstPassRate')}（{stats.get('samples')}） 独立质控通过率={stats.get('qcPassRate')}（{stats.get('qcSamples')}） | {policy['reason']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+/api/tasks 轮询基准：全量轮询 vs 增量游标 + 字段投影 + ETag
+
+预置 --tasks 个任务，模拟客户端轮询 --polls 次，每两次轮询之间随机更新 --changes 个任务状态、偶尔新建任务：
+- 全量模式：每次 GET /api/tasks（最新 200 条、全部字段）；
+- 增量模式：首次 since_updated_at 拉全量（按 X-Next-Cursor 翻页），之后带 cursor=、fields=id,status,updated_at
+  与 If-None-Match 轮询，无变化时应得到 304。
+统计两种模式的请求数、响应字节数、304 次数，并核对增量模式最终看到的每个任务状态与数据库一致（不遗漏变更）；
+另核对 after_id 游标、倒序分页与未知字段返回 400。任一项不符合预期时以非 0 退出码结束。
+
+示例：
+  python3 scripts/bench_api_tasks_poll.py --tasks 1000 --polls 50 --changes 3
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--tasks", type=int, default=1000, help="预置任务数")
+    p.add_argument("--polls", type=int, default=50, help="轮询次数")
+    p.add_argument("--changes", type=int, default=3, help="每轮之间更新的任务数（每 5 轮有一轮不变）")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    work = tempfile.mkdtemp(prefix="atc_poll_")
+    os.environ["ATC_DB_PATH"] = os.path.join(work, "tasks.db")
+    os.environ["ATC_ARTIFACT_ROOT"] = os.path.join(work, "artifacts")
+    os.environ["ATC_WORKDIR"] = work
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+
+    client = A.app.test_client()
+    with client.session_transaction() as s:
+        s["logged_in"] = True
+    rng = random.Random(7)
+    failed = False
+
+    def check(label: str, ok: bool, detail: str):
+        nonlocal failed
+        failed |= not ok
+        print(f"{label:<10} {detail}{'' if ok else '  ← 未通过'}")
+
+    for start in range(0, args.tasks, A.BULK_TASK_MAX):
+        batch = range(start, min(args.tasks, start + A.BULK_TASK_MAX))
+        client.post("/api/tasks/bulk", json={"tasks": [{"task_brief": f"轮询基准任务 {i}"} for i in batch]})
+
+    def mutate(round_no: int):
+        if round_no % 5 == 4:
+            return
+        with A.db_conn() as conn:
+            ids = [r[0] for r in conn.execute("SELECT id FROM tasks")]
+        for tid in rng.sample(ids, min(args.changes, len(ids))):
+            A.update_task(tid, status=rng.choice(["running", "done", "failed"]))
+        if round_no % 3 == 0:
+            client.post("/api/tasks/bulk", json={"tasks": [{"task_brief": f"新任务 {round_no}"}]})
+
+    full = {"requests": 0, "bytes": 0}
+    inc = {"requests": 0, "bytes": 0, "304": 0}
+    seen, cursor, etag = {}, None, None
+    fields = "id,status,updated_at"
+
+    def pull():
+        nonlocal cursor, etag
+        while True:
+            query = {"cursor": cursor} if cursor else {"since_updated_at": "0"}
+            query.update(fields=fields, limit=500)
+            resp = client.get("/api/tasks", query_string=query, headers={"If-None-Match": etag} if etag else {})
+            inc["requests"] += 1
+            inc["bytes"] += len(resp.data)
+            if resp.status_code == 304:
+                inc["304"] += 1
+                return
+            for row in resp.get_json():
+                seen[row["id"]] = row["status"]
+            cursor, etag = resp.headers["X-Next-Cursor"], resp.headers.get("ETag")
+            if resp.headers.get("X-Has-More") != "1":
+                return
+            etag = None
+
+    t0 = time.perf_counter()
+    pull()
+    for i in range(args.polls):
+        mutate(i)
+        resp = client.get("/api/tasks")
+        full["requests"] += 1
+        full["bytes"] += len(resp.data)
+        pull()
+        if i % 10 == 9:
+            time.sleep(1.05)
+    elapsed = time.perf_counter() - t0
+
+    with A.db_conn() as conn:
+        actual = {r[0]: r[1] for r in conn.execute("SELECT id, status FROM tasks")}
+    print(f"{'mode':<12} {'requests':>9} {'bytes':>12} {'304':>5}")
+    print(f"{'full':<12} {full['requests']:>9} {full['bytes']:>12} {'-':>5}")
+    print(f"{'incremental':<12} {inc['requests']:>9} {inc['bytes']:>12} {inc['304']:>5}")
+    check("consistent", seen == actual, f"增量模式看到 {len(seen)} 个任务，与数据库{'一致' if seen == actual else '不一致'}（{elapsed:.1f}s）")
+    check("bytes", inc["bytes"] * 5 < full["bytes"], f"增量字节为全量的 {inc['bytes'] / max(1, full['bytes']):.1%}")
+    check("etag", inc["304"] > 0, f"304 次数 {inc['304']}")
+
+    first = client.get("/api/tasks", query_string={"after_id": args.tasks - 2, "fields": "id"}).get_json()
+    check("after_id", [r["id"] for r in first][:2] == [args.tasks - 1, args.tasks], f"after_id={args.tasks - 2} → {[r['id'] for r in first][:4]}")
+    ids, query = [], {"limit": 300, "fields": "id"}
+    while True:
+        resp = client.get("/api/tasks", query_string=query)
+        ids += [r["id"] for r in resp.get_json()]
+        if resp.headers.get("X-Has-More") != "1":
+            break
+        query = {"cursor": resp.headers["X-Next-Cursor"], "limit": 300, "fields": "id"}
+    check("paging", ids == sorted(actual, reverse=True), f"倒序分页取回 {len(ids)} 个任务")
+    resp = client.get("/api/tasks", query_string={"fields": "id,nope"})
+    check("fields", resp.status_code == 400, f"未知字段 → {resp.status_code}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+批量提交基准：逐个表单 POST /tasks vs 一次 POST /api/tasks/bulk
+
+构造 --tasks 个关键词变体任务，每个任务带同一份附件（xhs_cookies.json，--attach-kb KB）：
+- 表单模式：每个任务一次 multipart 请求，附件随请求重复上传；
+- 批量模式：附件先经 POST /api/blobs 上传一次，再一次 JSON 请求提交全部任务（按 blob 哈希引用附件）。
+统计两种模式的耗时、任务/秒、SQLite 提交次数，并核对批量模式的任务行、创建日志、附件内容与返回的 id 一致。
+
+示例：
+  python3 scripts/bench_bulk_submit.py --tasks 200 --attach-kb 16
+"""
+
+import argparse
+import hashlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--tasks", type=int, default=200)
+    p.add_argument("--attach-kb", type=int, default=16, help="共享附件大小（KB）")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    work = tempfile.mkdtemp(prefix="atc_bulk_")
+    os.environ["ATC_DB_PATH"] = os.path.join(work, "tasks.db")
+    os.environ["ATC_ARTIFACT_ROOT"] = os.path.join(work, "artifacts")
+    os.environ["ATC_WORKDIR"] = work
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+
+    client = A.app.test_client()
+    with client.session_transaction() as s:
+        s["logged_in"] = True
+    cookie = os.urandom(args.attach_kb * 1024)
+    keywords = [f"小说推荐 变体{i}" for i in range(args.tasks)]
+    commits = []
+    with A.db_conn() as conn:
+        conn.set_trace_callback(lambda sql: sql.startswith("COMMIT") and commits.append(1))
+
+    def brief(kw: str) -> str:
+        return f"采集关键词「{kw}」的小红书热门笔记并输出文包"
+
+    def run_form():
+        for kw in keywords:
+            client.post(
+                "/tasks",
+                data={"workflow_template": "novel_multiagent", "task_brief": brief(kw), "attachments": (io.BytesIO(cookie), "xhs_cookies.json")},
+                content_type="multipart/form-data",
+            )
+        with A.db_conn() as conn:
+            return [r[0] for r in conn.execute("SELECT id FROM tasks ORDER BY id DESC LIMIT ?", (args.tasks,))][::-1]
+
+    def run_bulk():
+        blob = client.post("/api/blobs", data={"file": (io.BytesIO(cookie), "xhs_cookies.json")}, content_type="multipart/form-data").get_json()["blobs"][0]
+        resp = client.post(
+            "/api/tasks/bulk",
+            json={
+                "attachments": [{"name": "xhs_cookies.json", "blob": blob["blob"]}],
+                "tasks": [{"workflow_template": "novel_multiagent", "task_brief": brief(kw)} for kw in keywords],
+            },
+        )
+        return resp.get_json()["ids"]
+
+    rows, failed = [], False
+    for mode, fn in (("form", run_form), ("bulk", run_bulk)):
+        commits.clear()
+        t0 = time.perf_counter()
+        ids = fn()
+        elapsed = time.perf_counter() - t0
+        with A.db_conn() as conn:
+            n_tasks = conn.execute(f"SELECT count(*) FROM tasks WHERE id IN ({','.join('?' * len(ids))})", ids).fetchone()[0]
+            n_logs = conn.execute(f"SELECT count(DISTINCT task_id) FROM task_logs WHERE task_id IN ({','.join('?' * len(ids))})", ids).fetchone()[0]
+        attached = all(
+            hashlib.sha256(open(os.path.join(A.task_artifact_dirs(tid)[1], "xhs_cookies.json"), "rb").read()).digest() == hashlib.sha256(cookie).digest()
+            for tid in ids
+        )
+        ok = len(ids) == args.tasks == n_tasks == n_logs and attached
+        failed |= not ok
+        rows.append((mode, elapsed, len(commits), ok))
+
+    print(f"{'mode':<6} {'tasks':>6} {'sec':>8} {'tasks/s':>9} {'commits':>8}  check")
+    for mode, elapsed, n_commits, ok in rows:
+        print(f"{mode:<6} {args.tasks:>6} {elapsed:>8.2f} {args.tasks / elapsed:>9.1f} {n_commits:>8}  {'ok' if ok else '未通过'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
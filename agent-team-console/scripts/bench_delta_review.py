@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+增量修订基准：对抗评审后的修订提示词 全文模式 vs diff 模式
+
+mock 角色每次交付一份长报告（正文 + 待补充清单），每轮修订补齐部分清单项；
+mock 评审只根据实际收到的消息读报告，数其中剩余的「待补充」项（不参考提示词中的上一轮问题清单）。
+同一语料分别在 ATC_DELTA_REVIEW 关闭/开启下运行，对比评审/修订实际发送的 token 与逐轮结论一致率；
+评审方两种模式下都收到全文，token 应相同，节省全部来自修订提示词。
+结论不一致、任务未全部完成、评审 token 不同或修订 token 未减少时以非 0 退出码结束。
+
+示例：
+  python3 scripts/bench_delta_review.py --tasks 30 --body-lines 80
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+from bench_workflow_engine import MockLLM
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--tasks", type=int, default=30)
+    p.add_argument("--concurrency", type=int, default=16)
+    p.add_argument("--latency", type=float, default=0.02, help="mock 模型每次调用的延迟秒数")
+    p.add_argument("--body-lines", type=int, default=80, help="报告正文行数（越长 diff 模式收益越大）")
+    return p.parse_args()
+
+
+def crc(text: str) -> int:
+    return zlib.crc32(text.encode("utf-8"))
+
+
+def read_report(messages: list) -> list:
+    """按评审方实际收到的消息读出待评审的报告（只认全文提示词）。"""
+    lines = []
+    for m in messages:
+        if m["role"] == "user" and "阶段输出：\n" in m["content"]:
+            # 对抗评审全文为「当前阶段输出：」，阶段质控为「本阶段输出：」
+            lines = m["content"].split("阶段输出：\n", 1)[1].split("\n\n", 1)[0].rstrip("\n").splitlines()
+    return lines
+
+
+class ReportModel:
+    def __init__(self, body_lines: int):
+        self.body_lines = body_lines
+        self.estimate_tokens = len
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.versions = {}
+            self.verdicts = {}
+            self.tokens = {"review": 0, "revise": 0}
+
+    def report(self, case: str, stage: str, version: int) -> str:
+        key = f"{case}/{stage}"
+        initial = crc(key) % 4
+        resolved = sum(1 + crc(f"{key}#{v}") % 2 for v in range(2, version + 1))
+        body = [f"{stage} 第{n}节：{case} 的分析内容，数据口径与结论说明（第{n}行）。" for n in range(1, self.body_lines + 1)]
+        items = [f"- [{'已补充' if k < resolved else '待补充'}] 项目{k}" for k in range(initial)]
+        return "\n".join([f"阶段交付：{key}", f"版本：v{version}"] + body + ["清单："] + items)
+
+    def judge(self, messages: list) -> dict:
+        report = "\n".join(read_report(messages))
+        version = (re.findall(r"^版本：v(\d+)$", report, re.M) or ["0"])[-1]
+        key = (re.findall(r"^阶段交付：(\S+)$", report, re.M) or ["-"])[-1]
+        pending = set(re.findall(r"^- \[待补充\] (项目\d+)$", report, re.M))
+        dec = "FAIL" if pending else "PASS"
+        with self.lock:
+            self.verdicts[(key, version)] = dec
+        return {
+            "decision": dec,
+            "reason": "mock",
+            "issues": [f"待补充 {x}" for x in sorted(pending)],
+            "send_back_role": "",
+            "rework_instructions": "补齐待补充项",
+        }
+
+    def reply(self, messages):
+        last = messages[-1]["content"]
+        if "总控分发" in last:
+            return (
+                '分发清单\n{"assignments":[{"stage":"前端实现","role":"frontend"},{"stage":"后端实现","role":"backend"}],'
+                '"active_stages":["前端实现","后端实现","复核","联合交付"]}'
+            )
+        if "对抗评审角色" in last or "阶段质控复核" in last:
+            if "对抗评审角色" in last:
+                with self.lock:
+                    self.tokens["review"] += sum(self.estimate_tokens(m["content"]) for m in messages[1:])
+            return json.dumps(self.judge(messages), ensure_ascii=False)
+        if "复核阶段" in last or "Lead最终验收" in last:
+            return json.dumps({"decision": "PASS", "reason": "ok", "issues": [], "send_back_role": "", "rework_instructions": ""})
+        if "本轮挑战与修改要求" in last:
+            with self.lock:
+                self.tokens["revise"] += self.estimate_tokens(last)
+        if "工具执行结果" in last:
+            text = "\n".join(m["content"] for m in messages)
+            stage = (re.findall(r"负责阶段：(\S+)", text) or ["-"])[-1]
+            case = (re.findall(r"case-\d+", text) or ["case-0"])[0]
+            with self.lock:
+                key = (case, stage)
+                self.versions[key] = self.versions.get(key, 0) + 1
+                version = self.versions[key]
+            return json.dumps({"action": "final", "content": self.report(case, stage, version)}, ensure_ascii=False)
+        return json.dumps({"action": "run_command", "command": "echo ok > $TASK_OUTPUT_DIR/bench.txt; echo done", "reason": "bench"})
+
+
+def create_tasks(A, n: int) -> list:
+    ids = []
+    with A.db_conn() as conn:
+        for i in range(n):
+            cur = conn.execute(
+                "INSERT INTO tasks(title, description, status, workflow_code, created_at, updated_at) VALUES(?,?,?,?,?,?)",
+                (f"case-{i}", f"【任务描述】\n生成一份报告 case-{i}", "pending", "intelligent_dual", A.now_str(), A.now_str()),
+            )
+            ids.append(cur.lastrowid)
+    for tid in ids:
+        A.running_processes[tid] = None
+    return ids
+
+
+def run_batch(A, ids):
+    async def _all():
+        await asyncio.gather(*[A.run_task_async(tid) for tid in ids])
+
+    asyncio.run(_all())
+
+
+def main():
+    args = parse_args()
+    work = tempfile.mkdtemp(prefix="atc_bench_")
+    os.environ["ATC_DB_PATH"] = os.path.join(work, "tasks.db")
+    os.environ["ATC_ARTIFACT_ROOT"] = os.path.join(work, "artifacts")
+    os.environ["ATC_WORKDIR"] = work
+    model = ReportModel(args.body_lines)
+    mock = MockLLM(args.latency, reply_fn=model.reply)
+    port = mock.start()
+    os.environ["ATC_ROLE_DEFAULT_API_BASE"] = f"http://127.0.0.1:{port}"
+    os.environ["ATC_ROLE_DEFAULT_API_KEY"] = "bench"
+    os.environ["ATC_WORKFLOW_ENGINE"] = "asyncio"
+    os.environ["ATC_ADAPTIVE_REVIEW"] = "0"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+
+    model.estimate_tokens = A.estimate_tokens
+
+    A.limiter.set_limit(args.concurrency)
+    results, tokens, failed = {}, {}, False
+    print(f"body-lines={args.body_lines} tasks={args.tasks} workdir={work}")
+    print(f"{'mode':<6} {'done':>5} {'sec':>7} {'llm calls':>10} {'review tok':>11} {'revise tok':>11} {'total tok':>10}")
+    for delta in (False, True):
+        A.DELTA_REVIEW = delta
+        model.reset()
+        ids = create_tasks(A, args.tasks)
+        calls0 = mock.calls
+        t0 = time.perf_counter()
+        run_batch(A, ids)
+        elapsed = time.perf_counter() - t0
+        done = sum(1 for tid in ids if A.get_task(tid)["status"] == "done")
+        tok = dict(model.tokens)
+        results[delta], tokens[delta] = dict(model.verdicts), tok
+        failed |= done != args.tasks
+        print(
+            f"{'delta' if delta else 'full':<6} {done:>5} {elapsed:>7.2f} {mock.calls - calls0:>10} "
+            f"{tok['review']:>11} {tok['revise']:>11} {tok['review'] + tok['revise']:>10}"
+        )
+
+    common = set(results[False]) & set(results[True])
+    union = set(results[False]) | set(results[True])
+    agree = sum(1 for k in common if results[False][k] == results[True][k])
+    print(f"verdict agreement: {agree}/{len(union)} reviewed versions")
+    saved = 1 - tokens[True]["revise"] / max(1, tokens[False]["revise"])
+    print(f"revise tokens saved: {saved:.1%}")
+    failed |= tokens[True]["review"] != tokens[False]["review"] or saved <= 0
+    sys.exit(1 if failed or not union or agree != len(union) else 0)
+
+
+if __name__ == "__main__":
+    main()
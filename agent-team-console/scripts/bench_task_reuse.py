@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+整任务结果复用基准：相同任务重复提交时的耗时与模型调用数
+
+经页面表单（POST /tasks）提交同一 intelligent_dual 任务（相同描述与附件），mock 模型每次调用耗时 --latency 秒：
+1. 首次提交完整执行；
+2. ATC_TASK_REUSE=auto 下再次提交并启动，应直接复用首个任务的产物（硬链接、内容一致），不调用模型；
+3. 附件内容变化后指纹不同，完整执行；
+4. offer 模式下经 POST /tasks/<id>/reuse 手动复用；
+5. 工作流 reuse_ttl_sec 小于结果年龄时不复用。
+任一项不符合预期时以非 0 退出码结束。
+
+示例：
+  python3 scripts/bench_task_reuse.py --latency 0.2
+"""
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+from bench_workflow_engine import MockLLM
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--latency", type=float, default=0.2, help="mock 模型每次调用的延迟秒数")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    mock = MockLLM(args.latency)
+    port = mock.start()
+
+    work = tempfile.mkdtemp(prefix="atc_reuse_")
+    os.environ["ATC_DB_PATH"] = os.path.join(work, "tasks.db")
+    os.environ["ATC_ARTIFACT_ROOT"] = os.path.join(work, "artifacts")
+    os.environ["ATC_WORKDIR"] = work
+    os.environ["ATC_ROLE_DEFAULT_API_BASE"] = f"http://127.0.0.1:{port}"
+    os.environ["ATC_ROLE_DEFAULT_API_KEY"] = "bench"
+    os.environ["ATC_TASK_REUSE"] = "auto"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+
+    client = A.app.test_client()
+    with client.session_transaction() as s:
+        s["logged_in"] = True
+    failed = False
+
+    def submit(seed: str) -> int:
+        client.post(
+            "/tasks",
+            data={
+                "workflow_template": "intelligent_dual",
+                "task_brief": "每日小说关键词文包：整理  热门关键词并生成报告",
+                "attachments": (io.BytesIO(seed.encode("utf-8")), "keywords_seed.txt"),
+            },
+            content_type="multipart/form-data",
+        )
+        with A.db_conn() as conn:
+            return conn.execute("SELECT max(id) FROM tasks").fetchone()[0]
+
+    def run(tid: int):
+        calls0 = mock.calls
+        t0 = time.perf_counter()
+        A.running_processes[tid] = None
+        A.run_task(tid)
+        return A.get_task(tid), time.perf_counter() - t0, mock.calls - calls0
+
+    def outputs(tid: int) -> dict:
+        out = os.path.join(A.ARTIFACT_ROOT, f"task_{tid}", "output")
+        return {name: os.stat(os.path.join(out, name)).st_ino for name in os.listdir(out)}
+
+    def check(label: str, ok: bool, task, sec: float, calls: int):
+        nonlocal failed
+        failed |= not ok
+        print(
+            f"{label:<10} task=#{task['id']:<3} status={task['status']:<5} reused_from={task['reused_from'] or '-':<3} "
+            f"sec={sec:6.2f} llm calls={calls:<3}{'' if ok else '  ← 未通过'}"
+        )
+
+    first_id = submit("alpha")
+    first, first_sec, first_calls = run(first_id)
+    check("fresh", first["status"] == "done" and first["return_code"] == 0 and first_calls > 0, first, first_sec, first_calls)
+
+    tid = submit("alpha")
+    task, reuse_sec, calls = run(tid)
+    same = outputs(tid) == outputs(first_id)
+    check("auto", task["reused_from"] == first_id and task["status"] == "done" and calls == 0 and same, task, reuse_sec, calls)
+
+    tid = submit("beta")
+    task, sec, calls = run(tid)
+    check("changed", not task["reused_from"] and task["status"] == "done" and calls > 0, task, sec, calls)
+
+    A.TASK_REUSE = "offer"
+    tid = submit("alpha")
+    t0 = time.perf_counter()
+    client.post(f"/tasks/{tid}/reuse")
+    task = A.get_task(tid)
+    check("offer", task["reused_from"] == first_id and task["status"] == "done", task, time.perf_counter() - t0, 0)
+
+    A.TASK_REUSE = "auto"
+    with A.db_conn() as conn:
+        conn.execute("UPDATE workflows SET reuse_ttl_sec=1 WHERE code='intelligent_dual'")
+    time.sleep(1.5)
+    tid = submit("alpha")
+    task, sec, calls = run(tid)
+    check("ttl=1s", not task["reused_from"] and calls > 0, task, sec, calls)
+
+    print(f"重复提交：完整执行 {first_sec:.2f}s / {first_calls} 次模型调用，复用 {reuse_sec:.2f}s / 0 次")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+批量工具动作基准：逐条 run_command vs 一次 run_commands
+
+角色需要执行 --probes 条探测命令（每条 sleep --tool-sec 秒），其中最后一条依赖第一条的产物。
+- 逐条模式：mock 模型每轮返回一条 run_command，全部执行完再返回 final；
+- 批量模式：mock 模型一次返回 run_commands（最后一条 after 第一条），再返回 final。
+mock 模型每次调用耗时 --latency 秒，统计两种模式的模型调用数、工具轮次与阶段总耗时，
+并核对批量模式的依赖顺序与合并反馈。
+
+示例：
+  python3 scripts/bench_tool_batch.py --probes 3 --tool-sec 1 --latency 0.5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from bench_workflow_engine import MockLLM
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--probes", type=int, default=3)
+    p.add_argument("--tool-sec", type=float, default=1.0, help="每条探测命令耗时（秒）")
+    p.add_argument("--latency", type=float, default=0.5, help="mock 模型单次调用耗时（秒）")
+    return p.parse_args()
+
+
+def probe_commands(n: int, tool_sec: float) -> list:
+    cmds = [
+        {"id": f"p{i + 1}", "command": f"sleep {tool_sec}; date +%s.%N > $TASK_OUTPUT_DIR/p{i + 1}.txt; echo probe {i + 1} ok"}
+        for i in range(n)
+    ]
+    # 最后一条读取第一条的产物，需在其之后执行
+    cmds[-1]["command"] = f"sleep {tool_sec}; cat $TASK_OUTPUT_DIR/p1.txt > $TASK_OUTPUT_DIR/p{n}.txt; date +%s.%N >> $TASK_OUTPUT_DIR/p{n}.txt; echo probe {n} ok"
+    if n > 1:
+        cmds[-1]["after"] = ["p1"]
+    return cmds
+
+
+def make_reply(mode: str, cmds: list):
+    def reply(messages):
+        done = sum(1 for m in messages if m["role"] == "user" and "工具执行结果摘要" in m["content"])
+        if mode == "batch":
+            if done:
+                return json.dumps({"action": "final", "content": "探测完成"}, ensure_ascii=False)
+            return json.dumps({"action": "run_commands", "commands": cmds, "reason": "bench"}, ensure_ascii=False)
+        if done >= len(cmds):
+            return json.dumps({"action": "final", "content": "探测完成"}, ensure_ascii=False)
+        return json.dumps({"action": "run_command", "command": cmds[done]["command"], "reason": "bench"}, ensure_ascii=False)
+
+    return reply
+
+
+def main():
+    args = parse_args()
+    cmds = probe_commands(args.probes, args.tool_sec)
+    mocks = {mode: MockLLM(args.latency, reply_fn=make_reply(mode, cmds)) for mode in ("serial", "batch")}
+    ports = {mode: m.start() for mode, m in mocks.items()}
+
+    work = tempfile.mkdtemp(prefix="atc_batch_")
+    os.environ["ATC_DB_PATH"] = os.path.join(work, "tasks.db")
+    os.environ["ATC_ARTIFACT_ROOT"] = os.path.join(work, "artifacts")
+    os.environ["ATC_WORKDIR"] = work
+    os.environ["ATC_ROLE_DEFAULT_API_KEY"] = "bench"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+
+    rows, failed = [], False
+    for mode in ("serial", "batch"):
+        with A.db_conn() as conn:
+            conn.execute("UPDATE roles SET api_base=?", (f"http://127.0.0.1:{ports[mode]}",))
+            tid = conn.execute(
+                "INSERT INTO tasks(title, description, status, created_at, updated_at) VALUES(?,?,?,?,?)",
+                (f"batch-{mode}", "批量工具基准", "running", A.now_str(), A.now_str()),
+            ).lastrowid
+        A.running_processes[tid] = None
+        base_dir, input_dir, output_dir = A.task_artifact_dirs(tid)
+        role = A.get_role_by_code("backend")
+        messages = [{"role": "system", "content": "bench"}, {"role": "user", "content": "执行探测"}]
+        calls0 = mocks[mode].calls
+        t0 = time.perf_counter()
+        _, events = asyncio.run(A.run_role_stage_with_tools(tid, "后端实现", role, messages, base_dir, input_dir, output_dir))
+        elapsed = time.perf_counter() - t0
+        rounds = len({e["round"] for e in events})
+        ok = len(events) == args.probes and all(e["rc"] == 0 for e in events)
+        if mode == "batch" and args.probes > 1:
+            with open(os.path.join(output_dir, f"p{args.probes}.txt"), encoding="utf-8") as f:
+                first_done, last_done = [float(x) for x in f.read().split()]
+            ok &= last_done - first_done >= args.tool_sec * 0.9
+            ok &= sum(1 for m in messages if "批量工具执行结果摘要" in m["content"]) == 1
+        failed |= not ok
+        rows.append((mode, mocks[mode].calls - calls0, rounds, elapsed, ok))
+
+    print(f"{'mode':<8} {'llm calls':>9} {'tool rounds':>11} {'stage sec':>10}  check")
+    for mode, calls, rounds, elapsed, ok in rows:
+        print(f"{mode:<8} {calls:>9} {rounds:>11} {elapsed:>10.2f}  {'ok' if ok else '未通过'}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+预热执行器基准：bash 启动 python3 scripts/*.py vs warm_runner fork 执行
+
+在临时目录生成 scripts/probe.py（导入 --imports 中可用的模块后输出一行），
+再加上仓库自带脚本的 --help，分别经 bash 与预热执行器各启动 --runs 次，
+统计从发起到读完输出、拿到退出码的单次启动时延。
+
+示例：
+  python3 scripts/bench_warm_runner.py --runs 50
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+DEFAULT_IMPORTS = "asyncio,json,email.mime.multipart,http.client,urllib.request,ssl,zipfile,xml.dom.minidom,sqlite3,requests,bs4,playwright.async_api"
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--runs", type=int, default=50)
+    p.add_argument("--imports", default=DEFAULT_IMPORTS, help="probe 脚本导入、执行器预加载的模块（缺失的模块自动跳过）")
+    return p.parse_args()
+
+
+async def launch(A, command: str, cwd: str, env: dict):
+    t0 = time.perf_counter()
+    proc, launcher = await A.spawn_tool_process(command, cwd, dict(env))
+    out = await proc.stdout.read()
+    rc = await proc.wait()
+    return (time.perf_counter() - t0) * 1000, launcher, rc, out
+
+
+def main():
+    args = parse_args()
+    work = tempfile.mkdtemp(prefix="atc_warm_")
+    os.makedirs(os.path.join(work, "scripts"))
+    with open(os.path.join(work, "scripts", "probe.py"), "w", encoding="utf-8") as f:
+        f.write(
+            "import importlib, sys\n"
+            f"names = {args.imports!r}.split(',')\n"
+            "ok = []\n"
+            "for n in names:\n"
+            "    try:\n"
+            "        importlib.import_module(n); ok.append(n)\n"
+            "    except ImportError:\n"
+            "        pass\n"
+            "print('probe', len(ok), 'modules', sys.argv[1:])\n"
+        )
+    os.environ["ATC_DB_PATH"] = os.path.join(work, "tasks.db")
+    os.environ["ATC_ARTIFACT_ROOT"] = os.path.join(work, "artifacts")
+    os.environ["ATC_WORKDIR"] = work
+    os.environ["ATC_WARM_RUNNER_SOCKET"] = os.path.join(work, "warm_runner.sock")
+    os.environ["ATC_WARM_RUNNER_PRELOAD"] = args.imports
+    app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, app_dir)
+    import app as A
+
+    A.WARM_RUNNER = True
+    t0 = time.perf_counter()
+    if not A.ensure_warm_runner():
+        print("预热执行器启动失败，见", os.path.join(work, "warm_runner.log"))
+        sys.exit(1)
+    print(f"warm runner ready in {(time.perf_counter() - t0) * 1000:.0f}ms workdir={work}")
+
+    cases = [
+        ("probe", f"cd {work} && python3 scripts/probe.py --x 1", work),
+        ("build_novel_pack --help", "python3 scripts/build_novel_pack.py --help", app_dir),
+        ("xhs_virtual_keywords --help", "python3 scripts/xhs_virtual_keywords.py --help", app_dir),
+    ]
+    env = dict(os.environ)
+
+    async def run_all():
+        rows = []
+        for name, cmd, cwd in cases:
+            stats = {}
+            for warm in (False, True):
+                A.WARM_RUNNER = warm
+                samples, outputs = [], set()
+                for _ in range(args.runs):
+                    ms, launcher, rc, out = await launch(A, cmd, cwd, env)
+                    assert rc == 0 and launcher == ("warm" if warm else "bash"), (name, launcher, rc, out[-300:])
+                    samples.append(ms)
+                    outputs.add(out)
+                samples.sort()
+                stats[warm] = (statistics.median(samples), samples[int(len(samples) * 0.95) - 1], outputs)
+            rows.append((name, stats))
+        return rows
+
+    rows = asyncio.run(run_all())
+    print(f"{'script':<30} {'bash p50':>9} {'bash p95':>9} {'warm p50':>9} {'warm p95':>9} {'speedup':>8}  output")
+    for name, stats in rows:
+        (b50, b95, b_out), (w50, w95, w_out) = stats[False], stats[True]
+        same = "same" if b_out == w_out else "DIFF"
+        print(f"{name:<30} {b50:>8.1f}ms {b95:>8.1f}ms {w50:>8.1f}ms {w95:>8.1f}ms {b50 / w50:>7.1f}x  {same}")
+    A.warm_runner_state["proc"].terminate()
+
+
+if __name__ == "__main__":
+    main()
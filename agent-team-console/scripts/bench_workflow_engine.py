@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+工作流引擎吞吐基准：thread 引擎 vs asyncio 引擎
+
+内置一个 asyncio 实现的 OpenAI 兼容 mock 模型服务（固定延迟），
+按不同并发数批量跑 intelligent_dual 工作流，输出 tasks/min 与峰值线程数。
+
+示例：
+  python3 scripts/bench_workflow_engine.py --concurrency 16,64,256 --latency 0.2
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--concurrency", default="16,64,256", help="逗号分隔的并发工作流数")
+    p.add_argument("--engines", default="thread,asyncio")
+    p.add_argument("--latency", type=float, default=0.2, help="mock 模型每次调用的延迟秒数")
+    p.add_argument("--tasks", type=int, default=0, help="每档任务数，默认等于并发数")
+    return p.parse_args()
+
+
+def mock_reply(messages):
+    last = messages[-1]["content"]
+    if "总控分发" in last:
+        return (
+            '分发清单\n{"assignments":[{"stage":"前端实现","role":"frontend"},{"stage":"后端实现","role":"backend"}],'
+            '"active_stages":["前端实现","后端实现","复核","联合交付"],"collision_rounds":1}'
+        )
+    if "对抗评审" in last or "阶段质控" in last or "复核阶段" in last or "Lead最终验收" in last:
+        return json.dumps({"decision": "PASS", "reason": "ok", "issues": [], "send_back_role": "", "rework_instructions": ""})
+    if "工具执行结果" in last:
+        return json.dumps({"action": "final", "content": "阶段交付：完成，见 bench.txt"}, ensure_ascii=False)
+    return json.dumps({"action": "run_command", "command": "echo ok > $TASK_OUTPUT_DIR/bench.txt; echo done", "reason": "bench"})
+
+
+class MockLLM:
+    def __init__(self, latency: float, reply_fn=mock_reply):
+        self.latency = latency
+        self.reply_fn = reply_fn
+        self.calls = 0
+        self.disconnects = 0
+        self.port = 0
+        self._ready = threading.Event()
+
+    async def _handle(self, reader, writer):
+        try:
+            await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                k, _, v = line.decode("latin-1").partition(":")
+                if k.strip().lower() == "content-length":
+                    length = int(v.strip())
+            body = json.loads(await reader.readexactly(length))
+            self.calls += 1
+            if self.latency > 0:
+                # 等待期间客户端断开（读到 EOF）即视为请求被取消
+                try:
+                    if await asyncio.wait_for(reader.read(1), self.latency) == b"":
+                        self.disconnects += 1
+                        return
+                except asyncio.TimeoutError:
+                    pass
+            text = self.reply_fn(body["messages"])
+            out = json.dumps(
+                {"choices": [{"message": {"content": text}}], "usage": {"prompt_tokens": 100, "completion_tokens": 20}},
+                ensure_ascii=False,
+            ).encode("utf-8")
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nConnection: close\r\n"
+                + f"Content-Length: {len(out)}\r\n\r\n".encode("ascii")
+                + out
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def _serve(self):
+        loop = asyncio.new_event_loop()
+        server = loop.run_until_complete(asyncio.start_server(self._handle, "127.0.0.1", 0, backlog=2048))
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        loop.run_forever()
+
+    def start(self):
+        threading.Thread(target=self._serve, daemon=True).start()
+        self._ready.wait()
+        return self.port
+
+
+def create_tasks(A, n: int) -> list:
+    ids = []
+    with A.db_conn() as conn:
+        for i in range(n):
+            cur = conn.execute(
+                "INSERT INTO tasks(title, description, status, workflow_code, created_at, updated_at) VALUES(?,?,?,?,?,?)",
+                (f"bench-{i}", "【任务描述】\n生成一份报告", "pending", "intelligent_dual", A.now_str(), A.now_str()),
+            )
+            ids.append(cur.lastrowid)
+    for tid in ids:
+        A.running_processes[tid] = None
+    return ids
+
+
+def run_thread_engine(A, ids):
+    threads = [threading.Thread(target=A.run_task, args=(tid,), daemon=True) for tid in ids]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def run_asyncio_engine(A, ids):
+    async def _all():
+        await asyncio.gather(*[A.run_task_async(tid) for tid in ids])
+
+    asyncio.run(_all())
+
+
+def main():
+    args = parse_args()
+    mock = MockLLM(args.latency)
+    port = mock.start()
+
+    work = tempfile.mkdtemp(prefix="atc_bench_")
+    os.environ["ATC_DB_PATH"] = os.path.join(work, "tasks.db")
+    os.environ["ATC_ARTIFACT_ROOT"] = os.path.join(work, "artifacts")
+    os.environ["ATC_WORKDIR"] = work
+    os.environ["ATC_ROLE_DEFAULT_API_BASE"] = f"http://127.0.0.1:{port}"
+    os.environ["ATC_ROLE_DEFAULT_API_KEY"] = "bench"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+
+    runners = {"thread": run_thread_engine, "asyncio": run_asyncio_engine}
+    levels = [int(x) for x in args.concurrency.split(",") if x.strip()]
+    engines = [e.strip() for e in args.engines.split(",") if e.strip() in runners]
+
+    print(f"mock latency={args.latency}s workdir={work}")
+    print(f"{'engine':<8} {'conc':>5} {'tasks':>6} {'done':>5} {'sec':>8} {'tasks/min':>10} {'llm calls':>10} {'peak threads':>13}")
+    for level in levels:
+        for engine in engines:
+            A.limiter.set_limit(level)
+            ids = create_tasks(A, args.tasks or level)
+            calls0 = mock.calls
+            peak = {"n": threading.active_count()}
+            stop = threading.Event()
+
+            def sample():
+                while not stop.is_set():
+                    peak["n"] = max(peak["n"], threading.active_count())
+                    time.sleep(0.05)
+
+            sampler = threading.Thread(target=sample, daemon=True)
+            sampler.start()
+            t0 = time.perf_counter()
+            runners[engine](A, ids)
+            elapsed = time.perf_counter() - t0
+            stop.set()
+            sampler.join()
+
+            done = sum(1 for tid in ids if A.get_task(tid)["status"] == "done")
+            print(
+                f"{engine:<8} {level:>5} {len(ids):>6} {done:>5} {elapsed:>8.2f} "
+                f"{done / elapsed * 60:>10.1f} {mock.calls - calls0:>10} {peak['n']:>13}"
+            )
+
+
+if __name__ == "__main__":
+    main()
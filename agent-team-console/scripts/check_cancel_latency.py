@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+停止任务的取消时延检查：thread / asyncio 引擎 × 在途模型请求 / 在途工具命令
+
+mock 模型每次调用挂起 --hold 秒；工具场景让角色执行一个长时间 sleep 的命令。
+在调用进行中通过 /tasks/<id>/stop 停止任务，统计从发出停止到「空闲」的耗时：
+取消令牌已释放、并发槽位归还、模型连接已断开（mock 读到 EOF）/工具进程组已退出。
+任一场景超过 --max-ms 时以非 0 退出码结束。
+
+示例：
+  python3 scripts/check_cancel_latency.py --hold 30
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from bench_workflow_engine import MockLLM
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--hold", type=float, default=30.0, help="mock 模型每次调用挂起的秒数")
+    p.add_argument("--max-ms", type=int, default=1000, help="取消到空闲的时延上限")
+    p.add_argument("--engines", default="thread,asyncio")
+    return p.parse_args()
+
+
+def tool_reply(pid_file: str):
+    def reply(messages):
+        last = messages[-1]["content"]
+        if "总控分发" in last:
+            return '分发清单\n{"assignments":[],"active_stages":["前端实现"]}'
+        return json.dumps({"action": "run_command", "command": f"echo $$ > {pid_file}; sleep 600", "reason": "cancel check"})
+
+    return reply
+
+
+def pgid_alive(pgid: int) -> bool:
+    try:
+        os.killpg(pgid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+
+
+def wait_until(pred, timeout: float, step: float = 0.005) -> bool:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if pred():
+            return True
+        time.sleep(step)
+    return False
+
+
+def main():
+    args = parse_args()
+    work = tempfile.mkdtemp(prefix="atc_cancel_")
+    pid_file = os.path.join(work, "tool.pid")
+    llm_mock = MockLLM(args.hold)
+    tool_mock = MockLLM(0, reply_fn=tool_reply(pid_file))
+    llm_port, tool_port = llm_mock.start(), tool_mock.start()
+
+    os.environ["ATC_DB_PATH"] = os.path.join(work, "tasks.db")
+    os.environ["ATC_ARTIFACT_ROOT"] = os.path.join(work, "artifacts")
+    os.environ["ATC_WORKDIR"] = work
+    os.environ["ATC_ROLE_DEFAULT_API_KEY"] = "check"
+    os.environ["ATC_ROLE_DEFAULT_API_BASE"] = f"http://127.0.0.1:{llm_port}"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+
+    client = A.app.test_client()
+    with client.session_transaction() as sess:
+        sess["logged_in"] = True
+
+    def set_api_base(port: int):
+        with A.db_conn() as conn:
+            conn.execute("UPDATE roles SET api_base=?", (f"http://127.0.0.1:{port}",))
+
+    failed = False
+    print(f"{'engine':<8} {'scenario':<6} {'cancel->idle ms':>16}  detail")
+    for engine in [e.strip() for e in args.engines.split(",") if e.strip()]:
+        A.WORKFLOW_ENGINE = engine
+        for scenario in ("llm", "tool"):
+            set_api_base(llm_port if scenario == "llm" else tool_port)
+            if os.path.exists(pid_file):
+                os.remove(pid_file)
+            with A.db_conn() as conn:
+                tid = conn.execute(
+                    "INSERT INTO tasks(title, description, status, workflow_code, created_at, updated_at) VALUES(?,?,?,?,?,?)",
+                    (f"cancel-{engine}-{scenario}", "【任务描述】\n取消检查", "pending", "intelligent_dual", A.now_str(), A.now_str()),
+                ).lastrowid
+            calls0 = llm_mock.calls
+            A.start_task(tid)
+            if scenario == "llm":
+                in_flight = wait_until(lambda: llm_mock.calls > calls0 and tid in A.task_cancel_tokens, 10)
+            else:
+                in_flight = wait_until(lambda: os.path.exists(pid_file) and os.path.getsize(pid_file) > 0, 10)
+            if not in_flight:
+                print(f"{engine:<8} {scenario:<6} {'-':>16}  调用未进入在途状态")
+                failed = True
+                continue
+            pgid = int(open(pid_file).read().strip()) if scenario == "tool" else 0
+            disc0 = llm_mock.disconnects
+
+            t0 = time.perf_counter()
+            client.post(f"/tasks/{tid}/stop")
+
+            def idle():
+                if tid in A.task_cancel_tokens or tid in A.running_processes or A.limiter.get_running():
+                    return False
+                return llm_mock.disconnects > disc0 if scenario == "llm" else not pgid_alive(pgid)
+
+            ok = wait_until(idle, 10)
+            ms = int((time.perf_counter() - t0) * 1000)
+            status = A.get_task(tid)["status"]
+            detail = f"status={status}" + (f" disconnects={llm_mock.disconnects - disc0}" if scenario == "llm" else f" pgid={pgid} alive={pgid_alive(pgid)}")
+            if not ok or ms > args.max_ms:
+                failed = True
+                detail += "  ← 超出上限"
+            print(f"{engine:<8} {scenario:<6} {ms:>16}  {detail}")
+            threading.Event().wait(0.2)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+输出目录文件清单检查：新增/修改/删除识别 与 大目录重复比对的耗时
+
+1. 清单差异：新建、同名覆盖（尺寸或 mtime 变化）、删除分别识别为 created / modified / deleted；
+   已算过哈希的文件被原样重写（内容不变、mtime 变化）时不算修改；空文件与子目录不计入；
+2. 工具轮次：mock 角色用 run_command 覆盖一个已存在的文件，toolEvents 的 producedFiles 中应包含它
+   （只比较文件名集合时会被漏掉）；
+3. 大目录：--files 个文件的目录上重复 --repeat 次快照比对（每次之前都有工具事件、清单需重新扫描），
+   对比每次 listdir + stat 全量比对的耗时；
+4. 快照复用：在大目录上跑 --rounds 轮工具（含一轮被拒绝的命令），统计实际 stat 次数，
+   对比每轮前后各扫描一次的 2 × rounds × files。
+任一项不符合预期时以非 0 退出码结束。
+
+示例：
+  python3 scripts/check_file_manifest.py --files 20000 --repeat 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from bench_workflow_engine import MockLLM
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--files", type=int, default=20000, help="大目录场景的文件数")
+    p.add_argument("--repeat", type=int, default=20, help="大目录场景重复比对次数")
+    p.add_argument("--rounds", type=int, default=4, help="快照复用场景的工具轮数")
+    return p.parse_args()
+
+
+def write(path: str, text: str):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def full_listing(d: str) -> dict:
+    out = {}
+    for name in os.listdir(d):
+        full = os.path.join(d, name)
+        if os.path.isfile(full):
+            st = os.stat(full)
+            out[name] = (st.st_size, st.st_mtime_ns)
+    return out
+
+
+def main():
+    args = parse_args()
+    work = tempfile.mkdtemp(prefix="atc_manifest_")
+    os.environ["ATC_DB_PATH"] = os.path.join(work, "tasks.db")
+    os.environ["ATC_ARTIFACT_ROOT"] = os.path.join(work, "artifacts")
+    os.environ["ATC_WORKDIR"] = work
+    os.environ["ATC_ROLE_DEFAULT_API_KEY"] = "check"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+
+    failed = False
+
+    def check(label: str, ok: bool, detail):
+        nonlocal failed
+        failed |= not ok
+        print(f"{label:<12} {detail}{'' if ok else '  ← 未通过'}")
+
+    with A.db_conn() as conn:
+        tid = conn.execute(
+            "INSERT INTO tasks(title, description, status, created_at, updated_at) VALUES(?,?,?,?,?)",
+            ("manifest-check", "文件清单检查", "running", A.now_str(), A.now_str()),
+        ).lastrowid
+    A.running_processes[tid] = None
+    A.task_file_manifests[tid] = {}
+    base_dir, input_dir, output_dir = A.task_artifact_dirs(tid)
+
+    write(os.path.join(output_dir, "keep.txt"), "keep")
+    write(os.path.join(output_dir, "report.md"), "v1")
+    write(os.path.join(output_dir, "old.csv"), "a,b")
+    write(os.path.join(output_dir, "same.json"), '{"x": 1}')
+    A.manifest_snapshot(tid, [output_dir])
+    A.task_file_manifest(tid, output_dir).digest("same.json")
+    before = A.manifest_snapshot(tid, [output_dir])
+    time.sleep(0.02)
+    write(os.path.join(output_dir, "report.md"), "v2 longer")
+    write(os.path.join(output_dir, "same.json"), '{"x": 1}')
+    os.remove(os.path.join(output_dir, "old.csv"))
+    write(os.path.join(output_dir, "new.zip"), "zip")
+    write(os.path.join(output_dir, "empty.txt"), "")
+    os.makedirs(os.path.join(output_dir, "subdir"))
+    A.touch_task_files(tid)
+    changes = A.diff_file_manifests(before, A.manifest_snapshot(tid, [output_dir]))
+    expected = {"created": ["empty.txt", "new.zip"], "modified": ["report.md"], "deleted": ["old.csv"]}
+    check("diff", changes == expected, json.dumps(changes, ensure_ascii=False))
+
+    def reply(messages):
+        if any(m["role"] == "user" and "工具执行结果摘要" in m["content"] for m in messages):
+            return json.dumps({"action": "final", "content": "已更新报告"}, ensure_ascii=False)
+        return json.dumps({"action": "run_command", "command": "echo v3 > $TASK_OUTPUT_DIR/report.md", "reason": "check"}, ensure_ascii=False)
+
+    mock = MockLLM(0.0, reply_fn=reply)
+    port = mock.start()
+    with A.db_conn() as conn:
+        conn.execute("UPDATE roles SET api_base=?", (f"http://127.0.0.1:{port}",))
+    role = A.get_role_by_code("backend")
+    messages = [{"role": "system", "content": "check"}, {"role": "user", "content": "更新报告"}]
+    _, events = asyncio.run(A.run_role_stage_with_tools(tid, "后端实现", role, messages, base_dir, input_dir, output_dir))
+    produced = events[0].get("producedFiles") if events else None
+    check("overwrite", produced == ["report.md"], f"producedFiles={produced}")
+
+    big = os.path.join(work, "big")
+    os.makedirs(big)
+    for i in range(args.files):
+        write(os.path.join(big, f"f{i:06d}.txt"), str(i))
+    t0 = time.perf_counter()
+    prev = full_listing(big)
+    for _ in range(args.repeat):
+        cur = full_listing(big)
+        _ = [k for k, v in cur.items() if prev.get(k) != v]
+        prev = cur
+    full_sec = time.perf_counter() - t0
+
+    time.sleep(0.05)
+    t0 = time.perf_counter()
+    prev = A.manifest_snapshot(tid, [big])
+    for _ in range(args.repeat):
+        A.touch_task_files(tid)
+        cur = A.manifest_snapshot(tid, [big])
+        changes = A.diff_file_manifests(prev, cur)
+        prev = cur
+    manifest_sec = time.perf_counter() - t0
+    unchanged = not any(changes.values())
+    check("large dir", unchanged and manifest_sec <= full_sec * 1.1, f"{args.files} 个文件 × {args.repeat} 次：全量 listdir+stat {full_sec:.2f}s，增量清单 {manifest_sec:.2f}s")
+
+    def loop_reply(messages):
+        done = sum(1 for m in messages if m["role"] == "user" and ("工具执行结果摘要" in m["content"] or "拒绝执行" in m["content"]))
+        if done >= args.rounds:
+            return json.dumps({"action": "final", "content": "完成"}, ensure_ascii=False)
+        if done == 1:
+            return json.dumps({"action": "run_command", "command": "rm -rf /", "reason": "check"}, ensure_ascii=False)
+        return json.dumps({"action": "run_command", "command": f"echo {done} > $TASK_OUTPUT_DIR/round{done}.txt", "reason": "check"}, ensure_ascii=False)
+
+    mock.reply_fn = loop_reply
+    manifest = A.task_file_manifest(tid, big)
+    manifest.invalidate()
+    calls0 = manifest.stat_calls
+    messages = [{"role": "system", "content": "check"}, {"role": "user", "content": "多轮工具"}]
+    _, events = asyncio.run(A.run_role_stage_with_tools(tid, "后端实现", role, messages, base_dir, input_dir, big))
+    stats = manifest.stat_calls - calls0
+    naive = 2 * args.rounds * args.files
+    produced = [e.get("producedFiles") for e in events]
+    ok = len(events) == args.rounds and produced[0] == ["round0.txt"] and produced[1] == [] and stats < naive
+    check("reuse", ok, f"{args.rounds} 轮工具：stat {stats} 次，每轮前后各扫描需约 {naive} 次（减少 {1 - stats / naive:.0%}）；producedFiles={produced}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
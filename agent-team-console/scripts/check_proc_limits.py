@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+工具进程资源限制与用量统计检查
+
+在临时目录生成 scripts/burn.py（按参数消耗 CPU、分配并写满内存、写文件），经 execute_role_command 执行：
+1. 用量：CPU 秒、峰值 RSS 与脚本实际消耗相符（bash 与预热执行器两条路径）；
+2. 限制：cpu / mem / wall 超限时命令被终止，exitReason 分别为 cpu_limit / memory_limit / timeout；
+3. 准入：机器判定为饱和时，第二条命令等待第一条结束后才启动；
+4. 任务元数据 tasks.resource_json 累计了上述命令的用量。
+传入 --cgroup-root（已委派的 cgroup v2 目录）时改用 cgroup 限制与统计。任一项不符合预期时以非 0 退出码结束。
+
+示例：
+  python3 scripts/check_proc_limits.py
+  python3 scripts/check_proc_limits.py --cgroup-root /sys/fs/cgroup/atc
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--cgroup-root", default="", help="cgroup v2 根目录（需已委派并开启 memory/pids 控制器）")
+    p.add_argument("--rss-mb", type=int, default=150, help="用量场景分配并写满的内存（MB）")
+    p.add_argument("--cpu-sec", type=float, default=1.0, help="用量场景消耗的 CPU 秒数")
+    return p.parse_args()
+
+
+BURN = """
+import argparse, os, time
+p = argparse.ArgumentParser()
+p.add_argument("--cpu", type=float, default=0)
+p.add_argument("--mb", type=int, default=0)
+p.add_argument("--write-mb", type=int, default=0)
+p.add_argument("--sleep", type=float, default=0)
+a = p.parse_args()
+buf = bytearray(a.mb * 1024 * 1024)
+for i in range(0, len(buf), 4096):
+    buf[i] = 1
+t0 = time.process_time()
+while a.cpu < 0 or time.process_time() - t0 < a.cpu:
+    pass
+if a.write_mb:
+    with open(os.path.join(os.environ["TASK_OUTPUT_DIR"], "blob.bin"), "wb") as f:
+        f.write(os.urandom(a.write_mb * 1024 * 1024))
+        f.flush()
+        os.fsync(f.fileno())
+time.sleep(a.sleep)
+print("burn done", a)
+"""
+
+
+def main():
+    args = parse_args()
+    work = tempfile.mkdtemp(prefix="atc_limits_")
+    os.makedirs(os.path.join(work, "scripts"))
+    with open(os.path.join(work, "scripts", "burn.py"), "w", encoding="utf-8") as f:
+        f.write(BURN)
+    os.environ["ATC_DB_PATH"] = os.path.join(work, "tasks.db")
+    os.environ["ATC_ARTIFACT_ROOT"] = os.path.join(work, "artifacts")
+    os.environ["ATC_WORKDIR"] = work
+    os.environ["ATC_WARM_RUNNER_SOCKET"] = os.path.join(work, "warm_runner.sock")
+    os.environ["ATC_TOOL_CGROUP_ROOT"] = args.cgroup_root
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+
+    with A.db_conn() as conn:
+        tid = conn.execute(
+            "INSERT INTO tasks(title, description, status, created_at, updated_at) VALUES(?,?,?,?,?)",
+            ("limits-check", "资源限制检查", "running", A.now_str(), A.now_str()),
+        ).lastrowid
+    dirs = A.task_artifact_dirs(tid)
+    A.running_processes[tid] = None
+    failed = False
+
+    def run(cmd: str, limits: dict = None):
+        A.task_tool_limits[tid] = limits or {}
+        return asyncio.run(A.execute_role_command(cmd, tid, *dirs, timeout_sec=60))
+
+    def check(label: str, ok: bool, res: dict):
+        nonlocal failed
+        failed |= not ok
+        usage = res.get("usage") or {}
+        print(
+            f"{label:<14} rc={res['rc']:<4} exit={res.get('exitReason'):<13} cpu={usage.get('cpuSec')}s "
+            f"rss={usage.get('maxRssMb')}MB io(r/w)={usage.get('ioReadBytes')}/{usage.get('ioWriteBytes')}B "
+            f"wall={res['durationSec']}s launcher={res['launcher']}{'' if ok else '  ← 未通过'}"
+        )
+
+    burn = f"python3 scripts/burn.py --cpu {args.cpu_sec} --mb {args.rss_mb} --write-mb 8"
+    for warm in (False, True):
+        A.WARM_RUNNER = warm
+        if warm and not A.ensure_warm_runner():
+            print("预热执行器启动失败，跳过 warm 路径")
+            failed = True
+            continue
+        res = run(burn)
+        u = res["usage"]
+        ok = res["exitReason"] == "ok" and abs(u["cpuSec"] - args.cpu_sec) < args.cpu_sec * 0.5 + 0.3 and u["maxRssMb"] >= args.rss_mb
+        check(f"usage/{res['launcher']}", ok, res)
+
+        res = run("python3 scripts/burn.py --cpu -1", {"cpu_sec": 1})
+        check(f"cpu=1/{res['launcher']}", res["exitReason"] == "cpu_limit" and res["usage"]["cpuSec"] < 8, res)
+
+        res = run(f"python3 scripts/burn.py --mb {args.rss_mb * 2}", {"mem_mb": args.rss_mb})
+        check(f"mem={args.rss_mb}/{res['launcher']}", res["exitReason"] == "memory_limit", res)
+
+        res = run("python3 scripts/burn.py --sleep 30", {"wall_sec": 2})
+        check(f"wall=2/{res['launcher']}", res["exitReason"] == "timeout" and res["durationSec"] < 5, res)
+    A.WARM_RUNNER = False
+
+    # 准入：预留内存设为超过本机可用内存，第二条命令须等第一条结束
+    A.TOOL_ADMIT_RESERVE_MB = int(A.proc_limits.mem_available_mb()) + 1024
+    A.task_tool_limits[tid] = {}
+
+    async def pair():
+        first = asyncio.ensure_future(A.execute_role_command("python3 scripts/burn.py --sleep 2", tid, *dirs))
+        await asyncio.sleep(0.3)
+        second = await A.execute_role_command("python3 scripts/burn.py", tid, *dirs)
+        return await first, second
+
+    t0 = time.perf_counter()
+    first, second = asyncio.run(pair())
+    ok = first["admitWaitSec"] < 0.5 and second["admitWaitSec"] >= 1.2
+    failed |= not ok
+    print(f"admission      first wait={first['admitWaitSec']}s second wait={second['admitWaitSec']}s total={time.perf_counter() - t0:.1f}s{'' if ok else '  ← 未通过'}")
+
+    totals = A.load_task_resources(tid)
+    ok = totals.get("commands", 0) >= 10 and totals.get("exitReasons", {}).get("cpu_limit")
+    failed |= not ok
+    print(f"task totals    {json.dumps(totals, ensure_ascii=False)}{'' if ok else '  ← 未通过'}")
+    if A.warm_runner_state.get("proc"):
+        A.warm_runner_state["proc"].terminate()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+工具结果缓存检查：命中/失效/强制刷新/过期 与 返工场景节省的耗时
+
+在临时目录生成 scripts/slow_fetch.py（sleep --sleep 秒，读取输入目录文件后写出 result.json 与 report/summary.md），
+按返工场景对同一命令执行 --rounds 次，依次检查：
+1. 首次未命中、真实执行；之后各轮命中，产物与首次逐字节一致、返回码与输出摘要一致；
+2. 修改输入文件后缓存键变化，重新执行；
+3. refresh=True 强制重新执行；
+4. cache_ttl 小于缓存年龄时视为过期，重新执行。
+任一项不符合预期时以非 0 退出码结束。
+
+示例：
+  python3 scripts/check_tool_cache.py --rounds 5 --sleep 1.5
+"""
+
+import argparse
+import asyncio
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--rounds", type=int, default=5, help="同一命令重复执行次数（模拟返工轮次）")
+    p.add_argument("--sleep", type=float, default=1.5, help="慢速脚本执行耗时（秒）")
+    return p.parse_args()
+
+
+def tree_digest(root: str) -> dict:
+    out = {}
+    for base, _, names in os.walk(root):
+        for name in names:
+            full = os.path.join(base, name)
+            with open(full, "rb") as f:
+                out[os.path.relpath(full, root)] = hashlib.sha256(f.read()).hexdigest()
+    return out
+
+
+def main():
+    args = parse_args()
+    work = tempfile.mkdtemp(prefix="atc_toolcache_")
+    os.makedirs(os.path.join(work, "scripts"))
+    with open(os.path.join(work, "scripts", "slow_fetch.py"), "w", encoding="utf-8") as f:
+        f.write(
+            "import json, os, random, sys, time\n"
+            f"time.sleep({args.sleep})\n"
+            "src = os.path.join(os.environ['TASK_INPUT_DIR'], 'seed.txt')\n"
+            "seed = open(src, encoding='utf-8').read().strip()\n"
+            "out = os.environ['TASK_OUTPUT_DIR']\n"
+            "os.makedirs(os.path.join(out, 'report'), exist_ok=True)\n"
+            "json.dump({'seed': seed, 'nonce': random.random()}, open(os.path.join(out, 'result.json'), 'w'))\n"
+            "open(os.path.join(out, 'report', 'summary.md'), 'w').write('# ' + seed + '\\n')\n"
+            "for i in range(20):\n"
+            "    print('fetched item', i, seed)\n"
+            "print('done', sys.argv[1:])\n"
+        )
+    os.environ["ATC_DB_PATH"] = os.path.join(work, "tasks.db")
+    os.environ["ATC_ARTIFACT_ROOT"] = os.path.join(work, "artifacts")
+    os.environ["ATC_WORKDIR"] = work
+    os.environ["ATC_TOOL_CACHE"] = "1"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+
+    with A.db_conn() as conn:
+        tid = conn.execute(
+            "INSERT INTO tasks(title, description, status, created_at, updated_at) VALUES(?,?,?,?,?)",
+            ("tool-cache-check", "工具结果缓存检查", "running", A.now_str(), A.now_str()),
+        ).lastrowid
+    base_dir, input_dir, output_dir = A.task_artifact_dirs(tid)
+    with open(os.path.join(input_dir, "seed.txt"), "w", encoding="utf-8") as f:
+        f.write("alpha\n")
+    cmd = 'python3 scripts/slow_fetch.py --query "都市 小说" --out $TASK_OUTPUT_DIR/result.json'
+    failed = False
+
+    def run(**kw):
+        spill_path, _ = A.tool_output_path(base_dir, "check", 1)
+        t0 = time.perf_counter()
+        result = asyncio.run(A.execute_role_command(cmd, tid, base_dir, input_dir, output_dir, spill_path=spill_path, **kw))
+        with open(spill_path, encoding="utf-8") as f:
+            replayed = "fetched item 19" in f.read()
+        return result, time.perf_counter() - t0, replayed
+
+    def check(label: str, ok: bool, detail: str):
+        nonlocal failed
+        failed |= not ok
+        print(f"{label:<10} {detail}{'' if ok else '  ← 未通过'}")
+
+    first, first_sec, _ = run()
+    baseline = tree_digest(output_dir)
+    check("miss", not first["cache"]["hit"] and first["cache"]["stored"] and first["rc"] == 0, f"sec={first_sec:.2f} launcher={first['launcher']} files={sorted(baseline)}")
+
+    hit_secs = []
+    for i in range(2, args.rounds + 1):
+        for name in list(baseline):
+            os.remove(os.path.join(output_dir, name))
+        res, sec, replayed = run()
+        hit_secs.append(sec)
+        same = tree_digest(output_dir) == baseline and res["rc"] == first["rc"] and res["tail"] == first["tail"] and replayed
+        check(f"hit#{i}", res["cache"]["hit"] and same, f"sec={sec:.3f} launcher={res['launcher']} identical={same}")
+
+    with open(os.path.join(input_dir, "seed.txt"), "w", encoding="utf-8") as f:
+        f.write("beta\n")
+    res, sec, _ = run()
+    check("input", not res["cache"]["hit"] and tree_digest(output_dir) != baseline, f"sec={sec:.2f} 输入变化后重新执行")
+
+    res, sec, _ = run(refresh=True)
+    check("refresh", not res["cache"]["hit"] and res["cache"]["refresh"], f"sec={sec:.2f} 强制刷新重新执行")
+
+    time.sleep(1.1)
+    res, sec, _ = run(cache_ttl=1)
+    check("ttl", not res["cache"]["hit"], f"sec={sec:.2f} 超过 ttl=1s 重新执行")
+
+    uncached = first_sec * args.rounds
+    cached = first_sec + sum(hit_secs)
+    print(f"rework    {args.rounds} 轮：无缓存约 {uncached:.2f}s，缓存 {cached:.2f}s（节省 {uncached - cached:.2f}s）")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
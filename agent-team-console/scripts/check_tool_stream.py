@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+工具命令流式输出检查：日志可观测时延 + 大输出内存占用 + 超时后的部分输出
+
+1. 慢速命令每 --tick 秒输出一行，统计从命令输出到该行出现在任务日志中的最大时延；
+2. 命令输出 --mb MB 数据，用 tracemalloc 统计执行期间 Python 内存峰值，
+   同时核对落盘的完整输出文件与行数/字节数统计；
+3. 命令先输出若干行再挂起，超时被终止后摘要与完整输出文件仍保留已输出内容。
+任一项超出阈值时以非 0 退出码结束。
+
+示例：
+  python3 scripts/check_tool_stream.py --mb 200
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--mb", type=int, default=100, help="大输出场景的输出量（MB）")
+    p.add_argument("--ticks", type=int, default=6)
+    p.add_argument("--tick", type=float, default=0.5, help="慢速命令每行间隔秒数")
+    p.add_argument("--max-peak-mb", type=float, default=16.0, help="大输出场景 Python 内存峰值上限")
+    return p.parse_args()
+
+
+def log_lines(A, tid: int) -> list:
+    with A.db_conn() as conn:
+        return [r["line"] for r in conn.execute("SELECT line FROM task_logs WHERE task_id=? ORDER BY id", (tid,)).fetchall()]
+
+
+async def observe_latency(A, tid: int, dirs, args) -> float:
+    """命令每行带上输出时刻，轮询任务日志记录每行首次可见时刻。"""
+    cmd = f'for i in $(seq {args.ticks}); do echo "tick $i $(date +%s.%N)"; sleep {args.tick}; done'
+    seen = {}
+
+    async def poll():
+        while True:
+            for ln in log_lines(A, tid):
+                parts = ln.split("tick ", 1)[-1].split()
+                if ln.find("tick ") >= 0 and len(parts) == 2 and parts[0] not in seen:
+                    seen[parts[0]] = time.time() - float(parts[1])
+            await asyncio.sleep(0.02)
+
+    poller = asyncio.ensure_future(poll())
+    result = await A.execute_role_command(cmd, tid, *dirs, log_prefix="[check] ")
+    await asyncio.sleep(0.1)
+    poller.cancel()
+    for ln in log_lines(A, tid):
+        parts = ln.split("tick ", 1)[-1].split()
+        if "tick " in ln and len(parts) == 2 and parts[0] not in seen:
+            seen[parts[0]] = time.time() - float(parts[1])
+    assert result["rc"] == 0 and result["lines"] == args.ticks, result
+    return max(seen.values()) if len(seen) == args.ticks else float("inf")
+
+
+def main():
+    args = parse_args()
+    work = tempfile.mkdtemp(prefix="atc_stream_")
+    os.environ["ATC_DB_PATH"] = os.path.join(work, "tasks.db")
+    os.environ["ATC_ARTIFACT_ROOT"] = os.path.join(work, "artifacts")
+    os.environ["ATC_WORKDIR"] = work
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+
+    with A.db_conn() as conn:
+        tid = conn.execute(
+            "INSERT INTO tasks(title, description, status, created_at, updated_at) VALUES(?,?,?,?,?)",
+            ("stream-check", "工具流式输出检查", "running", A.now_str(), A.now_str()),
+        ).lastrowid
+    base_dir, input_dir, output_dir = A.task_artifact_dirs(tid)
+    dirs = (base_dir, input_dir, output_dir)
+    failed = False
+
+    latency = asyncio.run(observe_latency(A, tid, dirs, args))
+    limit = A.TOOL_STREAM_LOG_SEC + 0.5
+    ok = latency <= limit
+    failed |= not ok
+    print(f"observe   max line->log latency={latency:.2f}s (limit {limit:.1f}s){'' if ok else '  ← 超出上限'}")
+
+    spill_path, handle = A.tool_output_path(base_dir, "check", 1)
+    cmd = f"yes 'stream-check 0123456789 abcdefghijklmnopqrstuvwxyz' | head -c {args.mb * 1024 * 1024}"
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = asyncio.run(A.execute_role_command(cmd, tid, *dirs, timeout_sec=600, spill_path=spill_path, log_prefix="[check] "))
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    peak_mb = peak / 1024 / 1024
+    expected = args.mb * 1024 * 1024
+    spill_ok = os.path.getsize(spill_path) > expected and result["bytes"] == expected
+    ok = peak_mb <= args.max_peak_mb and spill_ok and result["rc"] == 0
+    failed |= not ok
+    logged = sum(1 for ln in log_lines(A, tid) if "stream-check" in ln)
+    print(
+        f"bulk      {args.mb}MB lines={result['lines']} bytes={result['bytes']} sec={elapsed:.2f} "
+        f"peak={peak_mb:.1f}MB (limit {args.max_peak_mb}MB) logged={logged} handle={handle}{'' if ok else '  ← 未通过'}"
+    )
+
+    spill_path, handle = A.tool_output_path(base_dir, "check", 2)
+    A.task_deadlines[tid] = (time.perf_counter(), 1.5)
+    result = asyncio.run(A.execute_role_command("echo before-timeout; echo oops error here; sleep 60", tid, *dirs, spill_path=spill_path))
+    A.task_deadlines.pop(tid, None)
+    with open(spill_path, encoding="utf-8") as f:
+        kept = "before-timeout" in f.read()
+    ok = result["timedOut"] and result["lines"] == 2 and bool(result["errorLines"]) and kept
+    failed |= not ok
+    print(f"timeout   timedOut={result['timedOut']} lines={result['lines']} errorLines={result['errorLines']} spillKept={kept}{'' if ok else '  ← 未通过'}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+任务状态 webhook 与长轮询检查
+
+启动本地接收端（校验 HMAC 签名；发往 /flaky 的前 --fail-first 次请求返回 500），经 /api/tasks/bulk 创建任务后：
+1. 全局订阅（全部状态）收到 running、done 两次通知，单任务订阅（只订 done）收到 done；签名均校验通过；
+2. /flaky 订阅失败后按退避重试，最终投递成功，attempts = --fail-first + 1；
+3. 任务运行期间调用 /api/tasks/<id>/wait，任务完成后立即返回（统计从状态变为 done 到返回的时延）；
+4. 对未启动的任务 wait?timeout=1 约 1 秒后返回 timedOut；
+5. 挂起 ATC_TASK_WAIT_MAX_WAITERS 个等待后，再来的等待立即返回 429 与当前状态。
+任一项不符合预期时以非 0 退出码结束。
+
+示例：
+  python3 scripts/check_webhooks.py --latency 0.2 --fail-first 2
+"""
+
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bench_workflow_engine import MockLLM
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--latency", type=float, default=0.2, help="mock 模型每次调用的延迟秒数")
+    p.add_argument("--fail-first", type=int, default=2, help="/flaky 接收端前几次返回 500")
+    return p.parse_args()
+
+
+SECRET = "check-secret"
+
+
+def start_receiver(fail_first: int):
+    received, failures = [], {"n": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            expected = "sha256=" + hmac.new(SECRET.encode(), self.headers["X-ATC-Timestamp"].encode() + b"." + body, hashlib.sha256).hexdigest()
+            if self.path == "/flaky" and failures["n"] < fail_first:
+                failures["n"] += 1
+                self.send_response(500)
+                self.end_headers()
+                return
+            received.append(
+                {"path": self.path, "payload": json.loads(body), "signed": hmac.compare_digest(expected, self.headers.get("X-ATC-Signature", "")), "at": time.perf_counter()}
+            )
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}", received
+
+
+def main():
+    args = parse_args()
+    mock = MockLLM(args.latency)
+    port = mock.start()
+    receiver, received = start_receiver(args.fail_first)
+
+    work = tempfile.mkdtemp(prefix="atc_webhook_")
+    os.environ["ATC_DB_PATH"] = os.path.join(work, "tasks.db")
+    os.environ["ATC_ARTIFACT_ROOT"] = os.path.join(work, "artifacts")
+    os.environ["ATC_WORKDIR"] = work
+    os.environ["ATC_ROLE_DEFAULT_API_BASE"] = f"http://127.0.0.1:{port}"
+    os.environ["ATC_ROLE_DEFAULT_API_KEY"] = "check"
+    os.environ["ATC_WEBHOOK_RETRY_BASE_SEC"] = "0.2"
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app as A
+
+    client = A.app.test_client()
+    with client.session_transaction() as s:
+        s["logged_in"] = True
+    failed = False
+
+    def check(label: str, ok: bool, detail: str):
+        nonlocal failed
+        failed |= not ok
+        print(f"{label:<10} {detail}{'' if ok else '  ← 未通过'}")
+
+    ids = client.post("/api/tasks/bulk", json={"tasks": [{"task_brief": "生成一份报告"}, {"task_brief": "不启动的任务"}]}).get_json()["ids"]
+    tid, idle_id = ids
+    client.post("/api/webhooks", json={"url": f"{receiver}/global", "secret": SECRET})
+    client.post("/api/webhooks", json={"url": f"{receiver}/task", "secret": SECRET, "task_id": tid, "events": ["done"]})
+    flaky = client.post("/api/webhooks", json={"url": f"{receiver}/flaky", "secret": SECRET, "task_id": tid, "events": "done,failed"}).get_json()
+
+    done_at = {}
+    update_task = A.update_task
+
+    def traced_update(task_id, **fields):
+        update_task(task_id, **fields)
+        if fields.get("status") in A.TASK_TERMINAL_STATUSES:
+            done_at.setdefault(task_id, time.perf_counter())
+
+    A.update_task = traced_update
+    A.running_processes[tid] = None
+    runner = threading.Thread(target=A.run_task, args=(tid,), daemon=True)
+    runner.start()
+    resp = client.get(f"/api/tasks/{tid}/wait?timeout=60").get_json()
+    returned_at = time.perf_counter()
+    runner.join()
+    lag_ms = (returned_at - done_at.get(tid, returned_at)) * 1000
+    check("wait", resp["status"] == "done" and not resp["timedOut"] and lag_ms < 200, f"status={resp['status']} 完成到返回 {lag_ms:.0f}ms")
+
+    t0 = time.perf_counter()
+    resp = client.get(f"/api/tasks/{idle_id}/wait?timeout=1").get_json()
+    sec = time.perf_counter() - t0
+    check("wait idle", resp["timedOut"] and resp["status"] == "pending" and 0.9 <= sec < 2, f"timedOut={resp['timedOut']} {sec:.2f}s")
+
+    def hold_wait():
+        c = A.app.test_client()
+        with c.session_transaction() as s:
+            s["logged_in"] = True
+        c.get(f"/api/tasks/{idle_id}/wait?timeout=2")
+
+    holders = [threading.Thread(target=hold_wait, daemon=True) for _ in range(A.TASK_WAIT_MAX_WAITERS)]
+    for h in holders:
+        h.start()
+    time.sleep(0.5)
+    t0 = time.perf_counter()
+    resp = client.get(f"/api/tasks/{idle_id}/wait?timeout=2")
+    sec = time.perf_counter() - t0
+    for h in holders:
+        h.join()
+    body = resp.get_json()
+    ok = resp.status_code == 429 and body["status"] == "pending" and sec < 0.5
+    check("wait full", ok, f"{A.TASK_WAIT_MAX_WAITERS} 个等待挂起时 → {resp.status_code} status={body.get('status')} {sec:.2f}s")
+
+    deadline = time.time() + 30
+    while time.time() < deadline and len([r for r in received if r["path"] == "/flaky"]) < 1:
+        time.sleep(0.1)
+    by_path = {}
+    for r in received:
+        by_path.setdefault(r["path"], []).append(r["payload"]["status"])
+    check("global", by_path.get("/global") == ["running", "done"], f"statuses={by_path.get('/global')}")
+    check("per-task", by_path.get("/task") == ["done"], f"statuses={by_path.get('/task')}")
+    check("signature", received and all(r["signed"] for r in received), f"{sum(r['signed'] for r in received)}/{len(received)} 校验通过")
+    rows = client.get(f"/api/webhooks/{flaky['id']}/deliveries").get_json()
+    ok = by_path.get("/flaky") == ["done"] and rows and rows[0]["status"] == "ok" and rows[0]["attempts"] == args.fail_first + 1
+    check("retry", ok, f"deliveries={[(r['status'], r['attempts'], r['last_status']) for r in rows]}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
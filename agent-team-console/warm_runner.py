@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+工具脚本预热执行器（forkserver）
+
+常驻进程预先导入脚本常用依赖，收到请求后 fork 子进程、以 runpy 执行 scripts/*.py 入口，
+省去每次启动解释器和导入 requests/bs4/playwright 等重依赖的开销。
+
+协议：Unix socket，每行一个 JSON。
+  请求  {"argv": ["scripts/x.py", ...], "cwd": "...", "env": {...}, "limits": {...}, "cgroup": "..."}，
+        并通过 SCM_RIGHTS 附带 1 个 fd，作为子进程的 stdout/stderr（与 bash 路径 stderr 合并到 stdout 的约定一致）；
+        limits/cgroup 可选，含义见 proc_limits
+  响应  {"pid": N}   子进程已启动；子进程独立会话（pgid=pid），调用方可按进程组终止
+        {"rc": N, "usage": {...}}  子进程退出；被信号终止时为 128+信号值，与 bash 一致；usage 为 wait4 取得的用量
+        {"error": "..."}  请求无效
+
+启动：
+  python3 warm_runner.py --socket data/warm_runner.sock
+"""
+
+import argparse
+import importlib
+import io
+import json
+import os
+import random
+import re
+import runpy
+import selectors
+import shlex
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import proc_limits
+
+DEFAULT_PRELOAD = (
+    "argparse,asyncio,json,re,random,shutil,subprocess,zipfile,collections,datetime,urllib.request,"
+    "requests,bs4,playwright.async_api"
+)
+REQUEST_MAX_BYTES = 4 * 1024 * 1024
+SHELL_META_RE = re.compile(r"[|;&<>`(){}*?!~\\\n]")
+ENV_REF_RE = re.compile(r"\$(?:\{(\w+)\}|(\w+))")
+COMMAND_RE = re.compile(r"^\s*(?:cd\s+(?P<cd>[^\s;&|]+)\s*&&\s*)?python3?\s+(?P<rest>.+?)\s*$")
+
+
+def expand_env_refs(text: str, env: dict):
+    """按 bash 规则展开 $VAR / ${VAR}（单引号内不展开）；结果会因分词、通配或转义而与 bash 不同时返回 None。"""
+    out, quote, i = [], "", 0
+    while i < len(text):
+        ch = text[i]
+        if ch in "'\"" and quote in ("", ch):
+            quote = "" if quote else ch
+        elif ch == "$" and quote != "'":
+            m = ENV_REF_RE.match(text, i)
+            if not m:
+                return None
+            value = env.get(m.group(1) or m.group(2), "")
+            if quote == '"':
+                if re.search(r'["\\$`]', value):
+                    return None
+                out.append(value)
+            else:
+                if not value or re.search(r"[\s*?\[]", value):
+                    return None
+                out.append(shlex.quote(value))
+            i = m.end()
+            continue
+        out.append(ch)
+        i += 1
+    return "".join(out)
+
+
+def plan_launch(command: str, cwd: str, env: dict):
+    """把 `[cd DIR &&] python3 scripts/x.py args` 形式的命令解析为 (argv, cwd)；其他形式返回 None，交给 bash 执行。"""
+    m = COMMAND_RE.match(command or "")
+    if not m:
+        return None
+    rest, target = m.group("rest"), m.group("cd")
+    if SHELL_META_RE.search(rest) or "$(" in rest:
+        return None
+
+    if target:
+        target = expand_env_refs(target, env)
+        if target is None:
+            return None
+        cwd = os.path.normpath(os.path.join(cwd, shlex.split(target)[0]))
+    rest = expand_env_refs(rest, env)
+    if rest is None:
+        return None
+    try:
+        argv = shlex.split(rest)
+    except ValueError:
+        return None
+    if not argv or argv[0].startswith("-") or not argv[0].endswith(".py"):
+        return None
+    script = os.path.realpath(os.path.join(cwd, argv[0]))
+    if os.path.basename(os.path.dirname(script)) != "scripts" or not os.path.isfile(script):
+        return None
+    return argv, cwd
+
+
+def preload(names: str) -> list:
+    loaded = []
+    for name in [x.strip() for x in (names or "").split(",") if x.strip()]:
+        try:
+            importlib.import_module(name)
+            loaded.append(name)
+        except Exception:
+            pass
+    return loaded
+
+
+def run_child(req: dict, out_fd: int):
+    """fork 后的子进程：接管 stdout/stderr、cwd、env 与 argv，以 __main__ 身份执行脚本，不返回。"""
+    code = 1
+    try:
+        os.setsid()
+        setup = proc_limits.child_setup(req.get("limits") or {}, req.get("cgroup") or "")
+        if setup:
+            setup()
+        signal.set_wakeup_fd(-1)
+        for sig in (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, signal.SIG_DFL)
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        os.dup2(devnull, 0)
+        os.dup2(out_fd, 1)
+        os.dup2(out_fd, 2)
+        os.close(devnull)
+        os.close(out_fd)
+        sys.stdin = io.TextIOWrapper(io.FileIO(0, "r", closefd=False), encoding="utf-8")
+        sys.stdout = io.TextIOWrapper(io.FileIO(1, "w", closefd=False), encoding="utf-8", line_buffering=True)
+        sys.stderr = io.TextIOWrapper(io.FileIO(2, "w", closefd=False), encoding="utf-8", errors="backslashreplace", line_buffering=True)
+
+        os.chdir(req["cwd"])
+        os.environ.clear()
+        os.environ.update(req["env"])
+        argv = [str(x) for x in req["argv"]]
+        script = os.path.abspath(argv[0])
+        sys.argv = argv
+        sys.path[0] = os.path.dirname(script)
+        random.seed()
+        try:
+            runpy.run_path(script, run_name="__main__")
+            code = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+    finally:
+        os._exit(code & 0xFF)
+
+
+def read_request(conn: socket.socket):
+    data, fds = b"", []
+    while not data.endswith(b"\n"):
+        msg, got, _, _ = socket.recv_fds(conn, 65536, 4)
+        fds += got
+        if not msg or len(data) + len(msg) > REQUEST_MAX_BYTES:
+            break
+        data += msg
+    return data, fds
+
+
+def serve(sock_path: str, preload_names: str):
+    loaded = preload(preload_names)
+    if os.path.exists(sock_path):
+        os.unlink(sock_path)
+    os.makedirs(os.path.dirname(os.path.abspath(sock_path)), exist_ok=True)
+    srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    srv.bind(sock_path)
+    os.chmod(sock_path, 0o600)
+    srv.listen(128)
+
+    # 子进程退出通过 SIGCHLD 唤醒主循环回收；服务端保持单线程，fork 时不会继承其他线程持有的锁
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_r, False)
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    sel = selectors.DefaultSelector()
+    sel.register(srv, selectors.EVENT_READ)
+    sel.register(wake_r, selectors.EVENT_READ)
+    waiting = {}
+    print(f"[warm_runner] 已就绪 socket={sock_path} pid={os.getpid()} 预加载={loaded}", flush=True)
+
+    def reply(conn, payload: dict):
+        try:
+            conn.sendall(json.dumps(payload).encode("utf-8") + b"\n")
+        except OSError:
+            pass
+
+    def reap():
+        while True:
+            try:
+                pid, status, ru = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            conn = waiting.pop(pid, None)
+            if conn is not None:
+                reply(conn, {"rc": proc_limits.status_to_rc(status), "usage": proc_limits.rusage_to_usage(ru)})
+                conn.close()
+
+    def accept():
+        conn, _ = srv.accept()
+        conn.settimeout(5)
+        fds = []
+        try:
+            data, fds = read_request(conn)
+            req = json.loads(data or b"{}")
+            if len(fds) != 1 or not req.get("argv") or not req.get("cwd"):
+                raise ValueError("请求需包含 argv、cwd 与 1 个输出 fd")
+        except Exception as e:
+            for fd in fds:
+                os.close(fd)
+            reply(conn, {"error": str(e)})
+            conn.close()
+            return
+        pid = os.fork()
+        if pid == 0:
+            srv.close()
+            conn.close()
+            for other in waiting.values():
+                other.close()
+            os.close(wake_r)
+            os.close(wake_w)
+            run_child(req, fds[0])
+        os.close(fds[0])
+        waiting[pid] = conn
+        reply(conn, {"pid": pid})
+
+    try:
+        while True:
+            for key, _ in sel.select():
+                if key.fileobj is srv:
+                    try:
+                        accept()
+                    except OSError:
+                        pass
+                else:
+                    try:
+                        while os.read(wake_r, 512):
+                            pass
+                    except BlockingIOError:
+                        pass
+            reap()
+    finally:
+        srv.close()
+        if os.path.exists(sock_path):
+            os.unlink(sock_path)
+
+
+def connect(sock_path: str, timeout: float = 2.0) -> socket.socket:
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    try:
+        conn.connect(sock_path)
+    except OSError:
+        conn.close()
+        raise
+    return conn
+
+
+def send_request(conn: socket.socket, argv: list, cwd: str, env: dict, out_fd: int, limits: dict = None, cgroup: str = ""):
+    data = json.dumps({"argv": argv, "cwd": cwd, "env": env, "limits": limits or {}, "cgroup": cgroup}).encode("utf-8") + b"\n"
+    sent = socket.send_fds(conn, [data], [out_fd])
+    if sent < len(data):
+        conn.sendall(data[sent:])
+
+
+def wait_ready(sock_path: str, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connect(sock_path, timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+
+def parse_args():
+    p = argparse.ArgumentParser()
+    p.add_argument("--socket", default=os.getenv("ATC_WARM_RUNNER_SOCKET", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "warm_runner.sock")))
+    p.add_argument("--preload", default=os.getenv("ATC_WARM_RUNNER_PRELOAD", DEFAULT_PRELOAD), help="逗号分隔的预导入模块，导入失败的模块会被跳过")
+    return p.parse_args()
+
+
+def main():
+    args = parse_args()
+    serve(args.socket, args.preload)
+
+
+if __name__ == "__main__":
+    main()